@@ -0,0 +1,359 @@
+# benchmark.py - Сквозной бенчмарк пропускной способности бота
+#
+# Гоняет синтетические апдейты aiogram через dp.feed_update по сценарию
+# /start → 📝 Генерация → gen:post → тема/стиль/аудитория/CTA → regen → save
+# на временной SQLite и локальных fake_upstreams (без сети и без Telegram).
+# Для шагов с генерацией латентность меряется до доставки результата очередью задач.
+#
+# Запуск:
+#   python benchmark.py --users 200 --concurrency 50 --latency-ms 300 --out bench_result.json
+#   python benchmark.py ... --baseline bench_result.json   # сравнение с прошлым прогоном
+
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# Все настройки окружения — до импорта main/config
+_TMP_DIR = tempfile.mkdtemp(prefix="contentgpt_bench_")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _prepare_env(fake_port: int, telegram_limits: bool) -> None:
+    os.environ["DATABASE_PATH"] = os.path.join(_TMP_DIR, "bench.db")
+    os.environ["TELEGRAM_BOT_TOKEN"] = "123456789:BENCHMARKbenchmarkBENCHMARKbenchmark"
+    os.environ["ADMIN_ID"] = "1"
+    os.environ["YANDEX_GPT_API_URL"] = f"http://127.0.0.1:{fake_port}/foundationModels/v1/completion"
+    os.environ["YANDEX_GPT_API_KEY"] = "bench"
+    os.environ["YANDEX_GPT_FOLDER_ID"] = "bench"
+    os.environ["YANDEX_GPT_CREDENTIALS"] = ""
+    os.environ["YANDEX_GPT_RPS_PER_KEY"] = "100000"
+    os.environ["YOOKASSA_API_BASE"] = f"http://127.0.0.1:{fake_port}/v3"
+    os.environ["YANDEX_KASSA_SHOP_ID"] = "bench"
+    os.environ["YANDEX_KASSA_SECRET_KEY"] = "bench"
+    if not telegram_limits:
+        # Синтетические пользователи «жмут» быстрее живых — лимиты Telegram
+        # маскировали бы время самих хендлеров
+        os.environ["TG_GLOBAL_RATE"] = "1000000"
+        os.environ["TG_CHAT_RATE"] = "1000000"
+
+
+# Время в SQLite, накопленное текущим апдейтом
+_db_time: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("db_time", default=None)
+
+
+def _timed(fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            acc = _db_time.get()
+            if acc is not None:
+                acc[0] += time.perf_counter() - started
+    return wrapper
+
+
+class TimedCursor(sqlite3.Cursor):
+    execute = _timed(sqlite3.Cursor.execute)
+    executemany = _timed(sqlite3.Cursor.executemany)
+    fetchone = _timed(sqlite3.Cursor.fetchone)
+    fetchall = _timed(sqlite3.Cursor.fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    execute = _timed(sqlite3.Connection.execute)
+    executemany = _timed(sqlite3.Connection.executemany)
+    commit = _timed(sqlite3.Connection.commit)
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """q-й перцентиль (0..100) методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "mean": round(statistics.fmean(values), 3) if values else 0.0,
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(max(values), 3) if values else 0.0,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    import uvicorn
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import AnswerCallbackQuery, TelegramMethod
+    from aiogram.types import CallbackQuery, Chat, Message, Update, User
+    from loguru import logger
+
+    from fake_upstreams import FakeUpstreamConfig, create_app
+
+    import main as botmain
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    # ---------- Telegram Bot API stand-in ----------
+    message_ids = itertools.count(1)
+    api_calls: Dict[str, int] = {}
+
+    class FakeTelegramSession(BaseSession):
+        """Отвечает на методы Bot API локально, без сети."""
+
+        async def make_request(self, bot, method: TelegramMethod, timeout=None):
+            name = type(method).__name__
+            api_calls[name] = api_calls.get(name, 0) + 1
+            if isinstance(method, AnswerCallbackQuery) or method.__returning__ is bool:
+                return True
+            chat_id = getattr(method, "chat_id", None) or 0
+            return Message(
+                message_id=next(message_ids),
+                date=datetime.now(),
+                chat=Chat(id=int(chat_id), type="private"),
+                text=getattr(method, "text", None),
+            )
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    fake_session = FakeTelegramSession()
+    fake_session.middleware = botmain.bot.session.middleware
+    botmain.bot.session = fake_session
+
+    # ---------- instrumented DB ----------
+    def timed_connection():
+        conn = sqlite3.connect(botmain.DATABASE_PATH, timeout=10, check_same_thread=False, factory=TimedConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    botmain.get_db_connection = timed_connection
+    botmain.metrics_writer.connect = timed_connection
+    botmain.init_database()
+
+    # ---------- fake upstreams ----------
+    fake_cfg = FakeUpstreamConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_429=args.error_429,
+        error_5xx=args.error_5xx,
+        seed=args.seed,
+    )
+    fake_app = create_app(fake_cfg)
+    server = uvicorn.Server(uvicorn.Config(fake_app, host="127.0.0.1", port=args.fake_port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    await botmain.metrics_writer.start()
+    await botmain.fsm_storage.start()
+    await botmain.jobs.start()
+
+    # ---------- synthetic updates ----------
+    update_ids = itertools.count(1)
+
+    def _user(uid: int) -> User:
+        return User(id=uid, is_bot=False, first_name=f"Bench{uid}", username=f"bench{uid}")
+
+    def _message(uid: int, text: str) -> Update:
+        return Update(
+            update_id=next(update_ids),
+            message=Message(
+                message_id=next(message_ids),
+                date=datetime.now(),
+                chat=Chat(id=uid, type="private"),
+                from_user=_user(uid),
+                text=text,
+            ),
+        )
+
+    def _callback(uid: int, data: str) -> Update:
+        return Update(
+            update_id=next(update_ids),
+            callback_query=CallbackQuery(
+                id=str(next(update_ids)),
+                from_user=_user(uid),
+                chat_instance=str(uid),
+                data=data,
+                message=Message(
+                    message_id=next(message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=uid, type="private"),
+                    from_user=_user(botmain.bot.id),
+                    text="…",
+                ),
+            ),
+        )
+
+    script = [
+        ("start", lambda uid: _message(uid, "/start")),
+        ("menu", lambda uid: _message(uid, "📝 Генерация")),
+        ("gen:post", lambda uid: _callback(uid, "gen:post")),
+        ("topic", lambda uid: _message(uid, "путешествия по Алтаю")),
+        ("style", lambda uid: _callback(uid, "poststyle:pro")),
+        ("audience", lambda uid: _message(uid, "молодые семьи")),
+        ("cta", lambda uid: _message(uid, "подпишись на канал")),
+        ("regen", lambda uid: _callback(uid, "content:regen")),
+        ("save", lambda uid: _callback(uid, "content:save")),
+    ]
+
+    # Шаги, результат которых доставляет очередь задач: меряем до доставки
+    job_steps = {"cta", "regen"}
+
+    def _pending_jobs(uid: int) -> int:
+        conn = sqlite3.connect(botmain.DATABASE_PATH, timeout=10)
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ('queued', 'leased')", (uid,)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    latencies: List[float] = []
+    db_times: List[float] = []
+    per_step: Dict[str, List[float]] = {name: [] for name, _ in script}
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(step: str, uid: int, update: Update) -> None:
+        nonlocal errors
+        acc = [0.0]
+        token = _db_time.set(acc)
+        started = time.perf_counter()
+        try:
+            await botmain.dp.feed_update(botmain.bot, update)
+            if step in job_steps:
+                while await asyncio.to_thread(_pending_jobs, uid):
+                    await asyncio.sleep(0.005)
+        except Exception as e:
+            errors += 1
+            logger.warning("update {} failed: {}", step, e)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            _db_time.reset(token)
+            latencies.append(elapsed)
+            db_times.append(acc[0] * 1000)
+            per_step[step].append(elapsed)
+
+    async def session(uid: int) -> None:
+        async with semaphore:
+            for step, build in script:
+                await feed(step, uid, build(uid))
+
+    # Пользователи с user_id > ADMIN_ID, чтобы работали обычные лимиты
+    base_uid = 1_000_000
+    started = time.perf_counter()
+    await asyncio.gather(*(session(base_uid + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await botmain.jobs.stop()
+    await botmain.fsm_storage.close()
+    await botmain.metrics_writer.close()
+    server.should_exit = True
+    await server_task
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "latency_ms": args.latency_ms,
+            "latency_sigma": args.latency_sigma,
+            "error_429": args.error_429,
+            "error_5xx": args.error_5xx,
+        },
+        "updates": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": summarize(latencies),
+        "db_ms_per_update": summarize(db_times),
+        "per_step_latency_ms": {name: summarize(values) for name, values in per_step.items()},
+        "telegram_api_calls": api_calls,
+        "upstream_calls": dict(fake_app.state.counters),
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Строки сравнения ключевых метрик с прошлым прогоном."""
+    lines = []
+
+    def _delta(name: str, cur: float, base: float, higher_is_better: bool) -> None:
+        if not base:
+            return
+        change = (cur - base) / base * 100
+        good = change >= 0 if higher_is_better else change <= 0
+        lines.append(f"{'✅' if good else '⚠️'} {name}: {base} → {cur} ({change:+.1f}%)")
+
+    _delta("updates/sec", current["updates_per_sec"], baseline["updates_per_sec"], True)
+    for q in ("p50", "p95", "p99"):
+        _delta(f"latency {q} ms", current["latency_ms"][q], baseline["latency_ms"][q], False)
+    _delta("db ms/update (mean)", current["db_ms_per_update"]["mean"], baseline["db_ms_per_update"]["mean"], False)
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ContentGPT end-to-end throughput benchmark")
+    parser.add_argument("--users", type=int, default=100, help="число синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременно активных сессий")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="медиана задержки fake YandexGPT")
+    parser.add_argument("--latency-sigma", type=float, default=0.35)
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-5xx", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake-port", type=int, default=0, help="порт fake_upstreams (0 — свободный)")
+    parser.add_argument("--out", default="bench_result.json")
+    parser.add_argument("--baseline", default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--telegram-limits", action="store_true", help="включить реальные лимиты исходящих сообщений")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    if not args.fake_port:
+        args.fake_port = _free_port()
+    _prepare_env(args.fake_port, args.telegram_limits)
+
+    result = asyncio.run(run_benchmark(args))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps({k: result[k] for k in ("updates", "errors", "updates_per_sec", "latency_ms", "db_ms_per_update")},
+                     ensure_ascii=False, indent=2))
+    print(f"📄 Результат сохранён в {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print("\n".join(compare(result, baseline)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+# broadcast.py - Рассылки по подписанным на уведомления пользователям
+#
+# Получатели читаются пачками по индексу (users.user_id > cursor ORDER BY user_id),
+# отправляются с ограничением темпа (поверх OutboundRateLimiter сессии бота),
+# результаты и курсор сохраняются в SQLite после каждой порции — после рестарта
+# рассылка продолжается с места остановки. Заблокировавшие бота пользователи
+# помечаются users.is_active = 0 и больше не попадают в выборку.
+# Каждую рассылку ведёт один процесс — под арендой broadcast:<id> (leader.py).
+
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from loguru import logger
+
+from leader import LeaseLost, LeaseManager
+from outbound_limiter import TokenBucket
+
+# Аудитория → (колонка user_settings, подпись)
+AUDIENCES: Dict[str, Tuple[str, str]] = {
+    "features": ("notif_features", "🆕 Новые функции"),
+    "promos": ("notif_promos", "🎁 Акции"),
+    "reminders": ("notif_reminders", "⏰ Напоминания"),
+}
+
+# Ошибки BadRequest, означающие, что писать пользователю больше некуда
+_GONE_MARKERS = ("chat not found", "user is deactivated", "bot was blocked", "peer_id_invalid")
+
+_STATUS_LABELS = {
+    "draft": "📝 черновик",
+    "running": "▶️ идёт",
+    "done": "✅ завершена",
+    "cancelled": "⏹ остановлена",
+    "failed": "❌ ошибка",
+}
+
+
+class BroadcastManager:
+    """Создание, запуск, возобновление и отмена рассылок."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        connect: Callable[[], Any],
+        rate: float = 20.0,
+        chunk_size: int = 500,
+        concurrency: int = 20,
+        progress_interval: float = 5.0,
+        flush_every: int = 50,
+        leases: Optional[LeaseManager] = None,
+        lease_ttl: float = 60.0,
+        on_blocked: Optional[Callable[[List[int]], None]] = None,
+    ):
+        self.bot = bot
+        # Вызывается (из потока) с user_id, помеченными is_active = 0
+        self.on_blocked = on_blocked
+        self.connect = connect
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.flush_every = flush_every
+        self.bucket = TokenBucket(rate, 1.0)
+        self.leases = leases
+        self.lease_ttl = lease_ttl
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._starting: Set[int] = set()
+        self._cancelled: Set[int] = set()
+
+    # ---------- БД (синхронно, вызывается через asyncio.to_thread) ----------
+
+    def count_audience(self, audience: str) -> int:
+        field = AUDIENCES[audience][0]
+        conn = self.connect()
+        try:
+            row = conn.execute(f"""
+                SELECT COUNT(*) FROM users u
+                JOIN user_settings s ON s.user_id = u.user_id
+                WHERE u.is_active = 1 AND s.{field} = 1
+            """).fetchone()
+            return int(row[0])
+        finally:
+            conn.close()
+
+    def create(self, audience: str, admin_chat_id: int, source_chat_id: int, source_message_id: int, preview: str = "") -> int:
+        """Создать черновик рассылки; сообщение копируется из чата админа."""
+        total = self.count_audience(audience)
+        conn = self.connect()
+        try:
+            cur = conn.execute("""
+                INSERT INTO broadcasts
+                    (audience, admin_chat_id, source_chat_id, source_message_id, preview, status, total)
+                VALUES (?, ?, ?, ?, ?, 'draft', ?)
+            """, (audience, admin_chat_id, source_chat_id, source_message_id, preview[:200], total))
+            conn.commit()
+            return int(cur.lastrowid)
+        finally:
+            conn.close()
+
+    def get(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        conn = self.connect()
+        try:
+            cur = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            return dict(zip([c[0] for c in cur.description], row))
+        finally:
+            conn.close()
+
+    def _set_status(
+        self,
+        broadcast_id: int,
+        status: str,
+        progress_message_id: Optional[int] = None,
+        only_from: Optional[str] = None,
+    ) -> None:
+        """only_from — менять, только если текущий статус такой (не затереть отмену из другого процесса)."""
+        conn = self.connect()
+        try:
+            conn.execute("""
+                UPDATE broadcasts
+                SET status = ?,
+                    progress_message_id = COALESCE(?, progress_message_id),
+                    started_at = CASE WHEN ? = 'running' THEN COALESCE(started_at, datetime('now')) ELSE started_at END,
+                    finished_at = CASE WHEN ? IN ('done', 'cancelled', 'failed') THEN datetime('now') ELSE finished_at END
+                WHERE id = ? AND (? IS NULL OR status = ?)
+            """, (status, progress_message_id, status, status, broadcast_id, only_from, only_from))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _status(self, broadcast_id: int) -> Optional[str]:
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def _claim_draft(self, broadcast_id: int, progress_message_id: Optional[int]) -> bool:
+        """draft → running; False — рассылку уже запустили (в т.ч. другой процесс)."""
+        conn = self.connect()
+        try:
+            cur = conn.execute("""
+                UPDATE broadcasts
+                SET status = 'running',
+                    progress_message_id = COALESCE(?, progress_message_id),
+                    started_at = COALESCE(started_at, datetime('now'))
+                WHERE id = ? AND status = 'draft'
+            """, (progress_message_id, broadcast_id))
+            conn.commit()
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def _running_ids(self) -> List[int]:
+        conn = self.connect()
+        try:
+            return [r[0] for r in conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+        finally:
+            conn.close()
+
+    def _next_chunk(self, field: str, cursor: int) -> List[int]:
+        conn = self.connect()
+        try:
+            rows = conn.execute(f"""
+                SELECT u.user_id FROM users u
+                JOIN user_settings s ON s.user_id = u.user_id
+                WHERE u.is_active = 1 AND u.user_id > ? AND s.{field} = 1
+                ORDER BY u.user_id
+                LIMIT ?
+            """, (cursor, self.chunk_size)).fetchall()
+            return [r[0] for r in rows]
+        finally:
+            conn.close()
+
+    def _save_results(self, broadcast_id: int, results: List[Tuple[int, str, str]], cursor: int, token: Optional[int] = None) -> None:
+        """Статусы получателей, счётчики и курсор — одной транзакцией (с проверкой аренды)."""
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        for _, status, _ in results:
+            counts[status] += 1
+        blocked = [(uid,) for uid, status, _ in results if status == "blocked"]
+
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            if token is not None:
+                try:
+                    LeaseManager.check(conn, f"broadcast:{broadcast_id}", token)
+                except LeaseLost:
+                    conn.execute("ROLLBACK")
+                    raise
+            conn.executemany("""
+                INSERT OR REPLACE INTO broadcast_recipients (broadcast_id, user_id, status, error)
+                VALUES (?, ?, ?, ?)
+            """, [(broadcast_id, uid, status, error) for uid, status, error in results])
+            if blocked:
+                conn.executemany(
+                    "UPDATE users SET is_active = 0, updated_at = datetime('now') WHERE user_id = ?",
+                    blocked,
+                )
+            conn.execute("""
+                UPDATE broadcasts
+                SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?, cursor_user_id = ?
+                WHERE id = ?
+            """, (counts["sent"], counts["failed"], counts["blocked"], cursor, broadcast_id))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if blocked and self.on_blocked is not None:
+            self.on_blocked([uid for uid, in blocked])
+
+    # ---------- Прогресс ----------
+
+    @staticmethod
+    def progress_text(row: Dict[str, Any], rate: Optional[float] = None) -> str:
+        done = row["sent"] + row["failed"] + row["blocked"]
+        total = max(row["total"], done)
+        percent = int(done * 100 / total) if total else 100
+        text = (
+            f"📣 Рассылка #{row['id']} — {AUDIENCES.get(row['audience'], ('', row['audience']))[1]}\n"
+            f"Статус: {_STATUS_LABELS.get(row['status'], row['status'])}\n\n"
+            f"Прогресс: {done}/{total} ({percent}%)\n"
+            f"✅ Доставлено: {row['sent']}\n"
+            f"🚫 Заблокировали бота: {row['blocked']}\n"
+            f"⚠️ Ошибок: {row['failed']}"
+        )
+        if rate and row["status"] == "running":
+            eta = int((total - done) / rate) if rate > 0 else 0
+            text += f"\n\n⚡ {rate:.1f} сообщ./сек, осталось ~{eta // 60} мин {eta % 60} сек"
+        return text
+
+    @staticmethod
+    def cancel_kb(broadcast_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bc:cancel:{broadcast_id}")],
+        ])
+
+    async def _report(self, broadcast_id: int, rate: Optional[float] = None) -> None:
+        row = await asyncio.to_thread(self.get, broadcast_id)
+        if not row or not row["progress_message_id"]:
+            return
+        try:
+            await self.bot.edit_message_text(
+                self.progress_text(row, rate),
+                chat_id=row["admin_chat_id"],
+                message_id=row["progress_message_id"],
+                reply_markup=self.cancel_kb(broadcast_id) if row["status"] == "running" else None,
+            )
+        except TelegramBadRequest:
+            pass  # message is not modified / сообщение удалено
+        except Exception as e:
+            logger.warning("⚠️ Не удалось обновить прогресс рассылки #{}: {}", broadcast_id, e)
+
+    # ---------- Отправка ----------
+
+    async def _deliver(self, sem: asyncio.Semaphore, row: Dict[str, Any], user_id: int) -> Tuple[int, str, str]:
+        async with sem:
+            now = time.monotonic()
+            delay = self.bucket.reserve(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=row["source_chat_id"],
+                    message_id=row["source_message_id"],
+                )
+                return user_id, "sent", ""
+            except TelegramForbiddenError as e:
+                return user_id, "blocked", str(e)[:200]
+            except TelegramBadRequest as e:
+                status = "blocked" if any(m in str(e).lower() for m in _GONE_MARKERS) else "failed"
+                return user_id, status, str(e)[:200]
+            except Exception as e:
+                return user_id, "failed", str(e)[:200]
+
+    async def _run(self, broadcast_id: int) -> None:
+        lease, token = f"broadcast:{broadcast_id}", None
+        if self.leases is not None:
+            token = await asyncio.to_thread(self.leases.acquire, lease, self.lease_ttl)
+            if token is None:
+                # Рассылку уже ведёт другой процесс
+                self._tasks.pop(broadcast_id, None)
+                return
+
+        row = await asyncio.to_thread(self.get, broadcast_id)
+        if not row:
+            self._tasks.pop(broadcast_id, None)
+            if token is not None:
+                await asyncio.to_thread(self.leases.release, lease, token)
+            return
+        field = AUDIENCES[row["audience"]][0]
+        cursor = int(row["cursor_user_id"] or 0)
+        sem = asyncio.Semaphore(self.concurrency)
+        started, delivered = time.monotonic(), 0
+        last_report = 0.0
+        logger.info("📣 Рассылка #{}: старт с user_id > {}", broadcast_id, cursor)
+
+        try:
+            while broadcast_id not in self._cancelled:
+                chunk = await asyncio.to_thread(self._next_chunk, field, cursor)
+                if not chunk:
+                    break
+                for i in range(0, len(chunk), self.flush_every):
+                    if broadcast_id in self._cancelled:
+                        break
+                    if token is not None and not await asyncio.to_thread(self.leases.renew, lease, token, self.lease_ttl):
+                        raise LeaseLost(lease)
+                    # Отмену могли нажать в другом процессе — там она только пишется в БД
+                    if await asyncio.to_thread(self._status, broadcast_id) == "cancelled":
+                        self._cancelled.add(broadcast_id)
+                        break
+                    part = chunk[i:i + self.flush_every]
+                    results = await asyncio.gather(*(self._deliver(sem, row, uid) for uid in part))
+                    cursor = part[-1]
+                    await asyncio.to_thread(self._save_results, broadcast_id, list(results), cursor, token)
+                    delivered += len(results)
+
+                    if time.monotonic() - last_report >= self.progress_interval:
+                        last_report = time.monotonic()
+                        await self._report(broadcast_id, delivered / max(last_report - started, 1e-6))
+
+            status = "cancelled" if broadcast_id in self._cancelled else "done"
+            await asyncio.to_thread(self._set_status, broadcast_id, status, None, "running")
+            logger.info("📣 Рассылка #{} {} ({} получателей за {:.0f}с)", broadcast_id, status, delivered, time.monotonic() - started)
+        except asyncio.CancelledError:
+            # Остановка процесса: статус остаётся running, продолжим после рестарта
+            logger.info("⏸ Рассылка #{} приостановлена на user_id {}", broadcast_id, cursor)
+            raise
+        except LeaseLost:
+            # Рассылку подхватил другой процесс — статус не трогаем
+            logger.warning("⚠️ Рассылка #{}: аренда потеряна, останавливаюсь", broadcast_id)
+            return
+        except Exception as e:
+            logger.exception("❌ Рассылка #{} прервана: {}", broadcast_id, e)
+            await asyncio.to_thread(self._set_status, broadcast_id, "failed", None, "running")
+        finally:
+            self._tasks.pop(broadcast_id, None)
+            self._cancelled.discard(broadcast_id)
+            if token is not None:
+                await asyncio.to_thread(self.leases.release, lease, token)
+
+        await self._report(broadcast_id)
+
+    # ---------- Управление ----------
+
+    def is_running(self, broadcast_id: int) -> bool:
+        return broadcast_id in self._tasks or broadcast_id in self._starting
+
+    async def start(self, broadcast_id: int, progress_message_id: Optional[int] = None) -> bool:
+        """Запустить черновик. False — рассылка уже идёт, отменена или не найдена."""
+        if self.is_running(broadcast_id):
+            return False
+        # Занять id до первого await: двойное нажатие «Запустить» не создаст вторую задачу
+        self._starting.add(broadcast_id)
+        try:
+            if not await asyncio.to_thread(self._claim_draft, broadcast_id, progress_message_id):
+                return False
+            self._tasks[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+            return True
+        finally:
+            self._starting.discard(broadcast_id)
+
+    async def resume(self) -> None:
+        """Продолжить рассылки, прерванные перезапуском."""
+        for broadcast_id in await asyncio.to_thread(self._running_ids):
+            if not self.is_running(broadcast_id):
+                logger.info("🔁 Возобновляю рассылку #{}", broadcast_id)
+                self._tasks[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Остановить рассылку (или отменить черновик)."""
+        if self.is_running(broadcast_id):
+            self._cancelled.add(broadcast_id)
+            return True
+        row = await asyncio.to_thread(self.get, broadcast_id)
+        if row and row["status"] in ("draft", "running"):
+            await asyncio.to_thread(self._set_status, broadcast_id, "cancelled")
+            return True
+        return False
+
+    async def stop(self) -> None:
+        """Остановить задачи при завершении процесса (курсор уже сохранён)."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
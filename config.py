@@ -1,5 +1,6 @@
 # config.py - КОНФИГУРАЦИЯ БОТ V3 С YANDEXGPT
 
+import hashlib
 import os
 from dotenv import load_dotenv
 from loguru import logger
@@ -24,6 +25,22 @@ class Settings:
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN")
     ADMIN_ID = int(os.getenv("ADMIN_ID", "123456789"))
     
+    # РЕЖИМ РАБОТЫ: auto (webhook, если известен внешний URL) / webhook / polling
+    BOT_MODE = os.getenv("BOT_MODE", "auto").lower()
+    # Render сам выставляет RENDER_EXTERNAL_URL для web-сервисов
+    WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL", "")
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook/telegram")
+    # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (по умолчанию — из токена бота)
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).hexdigest()[:64]
+    # Обработка апдейтов webhook: воркеры, размер очереди, окно дедупликации update_id (сек)
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+    UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "3600"))
+    # Процессов-воркеров (>1 — фронт-процесс раздаёт апдейты по user_id)
+    BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+    # Срок аренды задач-одиночек (сек): за это время лидерство перейдёт к живому процессу
+    LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+    
     # БД
     DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_database.db")
     
@@ -32,7 +49,25 @@ class Settings:
     YANDEX_KASSA_SECRET_KEY = os.getenv("YANDEX_KASSA_SECRET_KEY", "")
     PAYMENT_WEBHOOK_URL = os.getenv("PAYMENT_WEBHOOK_URL", "https://yourdomain.com/webhook/yandex")
     PAYMENT_RETURN_URL = os.getenv("PAYMENT_RETURN_URL", "https://t.me/YOUR_BOT_USERNAME")
-    YOOKASSA_API_BASE = os.getenv("YOOKASSA_API_BASE", "https://api.yookassa.ru/v3")
+    YOOKASSA_API_BASE = os.getenv("YOOKASSA_API_BASE", "https://api.yookassa.ru/v3").rstrip("/")
+    # Клиент API ЮKassa: таймаут запроса (сек), соединений в пуле, повторов при 429/5xx/сетевых ошибках
+    YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+    YOOKASSA_MAX_CONNECTIONS = int(os.getenv("YOOKASSA_MAX_CONNECTIONS", "20"))
+    YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "2"))
+    # Webhook ЮKassa: сети отправителя (пусто — официальные сети ЮKassa, off — без проверки IP),
+    # секрет в URL (?secret=...), число доверенных прокси перед ботом (IP клиента — из X-Forwarded-For)
+    YOOKASSA_WEBHOOK_IPS = os.getenv("YOOKASSA_WEBHOOK_IPS", "")
+    YOOKASSA_WEBHOOK_SECRET = os.getenv("YOOKASSA_WEBHOOK_SECRET", "")
+    TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+    # Сверка зависших платежей: период (сек), батч, параллельных запросов,
+    # первая задержка проверки (сек, дальше ×2 до 30 мин), срок до expired (сек)
+    PAYMENT_RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "30"))
+    PAYMENT_RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", "100"))
+    PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "5"))
+    PAYMENT_CHECK_BACKOFF = float(os.getenv("PAYMENT_CHECK_BACKOFF", "60"))
+    PAYMENT_EXPIRE_AFTER = float(os.getenv("PAYMENT_EXPIRE_AFTER", "86400"))
+    # Сколько секунд кнопка «✅ Я оплатил» использует уже полученный статус платежа
+    PAYMENT_STATUS_TTL = float(os.getenv("PAYMENT_STATUS_TTL", "5"))
     # TELEGRAM STARS
     PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
     
@@ -44,6 +79,58 @@ class Settings:
     # YANDEX GPT ⭐ НОВОЕ
     YANDEX_GPT_API_KEY = os.getenv("YANDEX_GPT_API_KEY", "")
     YANDEX_GPT_FOLDER_ID = os.getenv("YANDEX_GPT_FOLDER_ID", "")
+    YANDEX_GPT_API_URL = os.getenv(
+        "YANDEX_GPT_API_URL",
+        "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
+    )
+    # Пул ключей: "key1:folder1,key2:folder2" (если пусто — берётся пара выше)
+    YANDEX_GPT_CREDENTIALS = os.getenv("YANDEX_GPT_CREDENTIALS", "")
+    YANDEX_GPT_RPS_PER_KEY = float(os.getenv("YANDEX_GPT_RPS_PER_KEY", "10"))
+    YANDEX_GPT_EJECT_SECONDS = float(os.getenv("YANDEX_GPT_EJECT_SECONDS", "300"))
+    # Маршрутизация yandexgpt / yandexgpt-lite (JSON-переопределения политики)
+    MODEL_ROUTING = os.getenv("MODEL_ROUTING", "")
+    YANDEX_GPT_LITE_TIMEOUT = float(os.getenv("YANDEX_GPT_LITE_TIMEOUT", "15"))
+    
+    # Предгенерация «🔄 Ещё вариант» для платных тарифов
+    SPECULATIVE_REGEN = os.getenv("SPECULATIVE_REGEN", "0") == "1"
+    SPECULATIVE_TIERS = [t.strip() for t in os.getenv("SPECULATIVE_TIERS", "basic,premium,vip").split(",") if t.strip()]
+    SPECULATIVE_TTL = int(os.getenv("SPECULATIVE_TTL", "600"))
+    SPECULATIVE_MAX_USERS = int(os.getenv("SPECULATIVE_MAX_USERS", "500"))
+    
+    # Сколько апдейтов одного пользователя может ждать, пока обрабатывается предыдущий
+    USER_QUEUE_SIZE = int(os.getenv("USER_QUEUE_SIZE", "3"))
+    
+    # FSM-хранилище: размер LRU-кэша и период сброса изменений в SQLite (сек)
+    FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+    FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+    
+    # Очередь генераций: воркеров, время аренды задачи (сек), попыток
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+    JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "180"))
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    
+    # Кэш последних генераций для кнопок (записей, TTL в секундах)
+    GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "2000"))
+    GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", "3600"))
+    # Кэш действующей подписки (записей; сек — как быстро видна активация из другого процесса)
+    ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+    ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "30"))
+    # Истечение подписок: период проверки (сек), пачка; напоминание за N дней (0 — выключено)
+    SUBSCRIPTION_EXPIRY_INTERVAL = float(os.getenv("SUBSCRIPTION_EXPIRY_INTERVAL", "60"))
+    SUBSCRIPTION_EXPIRY_BATCH = int(os.getenv("SUBSCRIPTION_EXPIRY_BATCH", "500"))
+    RENEWAL_REMINDER_DAYS = float(os.getenv("RENEWAL_REMINDER_DAYS", "3"))
+    
+    # Лимиты исходящих сообщений Telegram
+    TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+    TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+    TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+    
+    # Рассылки: темп (сообщений/сек, меньше TG_GLOBAL_RATE — запас для диалогов),
+    # размер пачки получателей, параллельность отправки, интервал обновления прогресса (сек)
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+    BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+    BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
     
     # РАЗНОЕ
     REQUEST_TIMEOUT = 30
@@ -130,7 +217,9 @@ def validate_config():
     # Основное
     logger.info("🤖 ОСНОВНОЕ:")
     logger.info(f"• Telegram Bot ID: {settings.ADMIN_ID}")
-    if settings.YANDEX_GPT_API_KEY and settings.YANDEX_GPT_FOLDER_ID:
+    if settings.YANDEX_GPT_CREDENTIALS:
+        logger.info("• YandexGPT API: ✅ Подключен (пул ключей)")
+    elif settings.YANDEX_GPT_API_KEY and settings.YANDEX_GPT_FOLDER_ID:
         logger.info("• YandexGPT API: ✅ Подключен")
         logger.info(f"  - Folder ID: {settings.YANDEX_GPT_FOLDER_ID[:20]}...")
     else:
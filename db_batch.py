@@ -0,0 +1,116 @@
+# db_batch.py - Пакетная запись в SQLite (write-behind) для некритичных данных
+#
+# Хендлеры кладут INSERT/UPSERT в буфер без обращения к диску, а фоновая
+# задача раз в flush_interval (или при заполнении буфера) пишет всё одной
+# транзакцией через executemany в отдельном потоке. Неудачная пачка (например,
+# database is locked) возвращается в начало буфера и повторяется с backoff;
+# теряется — с критической ошибкой в логе — только после max_attempts попыток подряд.
+
+import asyncio
+import sqlite3
+import time
+from itertools import groupby
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+
+class BatchWriter:
+    """Буферизованный писатель: add() — O(1), запись — пачками в фоне."""
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        max_batch: int = 200,
+        flush_interval: float = 1.0,
+        max_attempts: int = 5,
+        retry_backoff: float = 1.0,
+    ):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        # Неудачных записей подряд и когда (monotonic) можно повторить
+        self._failures = 0
+        self._retry_at = 0.0
+        self._buffer: List[Tuple[str, Sequence[Any]]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Пачки пишутся строго по очереди — порядок записей сохраняется
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        """Сколько запросов ждёт записи."""
+        return len(self._buffer)
+
+    def add(self, sql: str, params: Sequence[Any]) -> None:
+        """Поставить запрос в очередь на запись."""
+        self._buffer.append((sql, params))
+        if self._wakeup is not None and len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        """Запустить фоновый сброс буфера (в текущем event loop)."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Остановить фоновую задачу и дописать остаток буфера."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(force=True)
+
+    async def flush(self, force: bool = False) -> None:
+        """Записать всё накопленное; после ошибки — не раньше конца backoff (force — сразу)."""
+        async with self._lock:
+            if not self._buffer or (not force and time.monotonic() < self._retry_at):
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except sqlite3.Error as e:
+                self._failures += 1
+                if self._failures >= self.max_attempts:
+                    logger.critical(
+                        "🚨 Пакетная запись не удалась {} раз подряд — {} строк потеряно: {}",
+                        self._failures, len(batch), e,
+                    )
+                    self._failures, self._retry_at = 0, 0.0
+                    return
+                # Обратно в начало буфера: порядок записей сохраняется
+                self._buffer[:0] = batch
+                delay = self.retry_backoff * 2 ** (self._failures - 1)
+                self._retry_at = time.monotonic() + delay
+                logger.warning(
+                    "⚠️ Ошибка пакетной записи ({} строк), попытка {}/{}, повтор через {:.1f}с: {}",
+                    len(batch), self._failures, self.max_attempts, delay, e,
+                )
+                return
+            self._failures, self._retry_at = 0, 0.0
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _write(self, batch: List[Tuple[str, Sequence[Any]]]) -> None:
+        """Одна транзакция; подряд идущие одинаковые запросы — через executemany."""
+        conn = self.connect()
+        try:
+            with conn:
+                for sql, group in groupby(batch, key=lambda item: item[0]):
+                    conn.executemany(sql, [params for _, params in group])
+        finally:
+            conn.close()
@@ -0,0 +1,165 @@
+# delivery.py - Доставка длинных генераций с учётом лимита длины сообщения Telegram
+#
+# Telegram меряет длину текста в UTF-16 code units (эмодзи = 2), лимит — 4096.
+# Текст режется по абзацам, затем по предложениям, затем по словам; части
+# отправляются по порядку (темп задаёт OutboundRateLimiter в сессии бота),
+# клавиатура — только у последней. Ошибка отправки
+# не теряет уже оплаченную генерацию: повтор, затем недоставленный остаток файлом.
+# Delivery.sent — сколько частей уже в чате: повтор задачи продолжает с них
+# (разбиение детерминировано). Бот заблокирован — повторять бесполезно (unreachable).
+
+import asyncio
+import re
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, Message
+from loguru import logger
+
+from config import settings
+
+TELEGRAM_LIMIT = getattr(settings, "MAX_MESSAGE_LENGTH", 4096)
+
+# Разделитель захватывается: переносы строк внутри абзаца не теряются
+_SENTENCE_RE = re.compile(r"((?<=[.!?…])\s+)")
+
+
+def utf16_len(text: str) -> int:
+    """Длина в единицах UTF-16, как её считает Telegram."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _hard_cut(text: str, limit: int) -> List[str]:
+    """Разрезать по словам (или посимвольно) кусок без удобных границ."""
+    parts, current = [], ""
+    for word in re.split(r"(\s+)", text):
+        if utf16_len(current + word) <= limit:
+            current += word
+            continue
+        if current.strip():
+            parts.append(current.rstrip())
+        current = word.lstrip()
+        while utf16_len(current) > limit:
+            cut = limit
+            while utf16_len(current[:cut]) > limit:
+                cut -= 1
+            parts.append(current[:cut])
+            current = current[cut:]
+    if current.strip():
+        parts.append(current.rstrip())
+    return parts
+
+
+def _pack(pieces: List[str], sep: str, limit: int) -> List[str]:
+    """Склеить куски обратно, пока влезает в лимит."""
+    chunks, current = [], ""
+    for piece in pieces:
+        candidate = current + sep + piece if current else piece
+        if utf16_len(candidate) <= limit:
+            current = candidate
+        else:
+            if current:
+                chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_message(text: str, limit: int = TELEGRAM_LIMIT) -> List[str]:
+    """Разбить текст на части ≤ limit (UTF-16) по абзацам/предложениям/словам."""
+    if utf16_len(text) <= limit:
+        return [text]
+
+    pieces: List[str] = []
+    for paragraph in text.split("\n\n"):
+        if utf16_len(paragraph) <= limit:
+            pieces.append(paragraph)
+            continue
+        parts = _SENTENCE_RE.split(paragraph)
+        sentences: List[str] = []
+        # parts = [предложение, разделитель, предложение, ...]
+        for sentence, sep in zip(parts[::2], parts[1::2] + [""]):
+            if utf16_len(sentence + sep) <= limit:
+                sentences.append(sentence + sep)
+            elif utf16_len(sentence) <= limit:
+                sentences.append(sentence)
+            else:
+                sentences.extend(_hard_cut(sentence, limit))
+        pieces.extend(chunk.rstrip() for chunk in _pack(sentences, "", limit))
+
+    return [c for c in _pack(pieces, "\n\n", limit) if c.strip()]
+
+
+async def _send_chunk(bot: Bot, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup], attempts: int = 3) -> Optional[Message]:
+    """Отправить одну часть с повтором на RetryAfter/сетевых ошибках."""
+    for attempt in range(attempts):
+        try:
+            return await bot.send_message(chat_id, text, reply_markup=reply_markup)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except (TelegramBadRequest, TelegramForbiddenError):
+            raise
+        except Exception as e:
+            logger.warning("⚠️ Ошибка отправки части сообщения (попытка {}): {}", attempt + 1, e)
+            await asyncio.sleep(0.5 * (attempt + 1))
+    return None
+
+
+class Delivery:
+    """Итог send_long_text: done — доставлено всё; sent — частей в чате; unreachable — бот заблокирован."""
+
+    __slots__ = ("done", "sent", "unreachable")
+
+    def __init__(self, done: bool, sent: int, unreachable: bool = False):
+        self.done = done
+        self.sent = sent
+        self.unreachable = unreachable
+
+
+async def send_long_text(
+    bot: Bot,
+    chat_id: int,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    limit: int = TELEGRAM_LIMIT,
+    start: int = 0,
+) -> Delivery:
+    """
+    Доставить текст любой длины (сообщениями или, в крайнем случае, файлом).
+    start — сколько частей уже доставлено прошлой попыткой (Delivery.sent).
+    """
+    chunks = split_message(text, limit)
+    delivered = min(start, len(chunks))
+
+    try:
+        for i in range(delivered, len(chunks)):
+            is_last = i == len(chunks) - 1
+            sent = await _send_chunk(bot, chat_id, chunks[i], reply_markup if is_last else None)
+            if sent is None:
+                raise RuntimeError("message not delivered")
+            delivered += 1
+        return Delivery(True, delivered)
+    except TelegramForbiddenError as e:
+        logger.warning("🚫 Чат {} недоступен (бот заблокирован): {}", chat_id, e)
+        return Delivery(False, delivered, unreachable=True)
+    except Exception as e:
+        logger.error("❌ Не удалось доставить генерацию в чат {} ({} из {} частей): {}", chat_id, delivered, len(chunks), e)
+
+    # Запасной вариант: недоставленный остаток файлом (уже отправленное не дублируется)
+    rest = "\n\n".join(chunks[delivered:])
+    try:
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(rest.encode("utf-8"), filename="contentgpt_result.txt"),
+            caption="📄 Окончание генерации" if delivered else "📄 Результат генерации",
+            reply_markup=reply_markup,
+        )
+        return Delivery(True, len(chunks))
+    except TelegramForbiddenError as e:
+        logger.warning("🚫 Чат {} недоступен (бот заблокирован): {}", chat_id, e)
+        return Delivery(False, delivered, unreachable=True)
+    except Exception as e:
+        logger.error("❌ Не удалось отправить генерацию файлом в чат {}: {}", chat_id, e)
+        return Delivery(False, delivered)
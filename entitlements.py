@@ -0,0 +1,161 @@
+# entitlements.py - Журнал подписок (entitlements): идемпотентная активация
+#
+# Каждая оплата — строка журнала с UNIQUE(provider, external_id): повторное
+# подтверждение того же платежа (webhook, кнопка, повтор апдейта) ничего не меняет.
+# Покупка того же тарифа продлевает срок с конца текущего периода, другого —
+# действует с момента оплаты. Действующая подписка — старший тариф среди
+# неистёкших строк: один запрос по индексу (user_id, ends_at), результат
+# кэшируется на пользователя до истечения периода (и не дольше ttl — активации
+# из других процессов). users.subscription_type/until — её копия для
+# отображения и статистики.
+#
+# Таблица entitlements создаётся в init_database() (main.py).
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+FREE = "free"
+
+
+class Entitlement:
+    """Действующая подписка; until — ISO-время окончания (None для free)."""
+
+    __slots__ = ("subscription_type", "until")
+
+    def __init__(self, subscription_type: str = FREE, until: Optional[str] = None):
+        self.subscription_type = subscription_type
+        self.until = until
+
+
+def _now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class EntitlementLedger:
+    """Журнал оплаченных периодов + LRU-кэш действующей подписки."""
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        ranks: Dict[str, int],
+        max_size: int = 10_000,
+        ttl: float = 30.0,
+    ):
+        self.connect = connect
+        self.ranks = ranks
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id → (годен до, unix time; подписка)
+        self._cache: "OrderedDict[int, Tuple[float, Entitlement]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # ---------- запись ----------
+
+    def grant(
+        self,
+        conn: sqlite3.Connection,
+        user_id: int,
+        provider: str,
+        external_id: str,
+        subscription_type: str,
+        days: int,
+    ) -> bool:
+        """
+        Добавить оплаченный период внутри транзакции вызывающего (BEGIN IMMEDIATE).
+        False — этот платёж уже учтён. После COMMIT вызвать invalidate(user_id).
+        """
+        now = datetime.now()
+        row = conn.execute("""
+            SELECT MAX(ends_at) FROM entitlements
+            WHERE user_id = ? AND subscription_type = ? AND ends_at > ?
+        """, (user_id, subscription_type, now.isoformat(timespec="seconds"))).fetchone()
+        starts = max(now, datetime.fromisoformat(row[0])) if row and row[0] else now
+        ends = starts + timedelta(days=days)
+
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO entitlements
+                (user_id, provider, external_id, subscription_type, tier_rank, starts_at, ends_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (
+            user_id, provider, external_id, subscription_type, self.ranks.get(subscription_type, 0),
+            starts.isoformat(timespec="seconds"), ends.isoformat(timespec="seconds"),
+        ))
+        if cur.rowcount == 0:
+            return False
+        self.sync_user(conn, user_id)
+        return True
+
+    def activate(self, user_id: int, provider: str, external_id: str, subscription_type: str, days: int) -> bool:
+        """grant() в собственной транзакции."""
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                granted = self.grant(conn, user_id, provider, external_id, subscription_type, days)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        self.invalidate(user_id)
+        return granted
+
+    def sync_user(self, conn: sqlite3.Connection, user_id: int) -> Entitlement:
+        """Записать действующую подписку в users (копия для отображения и статистики)."""
+        current = self._query(conn, user_id)
+        conn.execute("""
+            UPDATE users SET subscription_type = ?, subscription_until = ?, updated_at = datetime('now')
+            WHERE user_id = ?
+        """, (current.subscription_type, current.until, user_id))
+        return current
+
+    # ---------- чтение ----------
+
+    @staticmethod
+    def _query(conn: sqlite3.Connection, user_id: int) -> Entitlement:
+        row = conn.execute("""
+            SELECT subscription_type, ends_at FROM entitlements
+            WHERE user_id = ? AND ends_at > ?
+            ORDER BY tier_rank DESC, ends_at DESC
+            LIMIT 1
+        """, (user_id, _now_iso())).fetchone()
+        return Entitlement(row[0], row[1]) if row else Entitlement()
+
+    def effective(self, user_id: int) -> Entitlement:
+        """Действующая подписка (из кэша; промах — один запрос по индексу)."""
+        return self.lookup(user_id)[0]
+
+    def lookup(self, user_id: int) -> Tuple[Entitlement, bool]:
+        """effective() + fresh: True — только что прочитана из БД, а не взята из кэша."""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached and cached[0] > now:
+                self._cache.move_to_end(user_id)
+                return cached[1], False
+
+        conn = self.connect()
+        try:
+            current = self._query(conn, user_id)
+        finally:
+            conn.close()
+
+        valid_until = now + self.ttl
+        if current.until:
+            valid_until = min(valid_until, datetime.fromisoformat(current.until).timestamp())
+        with self._lock:
+            self._cache[user_id] = (valid_until, current)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return current, True
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._cache.pop(user_id, None)
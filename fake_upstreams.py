@@ -0,0 +1,216 @@
+# fake_upstreams.py - Локальная замена YandexGPT и ЮKassa для нагрузочных тестов без сети
+#
+# Эмулирует:
+#   POST /foundationModels/v1/completion  — YandexGPT (задержка, 429/5xx, stream)
+#   POST /v3/payments                     — создание платежа ЮKassa
+#   GET  /v3/payments/{payment_id}        — статус платежа
+#
+# Запуск:
+#   python fake_upstreams.py --port 8099 --latency-ms 800 --error-429 0.02 --error-5xx 0.01
+#
+# И в .env бота:
+#   YANDEX_GPT_API_URL=http://127.0.0.1:8099/foundationModels/v1/completion
+#   YANDEX_GPT_API_KEY=fake
+#   YANDEX_GPT_FOLDER_ID=fake
+#   YOOKASSA_API_BASE=http://127.0.0.1:8099/v3
+#   YANDEX_KASSA_SHOP_ID=fake
+#   YANDEX_KASSA_SECRET_KEY=fake
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LOREM = (
+    "Контент 🚀 который цепляет с первой строки. Мы расскажем, как сделать пост живым, "
+    "понятным и полезным для вашей аудитории. Структура, эмодзи и мягкий призыв к действию "
+    "помогают читателю дойти до конца и оставить комментарий."
+).split()
+
+
+class FakeUpstreamConfig:
+    """Параметры эмуляции."""
+
+    def __init__(
+        self,
+        latency_ms: float = 800.0,
+        latency_sigma: float = 0.35,
+        error_429: float = 0.0,
+        error_5xx: float = 0.0,
+        output_tokens: int = 250,
+        stream_chunks: int = 8,
+        payment_latency_ms: float = 150.0,
+        payment_succeed_after: float = 5.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.output_tokens = output_tokens
+        self.stream_chunks = stream_chunks
+        self.payment_latency_ms = payment_latency_ms
+        self.payment_succeed_after = payment_succeed_after
+        self.random = random.Random(seed)
+
+    def sample_latency(self, base_ms: float) -> float:
+        """Логнормальная задержка (медиана = base_ms), в секундах."""
+        if base_ms <= 0:
+            return 0.0
+        if self.latency_sigma <= 0:
+            return base_ms / 1000
+        return self.random.lognormvariate(0, self.latency_sigma) * base_ms / 1000
+
+
+def create_app(config: Optional[FakeUpstreamConfig] = None) -> FastAPI:
+    """FastAPI-приложение с эмуляцией обоих upstream-сервисов."""
+    cfg = config or FakeUpstreamConfig()
+    app = FastAPI(title="Fake upstreams")
+    app.state.config = cfg
+    app.state.counters = {"completion": 0, "429": 0, "5xx": 0, "payments_created": 0, "payments_checked": 0}
+
+    payments: Dict[str, Dict[str, Any]] = {}
+    idempotence: Dict[str, str] = {}
+
+    def _make_text(max_tokens: int) -> str:
+        n = max(1, min(cfg.output_tokens, max_tokens))
+        return " ".join(cfg.random.choice(LOREM) for _ in range(n))
+
+    def _completion_body(text: str, model_uri: str, prompt_tokens: int, partial: bool = False) -> Dict[str, Any]:
+        return {
+            "result": {
+                "alternatives": [{
+                    "message": {"role": "assistant", "text": text},
+                    "status": "ALTERNATIVE_STATUS_PARTIAL" if partial else "ALTERNATIVE_STATUS_FINAL",
+                }],
+                "usage": {
+                    "inputTextTokens": str(prompt_tokens),
+                    "completionTokens": str(len(text.split())),
+                    "totalTokens": str(prompt_tokens + len(text.split())),
+                },
+                "modelVersion": model_uri.rsplit("/", 1)[-1] or "latest",
+            }
+        }
+
+    @app.post("/foundationModels/v1/completion")
+    async def completion(request: Request):
+        app.state.counters["completion"] += 1
+        payload = await request.json()
+        options = payload.get("completionOptions") or {}
+        messages = payload.get("messages") or []
+        model_uri = payload.get("modelUri", "")
+        prompt_tokens = sum(len(str(m.get("text", "")).split()) for m in messages)
+
+        roll = cfg.random.random()
+        if roll < cfg.error_429:
+            app.state.counters["429"] += 1
+            return JSONResponse({"error": {"message": "ResourceExhausted"}}, status_code=429, headers={"Retry-After": "1"})
+        if roll < cfg.error_429 + cfg.error_5xx:
+            app.state.counters["5xx"] += 1
+            await asyncio.sleep(cfg.sample_latency(cfg.latency_ms) / 4)
+            return JSONResponse({"error": {"message": "Internal"}}, status_code=503)
+
+        # lite-модель отвечает примерно вдвое быстрее
+        base_ms = cfg.latency_ms / 2 if "-lite" in model_uri else cfg.latency_ms
+        latency = cfg.sample_latency(base_ms)
+        text = _make_text(int(options.get("maxTokens") or 1500))
+
+        if not options.get("stream"):
+            await asyncio.sleep(latency)
+            return _completion_body(text, model_uri, prompt_tokens)
+
+        words = text.split()
+        chunks = max(1, cfg.stream_chunks)
+
+        async def _stream():
+            for i in range(1, chunks + 1):
+                await asyncio.sleep(latency / chunks)
+                part = " ".join(words[: len(words) * i // chunks])
+                yield json.dumps(_completion_body(part, model_uri, prompt_tokens, partial=i < chunks), ensure_ascii=False) + "\n"
+
+        return StreamingResponse(_stream(), media_type="application/json")
+
+    @app.post("/v3/payments")
+    async def create_payment(request: Request):
+        await asyncio.sleep(cfg.sample_latency(cfg.payment_latency_ms))
+        key = request.headers.get("Idempotence-Key", "")
+        if key and key in idempotence:
+            return payments[idempotence[key]]["body"]
+
+        payload = await request.json()
+        payment_id = str(uuid.uuid4())
+        body = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": payload.get("amount") or {"value": "0.00", "currency": "RUB"},
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}",
+            },
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "description": payload.get("description", ""),
+            "metadata": payload.get("metadata") or {},
+            "test": True,
+        }
+        payments[payment_id] = {"body": body, "created": time.monotonic()}
+        if key:
+            idempotence[key] = payment_id
+        app.state.counters["payments_created"] += 1
+        return body
+
+    @app.get("/v3/payments/{payment_id}")
+    async def get_payment(payment_id: str):
+        await asyncio.sleep(cfg.sample_latency(cfg.payment_latency_ms))
+        app.state.counters["payments_checked"] += 1
+        item = payments.get(payment_id)
+        if not item:
+            return JSONResponse({"type": "error", "code": "not_found"}, status_code=404)
+        body = item["body"]
+        if body["status"] == "pending" and time.monotonic() - item["created"] >= cfg.payment_succeed_after:
+            body["status"] = "succeeded"
+            body["paid"] = True
+        return body
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.counters
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake YandexGPT + YooKassa server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="медиана задержки completion")
+    parser.add_argument("--latency-sigma", type=float, default=0.35, help="разброс (sigma логнормального)")
+    parser.add_argument("--error-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--output-tokens", type=int, default=250)
+    parser.add_argument("--payment-succeed-after", type=float, default=5.0, help="через сколько секунд платёж succeeded")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_429=args.error_429,
+        error_5xx=args.error_5xx,
+        output_tokens=args.output_tokens,
+        payment_succeed_after=args.payment_succeed_after,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# fsm_storage.py - FSM-хранилище aiogram в SQLite с write-through LRU-кэшем
+#
+# Чтение — из памяти (промах кэша — один SELECT в потоке), запись — сразу в кэш
+# и в буфер BatchWriter, который сбрасывает изменения пачкой в фоне. Шаг FSM
+# не ждёт диска, а состояние переживает рестарт и доступно другим процессам.
+#
+# Таблица fsm_storage создаётся в init_database() (main.py).
+
+import asyncio
+import json
+import sqlite3
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from db_batch import BatchWriter
+
+_UPSERT_SQL = """
+    INSERT INTO fsm_storage (key, state, data, updated_at)
+    VALUES (?, ?, ?, datetime('now'))
+    ON CONFLICT(key) DO UPDATE SET
+        state = excluded.state,
+        data = excluded.data,
+        updated_at = excluded.updated_at
+"""
+_DELETE_SQL = "DELETE FROM fsm_storage WHERE key = ?"
+
+
+class SQLiteStorage(BaseStorage):
+    """BaseStorage: LRU в памяти + пакетная запись в SQLite."""
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        max_size: int = 10_000,
+        flush_interval: float = 0.5,
+        key_builder: Optional[KeyBuilder] = None,
+    ):
+        self.connect = connect
+        self.max_size = max_size
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.writer = BatchWriter(connect, flush_interval=flush_interval)
+        # key → (state, data)
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any]]]" = OrderedDict()
+
+    async def start(self) -> None:
+        await self.writer.start()
+
+    async def close(self) -> None:
+        await self.writer.close()
+
+    # ---------- кэш ----------
+
+    def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT state, data FROM fsm_storage WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    async def _get(self, key: StorageKey) -> Tuple[str, Tuple[Optional[str], Dict[str, Any]]]:
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is not None:
+            self._cache.move_to_end(k)
+            return k, entry
+
+        # Промах: сначала дописываем буфер, чтобы не прочитать устаревшую строку
+        if self.writer.pending:
+            await self.writer.flush()
+        entry = await asyncio.to_thread(self._load, k)
+        # Пока шёл SELECT, ключ могли записать (set_state/set_data) — кэш свежее строки
+        cached = self._cache.get(k)
+        if cached is not None:
+            self._cache.move_to_end(k)
+            return k, cached
+        return k, self._remember(k, entry)
+
+    def _remember(self, k: str, entry: Tuple[Optional[str], Dict[str, Any]]) -> Tuple[Optional[str], Dict[str, Any]]:
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return entry
+
+    def _put(self, k: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        self._remember(k, (state, data))
+        if state is None and not data:
+            self.writer.add(_DELETE_SQL, (k,))
+        else:
+            self.writer.add(_UPSERT_SQL, (k, state, json.dumps(data, ensure_ascii=False, default=str)))
+
+    # ---------- BaseStorage ----------
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, (_, data) = await self._get(key)
+        self._put(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, (state, _) = await self._get(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise ValueError(f"Data must be a dict, got {type(data).__name__}")
+        k, (state, _) = await self._get(key)
+        self._put(k, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, (_, data) = await self._get(key)
+        return data.copy()
@@ -0,0 +1,98 @@
+# generation_cache.py - Последние генерации для кнопок «Сохранить / Правки / Ещё вариант»
+#
+# Ограниченный LRU с TTL поверх generation_history: кнопка несёт id генерации
+# (content:save:<id>), запись берётся из памяти, а при промахе (рестарт,
+# вытеснение, старое сообщение) — одним SELECT по первичному ключу.
+
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from loguru import logger
+
+
+class GenerationRecord:
+    """Компактная запись генерации."""
+
+    __slots__ = ("id", "user_id", "content_type", "prompt", "content", "created")
+
+    def __init__(self, id: int, user_id: int, content_type: str, prompt: str, content: str):
+        self.id = id
+        self.user_id = user_id
+        self.content_type = content_type
+        self.prompt = prompt
+        self.content = content
+        self.created = time.monotonic()
+
+
+_SELECT = "SELECT id, user_id, content_type, prompt, content FROM generation_history"
+
+
+class GenerationCache:
+    """id генерации → запись; плюс id последней генерации каждого пользователя."""
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], max_size: int = 2000, ttl: float = 3600.0):
+        self.connect = connect
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records: "OrderedDict[int, GenerationRecord]" = OrderedDict()
+        self._latest: "OrderedDict[int, int]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def put(self, record: GenerationRecord) -> None:
+        self._records[record.id] = record
+        self._records.move_to_end(record.id)
+        if record.id >= self._latest.get(record.user_id, 0):
+            self._latest[record.user_id] = record.id
+            self._latest.move_to_end(record.user_id)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+        while len(self._latest) > self.max_size:
+            self._latest.popitem(last=False)
+
+    def _cached(self, generation_id: int) -> Optional[GenerationRecord]:
+        record = self._records.get(generation_id)
+        if record is None:
+            return None
+        if time.monotonic() - record.created > self.ttl:
+            del self._records[generation_id]
+            return None
+        self._records.move_to_end(generation_id)
+        return record
+
+    def _fetch(self, where: str, params: tuple) -> Optional[GenerationRecord]:
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute(f"{_SELECT} WHERE {where}", params).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.OperationalError as e:
+            logger.error(f"❌ Ошибка загрузки генерации: {e}")
+            return None
+        if not row:
+            return None
+        record = GenerationRecord(*row)
+        self.put(record)
+        return record
+
+    def get(self, generation_id: int, user_id: int) -> Optional[GenerationRecord]:
+        """Генерация по id (только своя)."""
+        record = self._cached(generation_id)
+        if record is None:
+            record = self._fetch("id = ? AND user_id = ?", (generation_id, user_id))
+        if record is None or record.user_id != user_id:
+            return None
+        return record
+
+    def latest(self, user_id: int) -> Optional[GenerationRecord]:
+        """Последняя генерация пользователя (для кнопок без id)."""
+        generation_id = self._latest.get(user_id)
+        if generation_id is not None:
+            record = self._cached(generation_id)
+            if record is not None:
+                return record
+        return self._fetch("user_id = ? ORDER BY id DESC LIMIT 1", (user_id,))
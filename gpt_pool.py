@@ -0,0 +1,171 @@
+# gpt_pool.py - Пул ключей/каталогов YandexGPT с балансировкой по задержке и квоте
+#
+# Каждый участник пула — пара (API-ключ, folder_id) со своей квотой запросов
+# в секунду. Запрос уходит участнику с наименьшей ожидаемой задержкой среди тех,
+# у кого осталась квота. Ответы 401/403/429 временно выводят участника из пула.
+
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+# Коды ответов, после которых участник временно исключается из пула
+EJECT_STATUS_CODES = (401, 403, 429)
+
+
+class GPTCredential:
+    """Участник пула: ключ + каталог и его текущая статистика."""
+
+    __slots__ = (
+        "api_key", "folder_id", "rps", "tokens", "last_refill",
+        "ewma_latency", "in_flight", "ejected_until", "failures",
+    )
+
+    def __init__(self, api_key: str, folder_id: str, rps: float):
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.rps = max(float(rps), 0.1)
+        self.tokens = self.rps
+        self.last_refill = time.monotonic()
+        self.ewma_latency = 1.0
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.failures = 0
+
+    @property
+    def label(self) -> str:
+        """Безопасное имя для логов (без ключа)."""
+        return f"{self.folder_id[:8]}…"
+
+    def refill(self, now: float) -> None:
+        """Пополнить токен-бакет квоты."""
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.rps, self.tokens + elapsed * self.rps)
+            self.last_refill = now
+
+    def score(self) -> float:
+        """Ожидаемая задержка с учётом уже отправленных запросов."""
+        return self.ewma_latency * (1 + self.in_flight)
+
+
+class GPTCredentialPool:
+    """Потокобезопасный пул учётных данных YandexGPT."""
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(
+        self,
+        credentials: Iterable[Tuple[str, str]],
+        rps_per_key: float = 10.0,
+        eject_seconds: float = 300.0,
+        throttle_seconds: float = 10.0,
+    ):
+        self.members: List[GPTCredential] = [
+            GPTCredential(key, folder, rps_per_key) for key, folder in credentials if key and folder
+        ]
+        self.eject_seconds = eject_seconds
+        self.throttle_seconds = throttle_seconds
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def acquire(self, exclude: Iterable[GPTCredential] = ()) -> Optional[GPTCredential]:
+        """Выбрать участника для запроса (или None, если пул пуст/весь исключён)."""
+        excluded = set(id(m) for m in exclude)
+        now = time.monotonic()
+
+        with self._lock:
+            healthy = [
+                m for m in self.members
+                if id(m) not in excluded and m.ejected_until <= now
+            ]
+            if not healthy:
+                return None
+
+            for m in healthy:
+                m.refill(now)
+
+            with_quota = [m for m in healthy if m.tokens >= 1]
+            if with_quota:
+                member = min(with_quota, key=GPTCredential.score)
+            else:
+                # Квота исчерпана у всех — берём того, кто быстрее её восстановит
+                member = max(healthy, key=lambda m: (m.tokens, -m.score()))
+
+            member.tokens -= 1
+            member.in_flight += 1
+            return member
+
+    def release(
+        self,
+        member: GPTCredential,
+        status_code: Optional[int],
+        latency: float,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        """Вернуть участника и учесть результат запроса."""
+        with self._lock:
+            member.in_flight = max(0, member.in_flight - 1)
+
+            if status_code == 200:
+                member.ewma_latency += self.EWMA_ALPHA * (latency - member.ewma_latency)
+                member.failures = 0
+                return
+
+            member.failures += 1
+
+            if status_code in EJECT_STATUS_CODES:
+                if status_code == 429:
+                    cooldown = retry_after or self.throttle_seconds
+                    member.tokens = 0
+                else:
+                    cooldown = self.eject_seconds
+                member.ejected_until = time.monotonic() + cooldown
+                logger.warning(
+                    "⚠️ YandexGPT {} исключён из пула на {:.0f}с (HTTP {})",
+                    member.label, cooldown, status_code,
+                )
+            else:
+                # Ошибки сети/5xx не исключают участника, но делают его «медленнее»
+                member.ewma_latency += self.EWMA_ALPHA * (max(latency, member.ewma_latency * 2) - member.ewma_latency)
+
+    def snapshot(self) -> List[dict]:
+        """Состояние пула (для логов/админки)."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "folder": m.label,
+                    "latency": round(m.ewma_latency, 3),
+                    "in_flight": m.in_flight,
+                    "tokens": round(m.tokens, 2),
+                    "ejected_for": max(0.0, round(m.ejected_until - now, 1)),
+                }
+                for m in self.members
+            ]
+
+
+def parse_credentials(raw: str, fallback_key: str = "", fallback_folder: str = "") -> List[Tuple[str, str]]:
+    """
+    Разобрать YANDEX_GPT_CREDENTIALS вида "key1:folder1,key2:folder2".
+    Если переменная пуста — используется одиночная пара YANDEX_GPT_API_KEY/FOLDER_ID.
+    """
+    pairs: List[Tuple[str, str]] = []
+
+    for chunk in (raw or "").replace(";", ",").split(","):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        key, sep, folder = chunk.rpartition(":")
+        if not sep or not key.strip() or not folder.strip():
+            logger.warning("⚠️ Пропущена некорректная пара YANDEX_GPT_CREDENTIALS")
+            continue
+        pairs.append((key.strip(), folder.strip()))
+
+    if not pairs and fallback_key and fallback_folder:
+        pairs.append((fallback_key, fallback_folder))
+
+    return pairs
@@ -0,0 +1,361 @@
+# job_queue.py - Надёжная очередь задач в SQLite + пул asyncio-воркеров
+#
+# Хендлер кладёт задачу в таблицу jobs и сразу отвечает пользователю; воркеры
+# забирают задачи по приоритету (аренда с visibility timeout), продлевают
+# аренду, пока задача выполняется, и повторяют упавшие с backoff. Задачи,
+# чья аренда истекла (процесс упал/перезапущен), возвращаются в очередь.
+# Задачи одного пользователя выполняются по одной и по порядку.
+# В многопроцессном режиме (set_shard) процесс берёт только задачи своих
+# пользователей (user_id % count == index) — как и их апдейты, так что
+# кэши процесса (спекулятивные варианты, генерации) остаются полезными.
+#
+# Таблица jobs создаётся в init_database() (main.py).
+
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+class Job:
+    """Задача, выданная воркеру."""
+
+    __slots__ = ("id", "kind", "user_id", "chat_id", "payload", "attempts", "max_attempts", "result_id", "lease_token")
+
+    def __init__(self, id, kind, user_id, chat_id, payload, attempts, max_attempts, result_id, lease_token):
+        self.id = id
+        self.kind = kind
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.payload: Dict[str, Any] = json.loads(payload) if payload else {}
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.result_id = result_id
+        self.lease_token = lease_token
+
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+class JobQueue:
+    """Очередь задач в SQLite: enqueue() из хендлеров, обработка — пулом воркеров."""
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        workers: int = 8,
+        visibility_timeout: float = 180.0,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+        retry_backoff: float = 5.0,
+    ):
+        self.connect = connect
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_backoff = retry_backoff
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._owner = uuid.uuid4().hex[:12]
+        self._shard: Optional[Tuple[int, int]] = None
+
+    def set_shard(self, index: int, count: int) -> None:
+        """Брать только задачи пользователей шарда index из count (задачи без user_id — любые)."""
+        self._shard = (index, count) if count > 1 else None
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    # ---------- БД ----------
+
+    def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        user_id: Optional[int] = None,
+        chat_id: Optional[int] = None,
+        priority: int = 0,
+        max_attempts: Optional[int] = None,
+        dedupe_key: Optional[str] = None,
+    ) -> Optional[int]:
+        """
+        Поставить задачу в очередь; None — ошибка БД. С dedupe_key: 0 — у пользователя
+        уже есть такая задача в очереди или в работе (повторное нажатие), новая не ставится.
+        """
+        try:
+            conn = self.connect()
+            try:
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if dedupe_key is not None and conn.execute("""
+                        SELECT 1 FROM jobs
+                        WHERE user_id IS ? AND status IN ('queued', 'leased') AND dedupe_key = ?
+                        LIMIT 1
+                    """, (user_id, dedupe_key)).fetchone():
+                        conn.execute("COMMIT")
+                        return 0
+                    cur = conn.execute("""
+                        INSERT INTO jobs (kind, user_id, chat_id, payload, priority, max_attempts, available_at, dedupe_key)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (
+                        kind, user_id, chat_id, json.dumps(payload, ensure_ascii=False),
+                        priority, max_attempts or self.max_attempts, time.time(), dedupe_key,
+                    ))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                job_id = cur.lastrowid
+            finally:
+                conn.close()
+        except sqlite3.OperationalError as e:
+            logger.error("❌ Не удалось поставить задачу {} в очередь: {}", kind, e)
+            return None
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def _ready_filter(self, now: float) -> Tuple[str, tuple]:
+        """WHERE для задач, которые можно взять сейчас (пользователь свободен, шард свой)."""
+        sql = """
+            status = 'queued' AND available_at <= ?
+            AND (user_id IS NULL OR user_id NOT IN (
+                SELECT user_id FROM jobs WHERE status = 'leased' AND user_id IS NOT NULL
+            ))
+        """
+        if self._shard is None:
+            return sql, (now,)
+        return sql + "AND (user_id IS NULL OR user_id % ? = ?)", (now, self._shard[1], self._shard[0])
+
+    def _claim(self) -> Optional[Job]:
+        """
+        Арендовать следующую задачу (BEGIN IMMEDIATE — безопасно между процессами).
+        Сначала — обычное чтение: простаивающие воркеры не занимают блокировку записи.
+        """
+        now = time.time()
+        ready_sql, ready_params = self._ready_filter(now)
+        conn = self.connect()
+        try:
+            if not conn.execute(f"SELECT 1 FROM jobs WHERE {ready_sql} LIMIT 1", ready_params).fetchone():
+                return None
+
+            token = f"{self._owner}:{uuid.uuid4().hex[:8]}"
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(f"""
+                    SELECT id FROM jobs
+                    WHERE {ready_sql}
+                    ORDER BY priority DESC, id
+                    LIMIT 1
+                """, ready_params).fetchone()
+                if not row:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("""
+                    UPDATE jobs
+                    SET status = 'leased', attempts = attempts + 1, lease_until = ?, lease_token = ?,
+                        updated_at = datetime('now')
+                    WHERE id = ?
+                """, (now + self.visibility_timeout, token, row[0]))
+                job_row = conn.execute("""
+                    SELECT id, kind, user_id, chat_id, payload, attempts, max_attempts, result_id, lease_token
+                    FROM jobs WHERE id = ?
+                """, (row[0],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return Job(*job_row)
+
+    def _expire_leases(self) -> int:
+        """Истёкшие аренды (процесс упал) — обратно в очередь или в failed, если попытки кончились."""
+        return self._update("""
+            UPDATE jobs
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                error = COALESCE(error, 'lease expired'),
+                lease_token = NULL,
+                updated_at = datetime('now')
+            WHERE status = 'leased' AND lease_until < ?
+        """, (time.time(),))
+
+    def _update(self, sql: str, params: tuple) -> int:
+        conn = self.connect()
+        try:
+            cur = conn.execute(sql, params)
+            conn.commit()
+            return cur.rowcount
+        finally:
+            conn.close()
+
+    def _extend(self, job: Job) -> bool:
+        return bool(self._update(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+            (time.time() + self.visibility_timeout, job.id, job.lease_token),
+        ))
+
+    def _complete(self, job: Job) -> None:
+        self._update("""
+            UPDATE jobs SET status = 'done', lease_token = NULL, updated_at = datetime('now')
+            WHERE id = ? AND lease_token = ?
+        """, (job.id, job.lease_token))
+
+    def _fail(self, job: Job, error: str) -> bool:
+        """Вернуть в очередь с backoff; True — попытки исчерпаны."""
+        final = job.attempts >= job.max_attempts
+        self._update("""
+            UPDATE jobs
+            SET status = ?, error = ?, lease_token = NULL, available_at = ?, updated_at = datetime('now')
+            WHERE id = ? AND lease_token = ?
+        """, (
+            "failed" if final else "queued", error[:500],
+            time.time() + self.retry_backoff * job.attempts, job.id, job.lease_token,
+        ))
+        return final
+
+    @staticmethod
+    def attach_result(conn: sqlite3.Connection, job: Job, result_id: int) -> bool:
+        """
+        set_result() внутри транзакции вызывающего — вместе с записью самого результата.
+        False — аренда задачи потеряна (её выполняет другой воркер).
+        """
+        cur = conn.execute(
+            "UPDATE jobs SET result_id = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+            (result_id, job.id, job.lease_token),
+        )
+        if cur.rowcount != 1:
+            return False
+        job.result_id = result_id
+        return True
+
+    def set_result(self, job: Job, result_id: int) -> None:
+        """Запомнить результат (повтор задачи не выполнит работу заново)."""
+        job.result_id = result_id
+        self._update(
+            "UPDATE jobs SET result_id = ? WHERE id = ? AND lease_token = ?",
+            (result_id, job.id, job.lease_token),
+        )
+
+    def save_progress(self, job: Job, **values: Any) -> None:
+        """Дописать в payload задачи (повтор продолжит с этого места)."""
+        job.payload.update(values)
+        self._update(
+            "UPDATE jobs SET payload = ? WHERE id = ? AND lease_token = ?",
+            (json.dumps(job.payload, ensure_ascii=False), job.id, job.lease_token),
+        )
+
+    def _release_own(self) -> int:
+        """Вернуть в очередь задачи этого процесса (штатная остановка)."""
+        return self._update("""
+            UPDATE jobs SET status = 'queued', attempts = attempts - 1, lease_token = NULL,
+                            updated_at = datetime('now')
+            WHERE status = 'leased' AND lease_token LIKE ?
+        """, (self._owner + ":%",))
+
+    def depth(self) -> Dict[str, int]:
+        """Число задач по статусам (queued/leased — сигнал для масштабирования)."""
+        conn = self.connect()
+        try:
+            rows = conn.execute("""
+                SELECT status, COUNT(*) FROM jobs
+                WHERE status IN ('queued', 'leased')
+                GROUP BY status
+            """).fetchall()
+        finally:
+            conn.close()
+        counts = {"queued": 0, "leased": 0}
+        counts.update({status: int(n) for status, n in rows})
+        return counts
+
+    # ---------- Воркеры ----------
+
+    async def start(self) -> None:
+        if not self._tasks:
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._sweeper()))
+            logger.info("⚙️ Очередь задач: {} воркеров", self.workers)
+
+    async def stop(self) -> None:
+        """Остановить воркеров; незавершённые задачи вернутся в очередь."""
+        if not self._tasks:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        released = await asyncio.to_thread(self._release_own)
+        if released:
+            logger.info("↩️ В очередь возвращено задач: {}", released)
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            if not await asyncio.to_thread(self._extend, job):
+                logger.warning("⚠️ Аренда задачи #{} потеряна", job.id)
+                return
+
+    async def _sweeper(self) -> None:
+        """Одна периодическая проверка истёкших аренд на процесс (а не в каждом _claim)."""
+        while True:
+            try:
+                expired = await asyncio.to_thread(self._expire_leases)
+            except sqlite3.OperationalError as e:
+                logger.error("❌ Ошибка возврата истёкших задач: {}", e)
+                expired = 0
+            if expired:
+                logger.warning("↩️ Истекли аренды задач: {}", expired)
+                self._wakeup.set()
+            await asyncio.sleep(self.visibility_timeout / 3)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except sqlite3.OperationalError as e:
+                logger.error("❌ Ошибка получения задачи: {}", e)
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            # Освободился пользователь — его следующая задача может быть готова
+            await self._run(job)
+            self._wakeup.set()
+
+    async def _run(self, job: Job) -> None:
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            await asyncio.to_thread(self._fail, job, f"no handler for {job.kind}")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            final = await asyncio.to_thread(self._fail, job, repr(e))
+            logger.error(
+                "❌ Задача #{} ({}) упала, попытка {}/{}{}: {}",
+                job.id, job.kind, job.attempts, job.max_attempts, " — окончательно" if final else "", e,
+            )
+        else:
+            await asyncio.to_thread(self._complete, job)
+        finally:
+            heartbeat.cancel()
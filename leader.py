@@ -0,0 +1,176 @@
+# leader.py - Аренды (leases) в SQLite: выбор лидера для фоновых задач-одиночек
+#
+# Аренда — строка в таблице leases: держатель, срок и fencing token, который
+# растёт при каждой смене держателя. Держатель продлевает аренду (heartbeat);
+# упавший процесс теряет её по истечении ttl. Запись под арендой проверяет
+# токен в той же транзакции — «старый» лидер после паузы ничего не испортит.
+#
+# SingletonScheduler запускает зарегистрированную задачу только на процессе,
+# держащем её аренду; остальные раз в ttl/2 проверяют, не освободилась ли она.
+#
+# Таблица leases создаётся в init_database() (main.py).
+
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from loguru import logger
+
+
+class LeaseLost(Exception):
+    """Аренда перешла к другому процессу — работу под ней нужно прекратить."""
+
+
+class LeaseManager:
+    """Захват, продление и освобождение аренд."""
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], holder: Optional[str] = None):
+        self.connect = connect
+        self._holder = holder
+        self._suffix = uuid.uuid4().hex[:6]
+
+    @property
+    def holder(self) -> str:
+        """Идентификатор держателя; pid берётся при вызове — форкнутые воркеры различаются."""
+        return self._holder or f"{socket.gethostname()}:{os.getpid()}:{self._suffix}"
+
+    def acquire(self, name: str, ttl: float) -> Optional[int]:
+        """Захватить (или продлить свою) аренду; fencing token либо None."""
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT holder, token, expires_at FROM leases WHERE name = ?", (name,)
+                ).fetchone()
+                if row and row[0] != self.holder and row[2] > now:
+                    conn.execute("COMMIT")
+                    return None
+                token = row[1] if row and row[0] == self.holder and row[2] > now else (row[1] + 1 if row else 1)
+                conn.execute("""
+                    INSERT INTO leases (name, holder, token, expires_at, updated_at)
+                    VALUES (?, ?, ?, ?, datetime('now'))
+                    ON CONFLICT(name) DO UPDATE SET
+                        holder = excluded.holder,
+                        token = excluded.token,
+                        expires_at = excluded.expires_at,
+                        updated_at = excluded.updated_at
+                """, (name, self.holder, token, now + ttl))
+                conn.execute("COMMIT")
+                return token
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def renew(self, name: str, token: int, ttl: float) -> bool:
+        """Продлить аренду; False — она уже не наша."""
+        conn = self.connect()
+        try:
+            cur = conn.execute("""
+                UPDATE leases SET expires_at = ?, updated_at = datetime('now')
+                WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?
+            """, (time.time() + ttl, name, self.holder, token, time.time()))
+            conn.commit()
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def release(self, name: str, token: int) -> None:
+        conn = self.connect()
+        try:
+            conn.execute(
+                "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ? AND token = ?",
+                (name, self.holder, token),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def check(conn: sqlite3.Connection, name: str, token: int) -> None:
+        """Fencing: проверить токен внутри транзакции записи (иначе LeaseLost)."""
+        row = conn.execute(
+            "SELECT 1 FROM leases WHERE name = ? AND token = ? AND expires_at > ?",
+            (name, token, time.time()),
+        ).fetchone()
+        if not row:
+            raise LeaseLost(name)
+
+
+JobFunc = Callable[[int], Awaitable[None]]
+
+
+class SingletonScheduler:
+    """Периодические задачи, выполняемые ровно на одном живом процессе."""
+
+    def __init__(self, leases: LeaseManager, ttl: float = 30.0):
+        self.leases = leases
+        self.ttl = ttl
+        self._jobs: List[Tuple[str, JobFunc, float]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, name: str, func: JobFunc, interval: float) -> None:
+        """func(token) вызывается раз в interval секунд, пока процесс — лидер по name."""
+        self._jobs.append((name, func, interval))
+
+    async def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._loop(*job)) for job in self._jobs]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _hold(self, lease: str, token: int) -> None:
+        """Heartbeat: продлевать аренду, пока получается."""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await asyncio.to_thread(self.leases.renew, lease, token, self.ttl):
+                    return
+            except sqlite3.OperationalError as e:
+                logger.warning("⚠️ Не удалось продлить аренду {}: {}", lease, e)
+
+    async def _loop(self, name: str, func: JobFunc, interval: float) -> None:
+        lease = f"job:{name}"
+        while True:
+            try:
+                token = await asyncio.to_thread(self.leases.acquire, lease, self.ttl)
+            except sqlite3.OperationalError as e:
+                logger.warning("⚠️ Ошибка захвата аренды {}: {}", lease, e)
+                token = None
+            if token is None:
+                await asyncio.sleep(self.ttl / 2)
+                continue
+
+            logger.info("👑 Задача {}: этот процесс — лидер (token {})", name, token)
+            heartbeat = asyncio.create_task(self._hold(lease, token))
+            try:
+                while not heartbeat.done():
+                    run = asyncio.create_task(func(token))
+                    await asyncio.wait({run, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+                    if not run.done():
+                        run.cancel()
+                        await asyncio.gather(run, return_exceptions=True)
+                        break
+                    if not run.cancelled() and run.exception():
+                        logger.error("❌ Задача {} упала: {}", name, run.exception())
+                    await asyncio.wait({heartbeat}, timeout=interval)
+                logger.warning("⚠️ Задача {}: аренда потеряна", name)
+            finally:
+                heartbeat.cancel()
+                # Освобождаем сразу, чтобы другой процесс не ждал ttl (чужую аренду не тронет)
+                try:
+                    await asyncio.to_thread(self.leases.release, lease, token)
+                except sqlite3.Error:
+                    pass
@@ -2,27 +2,30 @@
 # 
 # Features:
 # - Generation: post/caption/story/ideas + "my style" analysis + edit/regenerate + save
-# - Payments: YooKassa via yandex_kassa_handler.py (poll status) + Telegram Stars
+# - Payments: YooKassa via yookassa_client.py (webhook + ручная проверка) + Telegram Stars
 # - Settings: notifications toggles, export CSV, saved content
 # - Admin: basic stats
-# - HTTP Server: FastAPI на PORT для Render (webhook-ready)
+# - HTTP Server: FastAPI на PORT для Render (webhook или polling, один event loop)
 
 import asyncio
 import csv
+import hmac
 import io
 import json
 import os
+import signal
 import sqlite3
 import time
 import uuid
 import threading
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Tuple
+from datetime import datetime
+from typing import Optional, Dict, Any, Set, Tuple
 
 import requests
 from loguru import logger
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -31,13 +34,34 @@ from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
     LabeledPrice, PreCheckoutQuery,
-    Update,
+    Update, ChatMemberUpdated,
 )
 from aiogram.types.input_file import BufferedInputFile
 import uvicorn
 
 from config import settings, SUBSCRIPTION_PLANS, CONTENT_TYPES
-from yandex_kassa_handler import kassa
+from gpt_pool import GPTCredentialPool, EJECT_STATUS_CODES, parse_credentials
+from db_batch import BatchWriter
+from prompt_templates import get_template, render_prompt, render_edit_prompt, fit_input
+from speculative import SpeculativeBuffer, prompt_key
+from model_router import ModelRouter, MODEL_LITE, parse_policy
+from delivery import send_long_text
+from update_queue import UpdateDeduper, UpdateWorkerPool
+from outbound_limiter import OutboundRateLimiter
+from broadcast import BroadcastManager, AUDIENCES
+from fsm_storage import SQLiteStorage
+from generation_cache import GenerationCache, GenerationRecord
+from user_serial import UserSerialMiddleware
+from job_queue import Job, JobQueue
+from sharding import ShardRouter, start_workers, stop_workers, update_user_id
+from leader import LeaseManager, SingletonScheduler
+from entitlements import EntitlementLedger
+from subscription_expiry import SubscriptionExpiry
+from payments import (
+    PaymentReconciler, PaymentStatusCache, PaymentStore, PaymentTransition, WebhookGuard,
+    FINAL_STATUSES, PROVIDER_STATUS, YOOKASSA_NETWORKS, parse_networks,
+)
+from yookassa_client import YooKassaClient, YooKassaError
 
 # =============================================================================
 # LOGGING
@@ -50,14 +74,38 @@ logger.add("bot.log", rotation="100 MB", retention="10 days")
 # =============================================================================
 
 bot = Bot(token=settings.TELEGRAM_BOT_TOKEN)
-dp = Dispatcher()
+# Все исходящие запросы проходят через лимиты Telegram (глобальный + по чатам)
+outbound_limiter = OutboundRateLimiter(
+    global_rate=settings.TG_GLOBAL_RATE,
+    chat_rate=settings.TG_CHAT_RATE,
+    group_per_minute=settings.TG_GROUP_PER_MINUTE,
+)
+bot.session.middleware(outbound_limiter)
+# FSM в SQLite (переживает рестарт); get_db_connection объявлена ниже
+fsm_storage = SQLiteStorage(
+    lambda: get_db_connection(),
+    max_size=settings.FSM_CACHE_SIZE,
+    flush_interval=settings.FSM_FLUSH_INTERVAL,
+)
+# FSM-middleware регистрируем сами: состояние должно читаться уже под замком
+# пользователя, иначе апдейт из очереди получит состояние до предыдущего хендлера
+dp = Dispatcher(storage=fsm_storage, disable_fsm=True)
+# Апдейты одного пользователя — по очереди, разных — параллельно
+dp.update.outer_middleware(UserSerialMiddleware(max_queue=settings.USER_QUEUE_SIZE))
+dp.update.outer_middleware(dp.fsm)
 router = Router()
 dp.include_router(router)
 
-# FastAPI приложение для Render
+# FastAPI приложение для Render (webhook + health, в одном event loop с ботом)
 app = FastAPI()
 PORT = int(os.getenv("PORT", "10000"))
-WEBHOOK_PATH = f"/webhook/{settings.TELEGRAM_BOT_TOKEN}"
+WEBHOOK_PATH = settings.WEBHOOK_PATH
+
+# Webhook: апдейты обрабатываются пулом воркеров, повторные доставки отбрасываются
+update_pool = UpdateWorkerPool(dp, bot, workers=settings.WEBHOOK_WORKERS, max_queue=settings.WEBHOOK_QUEUE_SIZE)
+update_dedup = UpdateDeduper(window=settings.UPDATE_DEDUP_WINDOW)
+# Многопроцессный режим (BOT_WORKERS > 1): фронт раздаёт апдейты процессам по user_id
+shard_router: Optional[ShardRouter] = None
 
 # =============================================================================
 # DATABASE
@@ -93,11 +141,32 @@ def init_database() -> None:
                 subscription_until TEXT,
                 bonus_points INTEGER DEFAULT 0,
                 is_admin INTEGER DEFAULT 0,
+                is_active INTEGER DEFAULT 1,
                 created_at TEXT DEFAULT (datetime('now')),
                 updated_at TEXT DEFAULT (datetime('now'))
             )
         """)
         
+        # Миграция: is_active (0 — пользователь заблокировал бота)
+        cursor.execute("PRAGMA table_info(users)")
+        user_columns = {row[1] for row in cursor.fetchall()}
+        if "is_active" not in user_columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN is_active INTEGER DEFAULT 1")
+            logger.info("🔧 Миграция: добавлена колонка users.is_active")
+        # Миграция: до какого subscription_until уже отправлено напоминание о продлении
+        if "renewal_reminded_until" not in user_columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN renewal_reminded_until TEXT")
+            logger.info("🔧 Миграция: добавлена колонка users.renewal_reminded_until")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_active
+            ON users(user_id) WHERE is_active = 1
+        """)
+        # Истечение подписок и напоминания (subscription_expiry.py): только платные
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_subscription_until
+            ON users(subscription_until) WHERE subscription_type != 'free'
+        """)
+        
         # Таблица счётчиков генераций
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS generation_counter (
@@ -139,6 +208,67 @@ def init_database() -> None:
             )
         """)
         
+        # Миграция: расписание сверки зависших платежей (PaymentReconciler)
+        cursor.execute("PRAGMA table_info(payments)")
+        payment_columns = {row[1] for row in cursor.fetchall()}
+        if "next_check_at" not in payment_columns:
+            cursor.execute("ALTER TABLE payments ADD COLUMN next_check_at REAL DEFAULT 0")
+            logger.info("🔧 Миграция: добавлена колонка payments.next_check_at")
+        if "check_attempts" not in payment_columns:
+            cursor.execute("ALTER TABLE payments ADD COLUMN check_attempts INTEGER DEFAULT 0")
+            logger.info("🔧 Миграция: добавлена колонка payments.check_attempts")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_payments_reconcile
+            ON payments(status, next_check_at)
+        """)
+        
+        # Поиск платежа по id провайдера (webhook, проверка статуса)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_payments_external
+            ON payments(provider, external_id)
+        """)
+        
+        # Журнал оплаченных периодов (entitlements.py): один платёж — одна строка
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entitlements'")
+        entitlements_exist = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS entitlements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                provider TEXT NOT NULL,
+                external_id TEXT NOT NULL,
+                subscription_type TEXT NOT NULL,
+                tier_rank INTEGER NOT NULL,
+                starts_at TEXT NOT NULL,
+                ends_at TEXT NOT NULL,
+                created_at TEXT DEFAULT (datetime('now')),
+                UNIQUE(provider, external_id),
+                FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_entitlements_user
+            ON entitlements(user_id, ends_at)
+        """)
+        if not entitlements_exist:
+            # Миграция: действующие подписки из users — в журнал (без срока — бессрочно)
+            cursor.execute("""
+                SELECT user_id, subscription_type, subscription_until FROM users
+                WHERE subscription_type IS NOT NULL AND subscription_type != 'free'
+            """)
+            legacy = [
+                (uid, f"user:{uid}", sub_type, PLAN_RANKS.get(sub_type, 0),
+                 datetime.now().isoformat(timespec="seconds"), until or "9999-12-31T00:00:00")
+                for uid, sub_type, until in cursor.fetchall()
+            ]
+            cursor.executemany("""
+                INSERT OR IGNORE INTO entitlements
+                    (user_id, provider, external_id, subscription_type, tier_rank, starts_at, ends_at)
+                VALUES (?, 'legacy', ?, ?, ?, ?, ?)
+            """, legacy)
+            if legacy:
+                logger.info(f"🔧 Миграция: подписок перенесено в журнал — {len(legacy)}")
+        
         # Таблица истории генераций
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS generation_history (
@@ -152,6 +282,143 @@ def init_database() -> None:
             )
         """)
         
+        # Последняя генерация пользователя (кнопки без id у старых сообщений)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_generation_history_user
+            ON generation_history(user_id, id)
+        """)
+        
+        # Метрики генераций (токены/задержка), пишутся пачками через metrics_writer
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS generation_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                generation_id INTEGER,
+                user_id INTEGER,
+                content_type TEXT,
+                tier TEXT,
+                model TEXT,
+                input_tokens INTEGER DEFAULT 0,
+                output_tokens INTEGER DEFAULT 0,
+                latency_ms INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0,
+                cache_hit INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT (datetime('now'))
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_generation_metrics_generation
+            ON generation_metrics(generation_id)
+        """)
+        
+        # Дневные агрегаты по метрикам генераций
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS generation_daily_stats (
+                date TEXT,
+                content_type TEXT,
+                tier TEXT,
+                model TEXT,
+                generations INTEGER DEFAULT 0,
+                input_tokens INTEGER DEFAULT 0,
+                output_tokens INTEGER DEFAULT 0,
+                latency_ms_total INTEGER DEFAULT 0,
+                latency_ms_max INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0,
+                cache_hits INTEGER DEFAULT 0,
+                PRIMARY KEY(date, content_type, tier, model)
+            )
+        """)
+        
+        # Рассылки: курсор по user_id для продолжения после рестарта
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                audience TEXT,
+                admin_chat_id INTEGER,
+                source_chat_id INTEGER,
+                source_message_id INTEGER,
+                progress_message_id INTEGER,
+                preview TEXT,
+                status TEXT DEFAULT 'draft',
+                cursor_user_id INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT (datetime('now')),
+                started_at TEXT,
+                finished_at TEXT
+            )
+        """)
+        
+        # Статус доставки рассылки каждому получателю
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT,
+                error TEXT,
+                sent_at TEXT DEFAULT (datetime('now')),
+                PRIMARY KEY(broadcast_id, user_id)
+            )
+        """)
+        
+        # Состояния FSM (SQLiteStorage)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at TEXT DEFAULT (datetime('now'))
+            )
+        """)
+        
+        # Очередь задач (генерации): аренда с visibility timeout, повторы, приоритет
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                payload TEXT,
+                priority INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 3,
+                available_at REAL,
+                lease_until REAL,
+                lease_token TEXT,
+                result_id INTEGER,
+                error TEXT,
+                dedupe_key TEXT,
+                created_at TEXT DEFAULT (datetime('now')),
+                updated_at TEXT DEFAULT (datetime('now'))
+            )
+        """)
+        # Миграция: ключ повторной постановки (двойное нажатие «Ещё вариант»)
+        cursor.execute("PRAGMA table_info(jobs)")
+        if "dedupe_key" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN dedupe_key TEXT")
+            logger.info("🔧 Миграция: добавлена колонка jobs.dedupe_key")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobs_claim
+            ON jobs(status, priority DESC, id)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobs_user
+            ON jobs(user_id, status)
+        """)
+        
+        # Аренды для задач-одиночек (leader.py): держатель, срок, fencing token
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT,
+                token INTEGER DEFAULT 0,
+                expires_at REAL DEFAULT 0,
+                updated_at TEXT DEFAULT (datetime('now'))
+            )
+        """)
+        
         # Таблица сохранённого контента
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS saved_content (
@@ -180,49 +447,110 @@ def init_database() -> None:
 # USER HELPERS
 # =============================================================================
 
+# Порядок тарифов (старший действует при пересечении периодов)
+PLAN_RANKS = {name: rank for rank, name in enumerate(SUBSCRIPTION_PLANS)}
+
+# Действующая подписка: журнал оплат + кэш на пользователя
+entitlements = EntitlementLedger(
+    get_db_connection,
+    ranks=PLAN_RANKS,
+    max_size=settings.ENTITLEMENT_CACHE_SIZE,
+    ttl=settings.ENTITLEMENT_CACHE_TTL,
+)
+
+# user_id, точно существующие в БД (users + user_settings): для них — ноль запросов
+known_users: Set[int] = set()
+# Из них — с users.is_active = 1: /start не пишет в БД, пока их не пометят заблокировавшими
+active_users: Set[int] = set()
+
+# user_id → (годен до, is_admin): флаг меняется вручную в БД, хватает короткого кэша
+_admin_cache: Dict[int, Tuple[float, bool]] = {}
+ADMIN_CACHE_TTL = 60.0
+
+def load_known_users() -> None:
+    """Прогреть known_users (и active_users) при старте."""
+    try:
+        conn = get_db_connection()
+        for user_id, is_active in conn.execute("SELECT user_id, is_active FROM users"):
+            known_users.add(user_id)
+            if is_active:
+                active_users.add(user_id)
+        conn.close()
+        logger.info(f"👥 Известных пользователей: {len(known_users)}")
+    except sqlite3.OperationalError as e:
+        logger.error(f"❌ Ошибка загрузки пользователей: {e}")
+
 def get_or_create_user(user_id: int, username: str = "", first_name: str = ""):
     """
     Гарантировать создание юзера перед использованием.
-    Вызывается в НАЧАЛЕ каждого хендлера.
+    Вызывается в НАЧАЛЕ каждого хендлера; для известных юзеров БД не трогает.
     """
+    if user_id in known_users:
+        return
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not cursor.fetchone():
-            cursor.execute("""
-                INSERT INTO users (user_id, username, first_name, subscription_type)
-                VALUES (?, ?, ?, 'free')
-            """, (user_id, username, first_name))
-            
-            cursor.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
+        cursor.execute("""
+            INSERT OR IGNORE INTO users (user_id, username, first_name, subscription_type)
+            VALUES (?, ?, ?, 'free')
+        """, (user_id, username, first_name))
+        if cursor.rowcount:
             logger.info(f"✅ Создан юзер {user_id}")
+            active_users.add(user_id)
+        cursor.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (user_id,))
         
         conn.commit()
         conn.close()
-    except sqlite3.IntegrityError:
-        logger.warning(f"⚠️ Юзер {user_id} уже существует")
+        known_users.add(user_id)
     except sqlite3.OperationalError as e:
         logger.error(f"❌ Ошибка БД при создании юзера {user_id}: {e}")
         raise
 
+def reactivate_user(user_id: int) -> None:
+    """Вернуть в рассылки пользователя, который разблокировал бота (запись — только если был помечен)."""
+    if user_id in active_users:
+        return
+    try:
+        conn = get_db_connection()
+        conn.execute(
+            "UPDATE users SET is_active = 1, updated_at = datetime('now') WHERE user_id = ? AND is_active = 0",
+            (user_id,)
+        )
+        conn.commit()
+        conn.close()
+        active_users.add(user_id)
+    except sqlite3.OperationalError as e:
+        logger.error(f"❌ Ошибка активации юзера {user_id}: {e}")
+
+def forget_active_users(user_ids) -> None:
+    """Пользователи помечены is_active = 0 (заблокировали бота): следующий /start их вернёт."""
+    active_users.difference_update(user_ids)
+
 def is_user_admin(user_id: int) -> bool:
     """Проверка админского статуса."""
     admin_id = getattr(settings, "ADMIN_ID", None)
     if admin_id and str(user_id) == str(admin_id):
         return True
     
+    now = time.monotonic()
+    cached = _admin_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,))
         row = cursor.fetchone()
         conn.close()
-        return bool(row and row[0])
     except sqlite3.OperationalError as e:
         logger.error(f"❌ Ошибка проверки админа: {e}")
         return False
+    is_admin = bool(row and row[0])
+    _admin_cache[user_id] = (now + ADMIN_CACHE_TTL, is_admin)
+    return is_admin
 
 def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
     """Получить информацию пользователя."""
@@ -240,12 +568,13 @@ def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
         if not row:
             return None
         
+        current = entitlements.effective(user_id)
         return {
             "user_id": row[0],
             "username": row[1] or "не указан",
             "first_name": row[2] or "Пользователь",
-            "subscription_type": row[3] or "free",
-            "subscription_until": row[4],
+            "subscription_type": current.subscription_type,
+            "subscription_until": current.until,
             "bonus_points": int(row[5] or 0),
             "is_admin": int(row[6] or 0),
         }
@@ -253,6 +582,10 @@ def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
         logger.error(f"❌ Ошибка получения info юзера: {e}")
         return None
 
+def get_user_tier(user_id: int) -> str:
+    """Тариф пользователя (для выбора модели/метрик)."""
+    return entitlements.effective(user_id).subscription_type
+
 def _plan_daily_limit(plan: Dict[str, Any]) -> int:
     """Совместимость: daily_limit (новое) / monthly_limit (старое имя)."""
     if "daily_limit" in plan and isinstance(plan["daily_limit"], int):
@@ -261,17 +594,15 @@ def _plan_daily_limit(plan: Dict[str, Any]) -> int:
         return plan["monthly_limit"]
     return 5
 
-def check_generation_limit(user_id: int) -> Tuple[bool, int, int]:
-    """Проверка лимита генераций (возвращает: is_available, used, limit)."""
-    if is_user_admin(user_id):
-        return True, 0, 999999
-    
-    user = get_user_info(user_id)
-    sub_type = (user or {}).get("subscription_type", "free")
-    plan = SUBSCRIPTION_PLANS.get(sub_type, SUBSCRIPTION_PLANS.get("free", {"daily_limit": 5}))
-    limit = _plan_daily_limit(plan)
-    
+# user_id → (дата, генераций за день): счётчик пишет только процесс шарда пользователя
+_usage_cache: Dict[int, Tuple[str, int]] = {}
+
+def generations_used_today(user_id: int) -> int:
+    """Генераций за сегодня (из кэша; промах — один SELECT)."""
     today = datetime.now().strftime("%Y-%m-%d")
+    cached = _usage_cache.get(user_id)
+    if cached and cached[0] == today:
+        return cached[1]
     
     try:
         conn = get_db_connection()
@@ -282,10 +613,30 @@ def check_generation_limit(user_id: int) -> Tuple[bool, int, int]:
         )
         row = cursor.fetchone()
         conn.close()
-        used = int(row[0]) if row else 0
     except sqlite3.OperationalError as e:
         logger.error(f"❌ Ошибка проверки лимита: {e}")
-        used = 0
+        return 0
+    used = int(row[0]) if row else 0
+    _usage_cache[user_id] = (today, used)
+    return used
+
+def _daily_limit_for(sub_type: str) -> int:
+    plan = SUBSCRIPTION_PLANS.get(sub_type, SUBSCRIPTION_PLANS.get("free", {"daily_limit": 5}))
+    return _plan_daily_limit(plan)
+
+def check_generation_limit(user_id: int) -> Tuple[bool, int, int]:
+    """Проверка лимита генераций (возвращает: is_available, used, limit)."""
+    if is_user_admin(user_id):
+        return True, 0, 999999
+    
+    current, fresh = entitlements.lookup(user_id)
+    limit = _daily_limit_for(current.subscription_type)
+    used = generations_used_today(user_id)
+    
+    if used >= limit and not fresh:
+        # Отказ по подписке из кэша перепроверяем: её могли активировать в другом процессе
+        entitlements.invalidate(user_id)
+        limit = _daily_limit_for(entitlements.effective(user_id).subscription_type)
     
     return used < limit, used, limit
 
@@ -294,18 +645,12 @@ def increment_generation_counter(user_id: int) -> None:
     today = datetime.now().strftime("%Y-%m-%d")
     
     try:
+        # Юзер должен существовать (FOREIGN KEY); обычно он уже в known_users
+        get_or_create_user(user_id)
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Проверка существования юзера
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not cursor.fetchone():
-            logger.warning(f"⚠️ Юзер {user_id} не существует при инкременте! Создаю...")
-            conn.close()
-            get_or_create_user(user_id)
-            conn = get_db_connection()
-            cursor = conn.cursor()
-        
         # Инкремент с ON CONFLICT для SQLite
         cursor.execute("""
             INSERT INTO generation_counter (user_id, date, count)
@@ -315,6 +660,7 @@ def increment_generation_counter(user_id: int) -> None:
         
         conn.commit()
         conn.close()
+        _usage_cache.pop(user_id, None)
         logger.debug(f"✅ Счётчик +1 для {user_id}")
         
     except sqlite3.IntegrityError as e:
@@ -322,8 +668,8 @@ def increment_generation_counter(user_id: int) -> None:
     except sqlite3.OperationalError as e:
         logger.error(f"❌ БД заблокирована при инкременте: {e}")
 
-def save_generation(user_id: int, content_type: str, prompt: str, content: str) -> None:
-    """Сохранить в историю генераций."""
+def save_generation(user_id: int, content_type: str, prompt: str, content: str) -> Optional[int]:
+    """Сохранить в историю генераций (возвращает id записи)."""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -331,10 +677,87 @@ def save_generation(user_id: int, content_type: str, prompt: str, content: str)
             INSERT INTO generation_history (user_id, content_type, prompt, content)
             VALUES (?, ?, ?, ?)
         """, (user_id, content_type, prompt, content))
+        generation_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        return generation_id
     except sqlite3.OperationalError as e:
         logger.error(f"❌ Ошибка сохранения генерации: {e}")
+        return None
+
+def record_generation_metrics(
+    generation_id: Optional[int],
+    user_id: int,
+    content_type: str,
+    result: "GenerationResult",
+) -> None:
+    """Записать метрики генерации и дневной агрегат (через пакетную запись)."""
+    tier = get_user_tier(user_id)
+    latency_ms = int(result.latency * 1000)
+    
+    metrics_writer.add("""
+        INSERT INTO generation_metrics
+            (generation_id, user_id, content_type, tier, model,
+             input_tokens, output_tokens, latency_ms, retries, cache_hit)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        generation_id, user_id, content_type, tier, result.model,
+        result.input_tokens, result.output_tokens, latency_ms,
+        result.retries, int(result.cache_hit),
+    ))
+    
+    metrics_writer.add("""
+        INSERT INTO generation_daily_stats
+            (date, content_type, tier, model, generations, input_tokens, output_tokens,
+             latency_ms_total, latency_ms_max, retries, cache_hits)
+        VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(date, content_type, tier, model) DO UPDATE SET
+            generations = generations + 1,
+            input_tokens = input_tokens + excluded.input_tokens,
+            output_tokens = output_tokens + excluded.output_tokens,
+            latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+            latency_ms_max = MAX(latency_ms_max, excluded.latency_ms_max),
+            retries = retries + excluded.retries,
+            cache_hits = cache_hits + excluded.cache_hits
+    """, (
+        datetime.now().strftime("%Y-%m-%d"), content_type, tier, result.model,
+        result.input_tokens, result.output_tokens, latency_ms, latency_ms,
+        result.retries, int(result.cache_hit),
+    ))
+
+def commit_generation(user_id: int, content_type: str, prompt: str, result: "GenerationResult", job: Job) -> int:
+    """
+    Списать генерацию, сохранить в историю и отметить result_id задачи — одной
+    транзакцией (повтор задачи после сбоя не спишет второй раз); затем метрики и кэш для кнопок.
+    """
+    get_or_create_user(user_id)
+    conn = get_db_connection()
+    try:
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                INSERT INTO generation_counter (user_id, date, count)
+                VALUES (?, ?, 1)
+                ON CONFLICT(user_id, date) DO UPDATE SET count = count + 1
+            """, (user_id, datetime.now().strftime("%Y-%m-%d")))
+            generation_id = conn.execute("""
+                INSERT INTO generation_history (user_id, content_type, prompt, content)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, content_type, prompt, result.text)).lastrowid
+            if not JobQueue.attach_result(conn, job, generation_id):
+                raise RuntimeError(f"lease of job #{job.id} lost")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    _usage_cache.pop(user_id, None)
+    
+    record_generation_metrics(generation_id, user_id, content_type, result)
+    generations.put(GenerationRecord(generation_id, user_id, content_type, prompt, result.text))
+    return generation_id
 
 def save_content(user_id: int, content_type: str, prompt: str, content: str) -> None:
     """Сохранить в saved_content."""
@@ -441,22 +864,25 @@ def get_notifications(user_id: int) -> Tuple[int, int, int]:
         logger.error(f"❌ Ошибка получения уведомлений: {e}")
         return 1, 1, 1
 
-def update_subscription(user_id: int, sub_type: str, days: int = 30) -> None:
-    """Обновить подписку пользователя."""
-    until = datetime.now() + timedelta(days=days)
-    
+def generation_stats_today() -> list:
+    """Агрегаты генераций за сегодня по типу контента и тарифу."""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("""
-            UPDATE users
-            SET subscription_type = ?, subscription_until = ?, updated_at = datetime('now')
-            WHERE user_id = ?
-        """, (sub_type, until.isoformat(), user_id))
-        conn.commit()
+            SELECT content_type, tier, SUM(generations), SUM(input_tokens), SUM(output_tokens),
+                   SUM(latency_ms_total), SUM(cache_hits)
+            FROM generation_daily_stats
+            WHERE date = ?
+            GROUP BY content_type, tier
+            ORDER BY SUM(generations) DESC
+        """, (datetime.now().strftime("%Y-%m-%d"),))
+        rows = cursor.fetchall()
         conn.close()
+        return rows
     except sqlite3.OperationalError as e:
-        logger.error(f"❌ Ошибка обновления подписки: {e}")
+        logger.error(f"❌ Ошибка получения метрик генераций: {e}")
+        return []
 
 def admin_stats() -> Dict[str, Any]:
     """Получить статистику для админа."""
@@ -502,70 +928,263 @@ def admin_stats() -> Dict[str, Any]:
 # YANDEX GPT HANDLER
 # =============================================================================
 
+class GenerationResult:
+    """Результат генерации с метриками (токены, задержка, ретраи)."""
+    
+    __slots__ = ("text", "model", "input_tokens", "output_tokens", "latency", "retries", "cache_hit")
+    
+    def __init__(
+        self,
+        text: str,
+        model: str,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        latency: float = 0.0,
+        retries: int = 0,
+        cache_hit: bool = False,
+    ):
+        self.text = text
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.latency = latency
+        self.retries = retries
+        self.cache_hit = cache_hit
+
 class YandexGPTHandler:
-    """Wrapper для YandexGPT API."""
+    """Wrapper для YandexGPT API (с пулом ключей/каталогов)."""
     
-    API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    API_URL = settings.YANDEX_GPT_API_URL
     
     def __init__(self):
-        self.api_key = getattr(settings, "YANDEX_GPT_API_KEY", None)
-        self.folder_id = getattr(settings, "YANDEX_GPT_FOLDER_ID", None)
-    
-    def _sync_generate(self, prompt: str, content_type: str) -> Optional[str]:
+        self.pool = GPTCredentialPool(
+            parse_credentials(
+                getattr(settings, "YANDEX_GPT_CREDENTIALS", ""),
+                getattr(settings, "YANDEX_GPT_API_KEY", ""),
+                getattr(settings, "YANDEX_GPT_FOLDER_ID", ""),
+            ),
+            rps_per_key=getattr(settings, "YANDEX_GPT_RPS_PER_KEY", 10),
+            eject_seconds=getattr(settings, "YANDEX_GPT_EJECT_SECONDS", 300),
+        )
+        self.router = ModelRouter(
+            parse_policy(getattr(settings, "MODEL_ROUTING", "")),
+            timeouts={MODEL_LITE: getattr(settings, "YANDEX_GPT_LITE_TIMEOUT", 15)},
+        )
+        # Одно HTTP-соединение на поток (keep-alive к llm.api.cloud.yandex.net)
+        self._local = threading.local()
+        logger.info("🤖 YandexGPT: ключей в пуле — {}", len(self.pool))
+    
+    def _session(self) -> requests.Session:
+        """requests.Session текущего потока."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+    
+    def _request(self, model: str, prompt: str, template, timeout: float) -> Tuple[Optional[GenerationResult], bool]:
+        """
+        Один запрос к модели через пул ключей.
+        Возвращает (результат, fatal): fatal=True — ошибка в самом запросе, повтор бесполезен.
+        """
+        tried = []
+        # Каждый участник пула пробуется не более одного раза
+        while len(tried) < len(self.pool):
+            member = self.pool.acquire(exclude=tried)
+            if member is None:
+                break
+            tried.append(member)
+            
+            payload = {
+                "modelUri": f"gpt://{member.folder_id}/{model}/latest",
+                "completionOptions": {
+                    "stream": False,
+                    "temperature": template.temperature,
+                    "maxTokens": str(template.max_tokens)
+                },
+                "messages": [
+                    {"role": "system", "text": template.system},
+                    {"role": "user", "text": prompt},
+                ],
+            }
+            
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {member.api_key}",
+                "x-folder-id": member.folder_id,
+            }
+            
+            started = time.monotonic()
+            try:
+                response = self._session().post(self.API_URL, json=payload, headers=headers, timeout=timeout)
+            except Exception as e:
+                self.pool.release(member, None, time.monotonic() - started)
+                logger.error("❌ Ошибка генерации YandexGPT ({}, {}): {}", model, member.label, e)
+                continue
+            
+            latency = time.monotonic() - started
+            
+            if response.status_code != 200:
+                retry_after = response.headers.get("Retry-After")
+                self.pool.release(
+                    member, response.status_code, latency,
+                    retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+                )
+                logger.error("❌ YandexGPT error {} {} {}", model, response.status_code, response.text[:200])
+                if 400 <= response.status_code < 500 and response.status_code not in EJECT_STATUS_CODES:
+                    # Ошибка в самом запросе — другой ключ не поможет
+                    return None, True
+                continue
+            
+            self.pool.release(member, 200, latency)
+            
+            try:
+                result = response.json()["result"]
+                usage = result.get("usage") or {}
+                return GenerationResult(
+                    text=result["alternatives"][0]["message"]["text"],
+                    model=model,
+                    input_tokens=int(usage.get("inputTextTokens") or 0),
+                    output_tokens=int(usage.get("completionTokens") or 0),
+                    latency=latency,
+                    retries=len(tried) - 1,
+                ), False
+            except Exception as e:
+                logger.error("❌ Некорректный ответ YandexGPT: {}", e)
+                return None, True
+        
+        logger.error("❌ YandexGPT ({}): все ключи пула недоступны", model)
+        return None, False
+    
+    def _sync_generate(self, prompt: str, content_type: str, tier: str = "free") -> Optional[GenerationResult]:
         """Синхронная генерация (вызовется через asyncio.to_thread)."""
-        if not self.api_key or not self.folder_id:
+        if not len(self.pool):
             logger.warning("⚠️ YandexGPT не настроен")
             return None
         
-        system_prompts = {
-            "post": "Ты профессиональный копирайтер для соцсетей. Дай структурированный пост с эмодзи и мягким CTA.",
-            "caption": "Ты эксперт по подписям. Дай 2 версии (формальная/неформальная) + хештеги.",
-            "story": "Ты сторителлер. Сгенерируй сценарий сторис в 5-7 пунктов + вопросы для вовлечения.",
-            "ideas": "Ты генератор идей. Дай 10 идей контента, разнообразных по формату.",
-            "style_analysis": "Ты анализируешь стиль автора. Коротко опиши стиль (3-5 предложений) и ключевые приемы.",
-        }
-        
-        system_prompt = system_prompts.get(content_type, system_prompts["post"])
-        
-        payload = {
-            "modelUri": f"gpt://{self.folder_id}/yandexgpt/latest",
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.7,
-                "maxTokens": "1500"
-            },
-            "messages": [
-                {"role": "system", "text": system_prompt},
-                {"role": "user", "text": prompt},
-            ],
-        }
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
+        template = get_template(content_type)
+        prompt = fit_input(content_type, prompt)
         timeout = getattr(settings, "REQUEST_TIMEOUT", 30)
         
-        try:
-            response = requests.post(self.API_URL, json=payload, headers=headers, timeout=timeout)
-            
-            if response.status_code != 200:
-                logger.error("❌ YandexGPT error {} {}", response.status_code, response.text[:200])
-                return None
-            
-            data = response.json()
-            return data["result"]["alternatives"][0]["message"]["text"]
-        except Exception as e:
-            logger.error("❌ Ошибка генерации YandexGPT: {}", e)
-            return None
+        # Основная модель по политике, при ошибке/таймауте — запасная
+        for attempt, model in enumerate(self.router.route(content_type, tier)):
+            started = time.monotonic()
+            result, fatal = self._request(model, prompt, template, self.router.timeout_for(model, timeout))
+            self.router.stats.record(
+                model, content_type, tier,
+                ok=result is not None,
+                latency=time.monotonic() - started,
+                fallback=attempt > 0,
+            )
+            if result is not None:
+                result.retries += attempt
+                return result
+            if fatal:
+                break
+        
+        return None
     
-    async def generate(self, prompt: str, content_type: str) -> Optional[str]:
+    async def generate(self, prompt: str, content_type: str, tier: str = "free") -> Optional[GenerationResult]:
         """Асинхронная генерация."""
-        return await asyncio.to_thread(self._sync_generate, prompt, content_type)
+        return await asyncio.to_thread(self._sync_generate, prompt, content_type, tier)
 
 gpt = YandexGPTHandler()
 
+# Пакетная запись метрик генераций (запускается в main())
+metrics_writer = BatchWriter(get_db_connection)
+
+# Очередь генераций: переживает рестарт, воркеры доставляют результат в чат
+jobs = JobQueue(
+    get_db_connection,
+    workers=settings.JOB_WORKERS,
+    visibility_timeout=settings.JOB_VISIBILITY_TIMEOUT,
+    max_attempts=settings.JOB_MAX_ATTEMPTS,
+)
+
+# Аренды и планировщик задач, которые должны идти ровно на одном процессе
+leases = LeaseManager(get_db_connection)
+scheduler = SingletonScheduler(leases, ttl=settings.LEASE_TTL)
+
+broadcaster = BroadcastManager(
+    bot,
+    get_db_connection,
+    leases=leases,
+    rate=settings.BROADCAST_RATE,
+    chunk_size=settings.BROADCAST_CHUNK_SIZE,
+    concurrency=settings.BROADCAST_CONCURRENCY,
+    progress_interval=settings.BROADCAST_PROGRESS_INTERVAL,
+    on_blocked=forget_active_users,
+)
+
+# Платежи ЮKassa: смена статуса вместе с подпиской + проверка отправителя webhook
+payment_store = PaymentStore(get_db_connection, entitlements, subscription_days=30)
+kassa_guard = WebhookGuard(
+    [] if settings.YOOKASSA_WEBHOOK_IPS == "off"
+    else parse_networks(settings.YOOKASSA_WEBHOOK_IPS or ",".join(YOOKASSA_NETWORKS)),
+    secret=settings.YOOKASSA_WEBHOOK_SECRET,
+    proxy_hops=settings.TRUSTED_PROXY_HOPS,
+)
+kassa_client = YooKassaClient(
+    settings.YANDEX_KASSA_SHOP_ID,
+    settings.YANDEX_KASSA_SECRET_KEY,
+    api_base=settings.YOOKASSA_API_BASE,
+    timeout=settings.YOOKASSA_TIMEOUT,
+    max_connections=settings.YOOKASSA_MAX_CONNECTIONS,
+    retries=settings.YOOKASSA_RETRIES,
+)
+# Статусы для кнопки «✅ Я оплатил»: повторные нажатия не идут в API
+payment_statuses = PaymentStatusCache(kassa_client, ttl=settings.PAYMENT_STATUS_TTL)
+# Сверка платежей, по которым не пришёл webhook (notify_payment объявлена ниже)
+reconciler = PaymentReconciler(
+    payment_store,
+    kassa_client,
+    on_change=lambda result: notify_payment(result),
+    batch_size=settings.PAYMENT_RECONCILE_BATCH,
+    concurrency=settings.PAYMENT_RECONCILE_CONCURRENCY,
+    backoff=settings.PAYMENT_CHECK_BACKOFF,
+    expire_after=settings.PAYMENT_EXPIRE_AFTER,
+)
+# Понижение истёкших подписок + напоминания о продлении (send_renewal_reminder — ниже)
+expiry = SubscriptionExpiry(
+    get_db_connection,
+    entitlements,
+    remind=lambda user_id, sub_type, until: send_renewal_reminder(user_id, sub_type, until),
+    batch_size=settings.SUBSCRIPTION_EXPIRY_BATCH,
+    remind_days=settings.RENEWAL_REMINDER_DAYS,
+)
+
+def purge_stale_rows() -> None:
+    """Удалить брошенные FSM-диалоги (30 дней) и завершённые задачи (7 дней)."""
+    conn = get_db_connection()
+    try:
+        fsm = conn.execute("DELETE FROM fsm_storage WHERE updated_at < datetime('now', '-30 days')").rowcount
+        done = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < datetime('now', '-7 days')"
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if fsm or done:
+        logger.info(f"🧹 Очистка: FSM {fsm}, задач {done}")
+
+async def maintenance_job(token: int) -> None:
+    await asyncio.to_thread(purge_stale_rows)
+
+async def broadcasts_job(token: int) -> None:
+    # Подхватить рассылки, брошенные упавшим/перезапущенным процессом
+    await broadcaster.resume()
+
+async def payments_job(token: int) -> None:
+    await reconciler.run_once()
+
+async def expiry_job(token: int) -> None:
+    await expiry.run_once()
+
+scheduler.register("maintenance", maintenance_job, interval=3600)
+scheduler.register("broadcasts", broadcasts_job, interval=60)
+scheduler.register("payments", payments_job, interval=settings.PAYMENT_RECONCILE_INTERVAL)
+scheduler.register("subscription_expiry", expiry_job, interval=settings.SUBSCRIPTION_EXPIRY_INTERVAL)
+
 # =============================================================================
 # UI HELPERS
 # =============================================================================
@@ -593,12 +1212,13 @@ def generation_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🤖 Мой стиль", callback_data="gen:style")],
     ])
 
-def after_generation_kb() -> InlineKeyboardMarkup:
-    """Действия после генерации."""
+def after_generation_kb(generation_id: Optional[int] = None) -> InlineKeyboardMarkup:
+    """Действия после генерации (кнопки привязаны к id генерации)."""
+    suffix = f":{generation_id}" if generation_id else ""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💾 Сохранить", callback_data="content:save")],
-        [InlineKeyboardButton(text="✏️ Правки", callback_data="content:edit")],
-        [InlineKeyboardButton(text="🔄 Ещё вариант", callback_data="content:regen")],
+        [InlineKeyboardButton(text="💾 Сохранить", callback_data=f"content:save{suffix}")],
+        [InlineKeyboardButton(text="✏️ Правки", callback_data=f"content:edit{suffix}")],
+        [InlineKeyboardButton(text="🔄 Ещё вариант", callback_data=f"content:regen{suffix}")],
         [InlineKeyboardButton(text="⬅️ В меню генерации", callback_data="nav:genmenu")],
     ])
 
@@ -643,37 +1263,304 @@ class EditStates(StatesGroup):
     """Состояния для редактирования."""
     waiting_edit = State()
 
+class BroadcastStates(StatesGroup):
+    """Состояния для рассылки (админ)."""
+    waiting_message = State()
+
 # =============================================================================
 # IN-MEMORY CACHE
 # =============================================================================
 
-last_content: Dict[int, Dict[str, str]] = {}
+# Последние генерации для кнопок (LRU + TTL, промах — из generation_history)
+generations = GenerationCache(
+    get_db_connection,
+    max_size=settings.GENERATION_CACHE_SIZE,
+    ttl=settings.GENERATION_CACHE_TTL,
+)
+
+def generation_for_callback(query: CallbackQuery) -> Optional[GenerationRecord]:
+    """Генерация из callback_data вида content:<action>[:<id>]."""
+    parts = query.data.split(":")
+    if len(parts) > 2 and parts[2].isdigit():
+        return generations.get(int(parts[2]), query.from_user.id)
+    # Кнопки старого формата — последняя генерация пользователя
+    return generations.latest(query.from_user.id)
+
+# Предгенерированные варианты для «🔄 Ещё вариант» (платные тарифы)
+variants = SpeculativeBuffer(
+    max_users=settings.SPECULATIVE_MAX_USERS,
+    ttl=settings.SPECULATIVE_TTL,
+)
+
+def prefetch_variant(user_id: int, content_type: str, prompt: str) -> None:
+    """Запустить фоновую генерацию альтернативного варианта (лимит не списывается)."""
+    if not settings.SPECULATIVE_REGEN:
+        return
+    
+    tier = get_user_tier(user_id)
+    if tier not in settings.SPECULATIVE_TIERS:
+        return
+    
+    # Нет смысла готовить вариант, который нельзя будет получить по лимиту
+    has_limit, _, _ = check_generation_limit(user_id)
+    if not has_limit:
+        return
+    
+    variants.schedule(
+        user_id,
+        prompt_key(content_type, prompt),
+        lambda: gpt.generate(prompt, content_type, tier),
+    )
+
+# =============================================================================
+# GENERATION JOBS
+# =============================================================================
+
+# Платные тарифы обслуживаются раньше бесплатного при очереди
+TIER_PRIORITY = {"free": 0, "basic": 1, "premium": 2, "vip": 3}
+
+GENERATION_ERRORS = {
+    "new": "❌ Не удалось сгенерировать. Проверь YANDEX_GPT_API_KEY/FOLDER_ID.",
+    "regen": "❌ Не удалось перегенерировать.",
+    "edit": "❌ Не удалось применить правки.",
+}
+
+def enqueue_generation(user_id: int, chat_id: int, content_type: str, prompt: str, mode: str = "new") -> Optional[int]:
+    """
+    Поставить генерацию в очередь задач; результат придёт в чат от воркера.
+    None — ошибка БД, 0 — такая генерация у пользователя уже в очереди.
+    """
+    tier = get_user_tier(user_id)
+    kind = "style_analysis" if content_type == "style_analysis" else "generate"
+    return jobs.enqueue(
+        kind,
+        {"content_type": content_type, "prompt": prompt, "tier": tier, "mode": mode},
+        user_id=user_id,
+        chat_id=chat_id,
+        priority=TIER_PRIORITY.get(tier, 0),
+        dedupe_key=f"{kind}:{content_type}:{mode}",
+    )
+
+async def deliver_job_result(job: Job, text: str, reply_markup=None) -> None:
+    """
+    Доставить результат задачи; недоставка — исключение, и задача уйдёт на повтор,
+    который продолжит с первой недоставленной части. Бот заблокирован — без повтора.
+    """
+    delivery = await send_long_text(bot, job.chat_id, text, reply_markup, start=job.payload.get("delivered", 0))
+    if delivery.done or delivery.unreachable:
+        return
+    await asyncio.to_thread(jobs.save_progress, job, delivered=delivery.sent)
+    raise RuntimeError(f"result not delivered to chat {job.chat_id} ({delivery.sent} parts sent)")
+
+async def run_generation_job(job: Job) -> None:
+    """Задача generate: генерация → списание → доставка с кнопками."""
+    uid, chat_id = job.user_id, job.chat_id
+    ctype = job.payload["content_type"]
+    prompt = job.payload["prompt"]
+    mode = job.payload.get("mode", "new")
+    
+    # Повтор после сбоя доставки: генерация уже сохранена и оплачена
+    if job.result_id:
+        item = generations.get(job.result_id, uid)
+        if item:
+            await deliver_job_result(job, item.content, after_generation_kb(item.id))
+            return
+    
+    # Лимит проверен при постановке, но задачи юзера могли накопиться
+    has_limit, used, limit = check_generation_limit(uid)
+    if not has_limit:
+        await bot.send_message(chat_id, f"❌ Лимит исчерпан ({used}/{limit}).")
+        return
+    
+    result = None
+    if mode == "regen":
+        # Предгенерированный вариант (если есть) — без повторного запроса к YandexGPT
+        result = await variants.take(uid, prompt_key(ctype, prompt))
+        if result:
+            result.cache_hit = True
+    if not result:
+        result = await gpt.generate(prompt, ctype, job.payload.get("tier", "free"))
+    
+    if not result:
+        await bot.send_message(chat_id, GENERATION_ERRORS.get(mode, GENERATION_ERRORS["new"]))
+        return
+    
+    generation_id = commit_generation(uid, ctype, prompt, result, job)
+    
+    await deliver_job_result(job, result.text, after_generation_kb(generation_id))
+    prefetch_variant(uid, ctype, prompt)
+
+async def run_style_job(job: Job) -> None:
+    """Задача style_analysis: анализ примеров и сохранение стиля автора."""
+    uid, chat_id = job.user_id, job.chat_id
+    
+    if not job.result_id:
+        result = await gpt.generate(job.payload["prompt"], "style_analysis", job.payload.get("tier", "free"))
+        if not result:
+            await bot.send_message(chat_id, "❌ Не удалось проанализировать стиль.")
+            return
+        
+        increment_generation_counter(uid)
+        record_generation_metrics(None, uid, "style_analysis", result)
+        save_user_style(uid, result.text)
+        # Сам стиль лежит в user_settings; отметка нужна, чтобы повтор не списал лимит снова
+        jobs.set_result(job, 1)
+    
+    await deliver_job_result(
+        job,
+        "✅ Стиль сохранён!\n\n"
+        f"{get_user_style(uid)}\n\n"
+        "Теперь генерация будет учитывать твой стиль."
+    )
+
+jobs.register("generate", run_generation_job)
+jobs.register("style_analysis", run_style_job)
 
 # =============================================================================
 # FASTAPI ENDPOINTS (для Render HTTP сервера)
 # =============================================================================
 
-@app.get("/health")
+@app.api_route("/health", methods=["GET", "HEAD", "POST"])
 async def health_check():
-    """Health check для Render."""
-    return {"status": "ok", "bot": "running", "port": PORT}
+    """Health check для Render (GET, HEAD, POST)."""
+    # Без запросов к БД: проба идёт часто, глубина очереди — в админ-статистике
+    return {"status": "ok", "service": "ContentGPT Bot", "port": PORT}
 
 @app.get("/")
 async def root():
     """Root endpoint."""
-    return {"message": "CONTENTGPT BOT is running"}
+    return {"status": "ok", "service": "ContentGPT Bot"}
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    """Webhook для Telegram (опционально, сейчас работает polling)."""
+    """Webhook для Telegram (проверка secret token из set_webhook)."""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, settings.WEBHOOK_SECRET):
+        logger.warning("⚠️ Webhook: неверный secret token")
+        return Response(status_code=403)
+    
+    if shard_router is not None:
+        return route_raw_update(await request.body())
+    
     try:
         update_data = await request.json()
-        update = Update(**update_data)
-        await dp.feed_update(bot, update)
+        update = Update.model_validate(update_data, context={"bot": bot})
+    except Exception as e:
+        logger.error(f"❌ Webhook error: {e}")
+        return {"ok": False}
+    
+    # Очередь полна — пусть Telegram повторит позже (апдейт ещё не помечен как увиденный)
+    if update_pool.full:
+        logger.warning("⚠️ Очередь апдейтов переполнена, update {} отклонён", update.update_id)
+        return Response(status_code=503)
+    
+    if update_dedup.seen(update.update_id):
+        logger.debug(f"🔁 Повторная доставка update {update.update_id} — пропуск")
         return {"ok": True}
+    
+    # Ответ Telegram сразу, обработка — в пуле воркеров
+    update_pool.submit(update)
+    return {"ok": True}
+
+def route_raw_update(raw: bytes):
+    """Фронт-процесс: апдейт — в очередь процесса-воркера его пользователя."""
+    try:
+        data = json.loads(raw)
+        update_id = int(data["update_id"])
     except Exception as e:
         logger.error(f"❌ Webhook error: {e}")
         return {"ok": False}
+    
+    if update_dedup.seen(update_id):
+        return {"ok": True}
+    
+    if not shard_router.route(update_user_id(data), raw):
+        # Не помечаем как увиденный: Telegram повторит доставку
+        update_dedup.forget(update_id)
+        logger.warning("⚠️ Очередь шарда переполнена, update {} отклонён", update_id)
+        return Response(status_code=503)
+    return {"ok": True}
+
+@app.post("/webhook/yandex-kassa")
+async def yandex_kassa_webhook(request: Request):
+    """Webhook платежей ЮKassa: подписка активируется без опроса статуса."""
+    ip = kassa_guard.client_ip(
+        request.client.host if request.client else None,
+        request.headers.get("X-Forwarded-For"),
+    )
+    if not kassa_guard.allowed(ip, request.query_params.get("secret", "")):
+        logger.warning(f"⚠️ Kassa webhook: отклонён запрос с {ip}")
+        return Response(status_code=403)
+    
+    try:
+        event = await request.json()
+        payment_id = str((event.get("object") or {})["id"])
+    except Exception as e:
+        logger.error(f"❌ Kassa webhook: некорректное уведомление: {e}")
+        return Response(status_code=400)
+    
+    logger.info(f"🔔 Kassa webhook: {event.get('event')} {payment_id}")
+    if not event.get("event", "").startswith("payment."):
+        return {"status": "ignored"}
+    
+    try:
+        local = await asyncio.to_thread(payment_store.get, "yookassa", payment_id)
+        if local is None:
+            logger.warning(f"⚠️ Kassa webhook: неизвестный платёж {payment_id}")
+            return {"status": "ok"}
+        if local.status in FINAL_STATUSES:
+            return {"status": "ok"}
+        # Статусу из тела не верим: уведомление можно подделать, API — нет
+        status = (await kassa_client.get_payment(payment_id)).get("status", "")
+        result = await asyncio.to_thread(payment_store.transition, "yookassa", payment_id, status)
+    except YooKassaError as e:
+        # Не 200 — ЮKassa повторит уведомление
+        logger.error(f"❌ Kassa webhook: не удалось проверить платёж {payment_id}: {e}")
+        return Response(status_code=503)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Kassa webhook: ошибка БД: {e}")
+        return Response(status_code=500)
+    
+    if result is not None and result.changed:
+        await notify_payment(result)
+    return {"status": "ok"}
+
+def payment_result_text(result: PaymentTransition) -> str:
+    """Сообщение пользователю о результате платежа."""
+    if result.status != "completed":
+        return "❌ Платёж отменён. Можно оплатить заново в разделе 💎 Подписки."
+    plan = SUBSCRIPTION_PLANS.get(result.subscription_type, {})
+    return (
+        "✅ Платёж подтверждён!\n\n"
+        f"Активирована подписка: {plan.get('emoji', '')} {plan.get('name', result.subscription_type)}\n"
+        f"Срок: {payment_store.subscription_days} дней\n\n"
+        "Можешь пользоваться генерацией."
+    )
+
+async def send_renewal_reminder(user_id: int, sub_type: str, until: str) -> bool:
+    """Напоминание о скором окончании подписки (False — чат недоступен; прочие ошибки — наружу, на повтор)."""
+    plan = SUBSCRIPTION_PLANS.get(sub_type, {})
+    try:
+        await bot.send_message(
+            user_id,
+            f"🔔 Подписка {plan.get('emoji', '')} {plan.get('name', sub_type)} "
+            f"заканчивается {until[:16].replace('T', ' ')}.\n\n"
+            "Продлить можно в разделе 💎 Подписки — оставшиеся дни сохранятся."
+        )
+        return True
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Бот заблокирован / чат удалён — повтор не поможет
+        logger.info(f"🚫 Напоминание {user_id} не доставлено: {e}")
+        return False
+
+async def notify_payment(result: PaymentTransition) -> None:
+    """Push пользователю после смены статуса платежа."""
+    if not result.user_id:
+        return
+    try:
+        await bot.send_message(result.user_id, payment_result_text(result))
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось уведомить {result.user_id} о платеже: {e}")
 
 # =============================================================================
 # HANDLERS: START / HELP / BASIC
@@ -687,6 +1574,7 @@ async def cmd_start(message: Message):
     first_name = message.from_user.first_name or "Пользователь"
     
     get_or_create_user(uid, username, first_name)
+    reactivate_user(uid)
     
     is_admin = is_user_admin(uid)
     has_limit, used, limit = check_generation_limit(uid)
@@ -701,6 +1589,27 @@ async def cmd_start(message: Message):
     
     await message.answer(text, reply_markup=bottom_keyboard(is_admin))
 
+@router.my_chat_member()
+async def on_my_chat_member(event: ChatMemberUpdated):
+    """Блокировка/разблокировка бота в личке (апдейт приходит в процесс шарда пользователя)."""
+    if event.chat.type != "private":
+        return
+    uid = event.from_user.id
+    if event.new_chat_member.status == "kicked":
+        forget_active_users([uid])
+        try:
+            conn = get_db_connection()
+            conn.execute(
+                "UPDATE users SET is_active = 0, updated_at = datetime('now') WHERE user_id = ?",
+                (uid,)
+            )
+            conn.commit()
+            conn.close()
+        except sqlite3.OperationalError as e:
+            logger.error(f"❌ Ошибка деактивации юзера {uid}: {e}")
+    elif event.new_chat_member.status == "member":
+        reactivate_user(uid)
+
 @router.message(Command("help"))
 async def cmd_help(message: Message):
     """Обработчик /help."""
@@ -943,19 +1852,17 @@ async def pay_yookassa(query: CallbackQuery):
     await query.answer("⏳ Создаю платёж...")
     
     try:
-        payment = await asyncio.to_thread(
-            kassa.create_payment,
+        # order_id — ключ идемпотентности: повтор запроса не создаст второй платёж
+        payment = await kassa_client.create_payment(
             amount,
             f"Подписка {plan.get('name', sub_type)}",
-            order_id
+            return_url=settings.PAYMENT_RETURN_URL,
+            metadata={"order_id": order_id, "user_id": str(uid), "subscription_type": sub_type},
+            idempotence_key=order_id,
         )
         
-        if not payment or payment.get("status") != "success":
-            await query.message.edit_text(f"❌ Не удалось создать платёж.\n{payment}")
-            return
-        
-        payment_id = payment.get("payment_id")
-        url = payment.get("confirmation_url")
+        payment_id = payment.get("id")
+        url = (payment.get("confirmation") or {}).get("confirmation_url")
         
         if not payment_id or not url:
             await query.message.edit_text("❌ Ошибка: нет payment_id/confirmation_url в ответе.")
@@ -964,9 +1871,9 @@ async def pay_yookassa(query: CallbackQuery):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO payments (user_id, provider, external_id, order_id, subscription_type, amount, currency, status)
-            VALUES (?, 'yookassa', ?, ?, ?, ?, 'RUB', 'pending')
-        """, (uid, str(payment_id), order_id, sub_type, amount))
+            INSERT INTO payments (user_id, provider, external_id, order_id, subscription_type, amount, currency, status, next_check_at)
+            VALUES (?, 'yookassa', ?, ?, ?, ?, 'RUB', 'pending', ?)
+        """, (uid, str(payment_id), order_id, sub_type, amount, time.time() + settings.PAYMENT_CHECK_BACKOFF))
         conn.commit()
         conn.close()
         
@@ -979,9 +1886,12 @@ async def pay_yookassa(query: CallbackQuery):
             "💳 Оплата через YooKassa\n\n"
             f"План: {plan.get('emoji', '')} {plan.get('name', sub_type)}\n"
             f"Сумма: {amount} ₽\n\n"
-            "После оплаты вернись в чат и нажми «✅ Я оплатил».",
+            "Подписка активируется автоматически после оплаты.\n"
+            "Если сообщения нет — нажми «✅ Я оплатил».",
             reply_markup=kb
         )
+    except YooKassaError as e:
+        await query.message.edit_text(f"❌ Не удалось создать платёж: {e.description[:200]}")
     except Exception as e:
         logger.error(f"❌ Ошибка создания платежа: {e}")
         await query.message.edit_text(f"❌ Ошибка: {str(e)[:100]}")
@@ -992,47 +1902,35 @@ async def pay_yookassa_check(query: CallbackQuery):
     uid = query.from_user.id
     
     try:
-        _, rest = query.data.split("pay:ykcheck:", 1)
-        payment_id, sub_type = rest.split(":", 1)
-        
-        await query.answer("⏳ Проверяю платёж...")
+        payment_id = query.data.split("pay:ykcheck:", 1)[1].split(":", 1)[0]
         
-        status_resp = await asyncio.to_thread(kassa.get_payment_status, payment_id)
-        
-        if not status_resp or status_resp.get("status") != "success":
-            await query.answer("❌ Не удалось проверить платёж", show_alert=True)
+        # Быстрый путь: платёж уже проведён (webhook/сверка) — без API и записей
+        local = await asyncio.to_thread(payment_store.get, "yookassa", payment_id)
+        if local is None or local.user_id != uid:
+            await query.answer("❌ Платёж не найден", show_alert=True)
+            return
+        if local.status in FINAL_STATUSES:
+            await query.answer()
+            await query.message.edit_text(payment_result_text(local))
             return
         
-        pay_status = status_resp.get("payment_status")
+        try:
+            pay_status = await payment_statuses.status(payment_id)
+        except YooKassaError:
+            await query.answer("❌ Не удалось проверить платёж, попробуй через минуту", show_alert=True)
+            return
         
-        if pay_status not in ("succeeded", "waiting_for_capture"):
+        if pay_status not in PROVIDER_STATUS:
             await query.answer(
                 f"Статус: {pay_status}. Если только оплатил — подожди 10–20 сек и нажми ещё раз.",
                 show_alert=True
             )
             return
         
-        update_subscription(uid, sub_type, days=30)
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE payments SET status='completed', updated_at=datetime('now')
-            WHERE user_id=? AND provider='yookassa' AND external_id=?
-        """, (uid, str(payment_id)))
-        conn.commit()
-        conn.close()
-        
-        plan = SUBSCRIPTION_PLANS.get(sub_type, {})
-        
-        await query.message.edit_text(
-            "✅ Платёж подтверждён!\n\n"
-            f"Активирована подписка: {plan.get('emoji', '')} {plan.get('name', sub_type)}\n"
-            "Срок: 30 дней\n\n"
-            "Можешь пользоваться генерацией."
-        )
-        
-        await query.answer("✅ Готово")
+        # Та же транзакция, что и у webhook: подписка активируется один раз
+        result = await asyncio.to_thread(payment_store.transition, "yookassa", payment_id, pay_status)
+        await query.answer()
+        await query.message.edit_text(payment_result_text(result or local))
     except Exception as e:
         logger.error(f"❌ Ошибка проверки платежа: {e}")
         await query.answer(f"❌ Ошибка: {str(e)[:100]}", show_alert=True)
@@ -1097,18 +1995,16 @@ async def successful_payment(message: Message):
             await message.answer("✅ Платёж получен, но не удалось определить план (payload).")
             return
         
-        update_subscription(uid, sub_type, days=30)
-        
         amount = float(sp.total_amount)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO payments (user_id, provider, external_id, order_id, subscription_type, amount, currency, status)
-            VALUES (?, 'telegram_stars', ?, NULL, ?, ?, 'XTR', 'completed')
-        """, (uid, sp.telegram_payment_charge_id, sub_type, amount))
-        conn.commit()
-        conn.close()
+        # Повтор того же платежа (повторная доставка апдейта) период не продлевает
+        granted = await asyncio.to_thread(
+            payment_store.record_completed,
+            uid, "telegram_stars", sp.telegram_payment_charge_id, sub_type, amount, "XTR",
+        )
+        if not granted:
+            await message.answer("✅ Этот платёж уже учтён.")
+            return
         
         plan = SUBSCRIPTION_PLANS.get(sub_type, {})
         
@@ -1216,35 +2112,15 @@ async def post_cta(message: Message, state: FSMContext):
     audience = data.get("audience", "")
     cta = message.text.strip()
     
-    user_style = get_user_style(uid)
-    style_note = f"\nСтиль автора (учти): {user_style}\n" if user_style else ""
-    
-    prompt = (
-        f"Создай пост для соцсетей.\n"
-        f"Тема: {topic}\n"
-        f"Аудитория: {audience}\n"
-        f"Стиль: {style}\n"
-        f"CTA: {cta}\n"
-        f"Длина: 800–1200 знаков.\n"
-        f"Добавь структуру (абзацы/списки), эмодзи уместно.\n"
-        f"{style_note}"
+    prompt = render_prompt(
+        "post", get_user_style(uid),
+        topic=topic, audience=audience, style=style, cta=cta,
     )
     
-    await message.answer("⏳ Генерирую...")
-    
-    text = await gpt.generate(prompt, "post")
-    
-    if not text:
-        await message.answer("❌ Не удалось сгенерировать. Проверь YANDEX_GPT_API_KEY/FOLDER_ID.")
-        await state.clear()
-        return
-    
-    increment_generation_counter(uid)
-    save_generation(uid, "post", prompt, text)
-    last_content[uid] = {"content_type": "post", "prompt": prompt, "content": text}
-    
-    await message.answer(text, reply_markup=after_generation_kb())
     await state.clear()
+    await message.answer("⏳ Генерирую...")
+    if enqueue_generation(uid, message.chat.id, "post", prompt) is None:
+        await message.answer("❌ Не удалось поставить генерацию в очередь. Попробуй ещё раз.")
 
 # ---------- STORY GENERATION ----------
 
@@ -1260,30 +2136,12 @@ async def story_vector(message: Message, state: FSMContext):
         return
     
     vector = message.text.strip()
-    user_style = get_user_style(uid)
-    style_note = f"\nСтиль автора (учти): {user_style}\n" if user_style else ""
-    
-    prompt = (
-        f"Сгенерируй сценарий сторис.\n"
-        f"Цель/вектор: {vector}\n"
-        f"Формат: 5–7 слайдов, на каждом: текст + что показать + вопрос/CTA.\n"
-        f"{style_note}"
-    )
-    
-    await message.answer("⏳ Генерирую...")
-    text = await gpt.generate(prompt, "story")
-    
-    if not text:
-        await message.answer("❌ Не удалось сгенерировать. Проверь YANDEX_GPT_API_KEY/FOLDER_ID.")
-        await state.clear()
-        return
+    prompt = render_prompt("story", get_user_style(uid), vector=vector)
     
-    increment_generation_counter(uid)
-    save_generation(uid, "story", prompt, text)
-    last_content[uid] = {"content_type": "story", "prompt": prompt, "content": text}
-    
-    await message.answer(text, reply_markup=after_generation_kb())
     await state.clear()
+    await message.answer("⏳ Генерирую...")
+    if enqueue_generation(uid, message.chat.id, "story", prompt) is None:
+        await message.answer("❌ Не удалось поставить генерацию в очередь. Попробуй ещё раз.")
 
 # ---------- IDEAS GENERATION ----------
 
@@ -1299,30 +2157,12 @@ async def ideas_theme(message: Message, state: FSMContext):
         return
     
     theme = message.text.strip()
-    user_style = get_user_style(uid)
-    style_note = f"\nСтиль автора (учти): {user_style}\n" if user_style else ""
-    
-    prompt = (
-        f"Дай 10 идей контента.\n"
-        f"Тема/ниша: {theme}\n"
-        f"Сделай идеи разными по формату: пост, сторис, рилс, карусель, опрос.\n"
-        f"{style_note}"
-    )
-    
-    await message.answer("⏳ Генерирую...")
-    text = await gpt.generate(prompt, "ideas")
+    prompt = render_prompt("ideas", get_user_style(uid), theme=theme)
     
-    if not text:
-        await message.answer("❌ Не удалось сгенерировать. Проверь YANDEX_GPT_API_KEY/FOLDER_ID.")
-        await state.clear()
-        return
-    
-    increment_generation_counter(uid)
-    save_generation(uid, "ideas", prompt, text)
-    last_content[uid] = {"content_type": "ideas", "prompt": prompt, "content": text}
-    
-    await message.answer(text, reply_markup=after_generation_kb())
     await state.clear()
+    await message.answer("⏳ Генерирую...")
+    if enqueue_generation(uid, message.chat.id, "ideas", prompt) is None:
+        await message.answer("❌ Не удалось поставить генерацию в очередь. Попробуй ещё раз.")
 
 # ---------- CAPTION GENERATION ----------
 
@@ -1351,31 +2191,12 @@ async def caption_task(message: Message, state: FSMContext):
     
     data = await state.get_data()
     task = message.text.strip()
-    user_style = get_user_style(uid)
-    style_note = f"\nСтиль автора (учти): {user_style}\n" if user_style else ""
-    
-    prompt = (
-        "Сгенерируй подпись к посту в соцсетях.\n"
-        "Дай 2 версии: формальная и неформальная.\n"
-        "Добавь 10 хештегов.\n"
-        f"ТЗ пользователя: {task}\n"
-        f"{style_note}"
-    )
+    prompt = render_prompt("caption", get_user_style(uid), task=task)
     
-    await message.answer("⏳ Генерирую...")
-    text = await gpt.generate(prompt, "caption")
-    
-    if not text:
-        await message.answer("❌ Не удалось сгенерировать. Проверь YANDEX_GPT_API_KEY/FOLDER_ID.")
-        await state.clear()
-        return
-    
-    increment_generation_counter(uid)
-    save_generation(uid, "caption", prompt, text)
-    last_content[uid] = {"content_type": "caption", "prompt": prompt, "content": text}
-    
-    await message.answer(text, reply_markup=after_generation_kb())
     await state.clear()
+    await message.answer("⏳ Генерирую...")
+    if enqueue_generation(uid, message.chat.id, "caption", prompt) is None:
+        await message.answer("❌ Не удалось поставить генерацию в очередь. Попробуй ещё раз.")
 
 # ---------- STYLE ANALYSIS ----------
 
@@ -1392,54 +2213,35 @@ async def style_examples(message: Message, state: FSMContext):
     
     examples = message.text.strip()
     
-    prompt = (
-        "Проанализируй стиль автора по примерам.\n"
-        "Скажи: тон, структура, длина, любимые приемы, 3-5 характерных фраз.\n"
-        "Ответ: 3-5 предложений + 5 буллетов.\n\n"
-        f"ПРИМЕРЫ:\n{examples}"
-    )
-    
-    await message.answer("⏳ Анализирую стиль...")
-    style = await gpt.generate(prompt, "style_analysis")
-    
-    if not style:
-        await message.answer("❌ Не удалось проанализировать стиль.")
-        await state.clear()
-        return
-    
-    increment_generation_counter(uid)
-    save_user_style(uid, style)
-    
-    await message.answer(
-        "✅ Стиль сохранён!\n\n"
-        f"{style}\n\n"
-        "Теперь генерация будет учитывать твой стиль."
-    )
+    prompt = render_prompt("style_analysis", examples=examples)
     
     await state.clear()
+    await message.answer("⏳ Анализирую стиль...")
+    if enqueue_generation(uid, message.chat.id, "style_analysis", prompt) is None:
+        await message.answer("❌ Не удалось поставить анализ в очередь. Попробуй ещё раз.")
 
 # =============================================================================
 # HANDLERS: CONTENT ACTIONS (save/edit/regen)
 # =============================================================================
 
-@router.callback_query(F.data == "content:save")
+@router.callback_query(F.data.startswith("content:save"))
 async def content_save(query: CallbackQuery):
     """Сохранение контента."""
     uid = query.from_user.id
-    item = last_content.get(uid)
+    item = generation_for_callback(query)
     
     if not item:
         await query.answer("Нет контента для сохранения", show_alert=True)
         return
     
-    save_content(uid, item["content_type"], item["prompt"], item["content"])
+    save_content(uid, item.content_type, item.prompt, item.content)
     await query.answer("✅ Сохранено")
 
-@router.callback_query(F.data == "content:regen")
+@router.callback_query(F.data.startswith("content:regen"))
 async def content_regen(query: CallbackQuery):
     """Перегенерация контента."""
     uid = query.from_user.id
-    item = last_content.get(uid)
+    item = generation_for_callback(query)
     
     if not item:
         await query.answer("Нет контента для перегенерации", show_alert=True)
@@ -1450,32 +2252,28 @@ async def content_regen(query: CallbackQuery):
         await query.answer(f"❌ Лимит исчерпан ({used}/{limit})", show_alert=True)
         return
     
-    await query.answer("⏳ Генерирую ещё вариант...")
-    text = await gpt.generate(item["prompt"], item["content_type"])
-    
-    if not text:
-        await query.message.answer("❌ Не удалось перегенерировать.")
+    job_id = enqueue_generation(uid, query.message.chat.id, item.content_type, item.prompt, mode="regen")
+    if job_id is None:
+        await query.answer("❌ Не удалось поставить генерацию в очередь", show_alert=True)
+        return
+    if not job_id:
+        await query.answer("⏳ Уже генерирую вариант — он скоро придёт")
         return
     
-    increment_generation_counter(uid)
-    save_generation(uid, item["content_type"], item["prompt"], text)
-    last_content[uid]["content"] = text
-    
-    await query.message.answer(text, reply_markup=after_generation_kb())
+    await query.answer("⏳ Генерирую ещё вариант...")
 
-@router.callback_query(F.data == "content:edit")
+@router.callback_query(F.data.startswith("content:edit"))
 async def content_edit(query: CallbackQuery, state: FSMContext):
     """Редактирование контента."""
-    uid = query.from_user.id
-    item = last_content.get(uid)
+    item = generation_for_callback(query)
     
     if not item:
         await query.answer("Нет контента для правок", show_alert=True)
         return
     
     await state.update_data(
-        edit_base_prompt=item["prompt"],
-        edit_content_type=item["content_type"]
+        edit_base_prompt=item.prompt,
+        edit_content_type=item.content_type
     )
     
     await query.message.answer("✏️ Напиши, какие правки внести (тон, структура, длина, что добавить/убрать).")
@@ -1498,22 +2296,12 @@ async def edit_apply(message: Message, state: FSMContext):
     ctype = data.get("edit_content_type", "post")
     instr = message.text.strip()
     
-    prompt = base_prompt + "\n\nВнеси правки (обязательно): " + instr
-    
-    await message.answer("⏳ Применяю правки...")
-    text = await gpt.generate(prompt, ctype)
-    
-    if not text:
-        await message.answer("❌ Не удалось применить правки.")
-        await state.clear()
-        return
+    prompt = render_edit_prompt(ctype, base_prompt, instr)
     
-    increment_generation_counter(uid)
-    save_generation(uid, ctype, prompt, text)
-    last_content[uid] = {"content_type": ctype, "prompt": prompt, "content": text}
-    
-    await message.answer(text, reply_markup=after_generation_kb())
     await state.clear()
+    await message.answer("⏳ Применяю правки...")
+    if enqueue_generation(uid, message.chat.id, ctype, prompt, mode="edit") is None:
+        await message.answer("❌ Не удалось поставить правки в очередь. Попробуй ещё раз.")
 
 # =============================================================================
 # HANDLERS: ADMIN
@@ -1529,6 +2317,23 @@ async def admin_panel(message: Message):
         return
     
     stats = admin_stats()
+    depth = jobs.depth()
+    
+    usage_lines = ""
+    for ctype, tier, gens, tok_in, tok_out, latency_total, cache_hits in generation_stats_today():
+        avg_latency = int(latency_total / gens) if gens else 0
+        usage_lines += (
+            f"• {ctype}/{tier}: {gens} шт, токены {tok_in}→{tok_out}, "
+            f"~{avg_latency} мс, кэш {cache_hits}\n"
+        )
+    
+    routing_lines = ""
+    for row in gpt.router.stats.snapshot()[:10]:
+        routing_lines += (
+            f"• {row['model']} {row['content_type']}/{row['tier']}: "
+            f"ok {row['ok']}, ошибок {row['fail']}, fallback {row['fallback']}, "
+            f"~{row['avg_latency'] or 0}с\n"
+        )
     
     await message.answer(
         "👨💼 Админ-панель\n\n"
@@ -1537,74 +2342,304 @@ async def admin_panel(message: Message):
         f"Генераций: {stats['generations']}\n"
         f"Платежей (completed): {stats['completed_payments']}\n"
         f"Выручка (условно): {stats['revenue']}\n"
+        f"Очередь генераций: {depth['queued']} ждут, {depth['leased']} в работе\n"
+        + (f"\n📊 Генерации сегодня:\n{usage_lines}" if usage_lines else "")
+        + (f"\n🧭 Модели (с запуска):\n{routing_lines}" if routing_lines else "")
+        + "\n📣 Рассылка: /broadcast"
     )
 
-# ==================== FastAPI Web Server ====================
-from fastapi import FastAPI
-import uvicorn
+def broadcast_audience_kb() -> InlineKeyboardMarkup:
+    """Выбор аудитории рассылки (с числом получателей)."""
+    rows = []
+    for key, (_, label) in AUDIENCES.items():
+        count = broadcaster.count_audience(key)
+        rows.append([InlineKeyboardButton(text=f"{label} ({count})", callback_data=f"bc:aud:{key}")])
+    rows.append([InlineKeyboardButton(text="❌ Отмена", callback_data="bc:abort")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, state: FSMContext):
+    """Начать рассылку: выбор аудитории."""
+    if not is_user_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещён.")
+        return
+    
+    await state.clear()
+    await message.answer("📣 Кому отправить рассылку?", reply_markup=broadcast_audience_kb())
 
-app = FastAPI()
+@router.callback_query(F.data.startswith("bc:aud:"))
+async def broadcast_audience(query: CallbackQuery, state: FSMContext):
+    """Аудитория выбрана — ждём сообщение."""
+    if not is_user_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещён", show_alert=True)
+        return
+    
+    audience = query.data.split("bc:aud:")[1]
+    if audience not in AUDIENCES:
+        await query.answer("❌ Неизвестная аудитория", show_alert=True)
+        return
+    
+    await state.set_state(BroadcastStates.waiting_message)
+    await state.update_data(audience=audience)
+    await query.message.edit_text(
+        f"📣 Аудитория: {AUDIENCES[audience][1]}\n\n"
+        "Отправь сообщение для рассылки (текст, фото, видео…) — оно будет скопировано получателям.\n"
+        "/cancel — отмена."
+    )
+    await query.answer()
 
-PORT = int(os.getenv("PORT", 10000))
+@router.callback_query(F.data == "bc:abort")
+async def broadcast_abort(query: CallbackQuery, state: FSMContext):
+    """Отмена на шаге выбора аудитории."""
+    await state.clear()
+    await query.message.edit_text("❌ Рассылка отменена.")
+    await query.answer()
 
-@app.get("/")
-async def root():
-    return {"status": "ok", "service": "ContentGPT Bot"}
+@router.message(BroadcastStates.waiting_message)
+async def broadcast_message(message: Message, state: FSMContext):
+    """Сообщение получено — создаём черновик и просим подтверждение."""
+    data = await state.get_data()
+    await state.clear()
+    
+    if message.text == "/cancel":
+        await message.answer("❌ Рассылка отменена.")
+        return
+    
+    audience = data.get("audience", "features")
+    broadcast_id = await asyncio.to_thread(
+        broadcaster.create,
+        audience,
+        message.chat.id,
+        message.chat.id,
+        message.message_id,
+        message.text or message.caption or "",
+    )
+    row = await asyncio.to_thread(broadcaster.get, broadcast_id)
+    
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id}: {AUDIENCES[audience][1]}\n"
+        f"Получателей: {row['total']}\n\n"
+        "Сообщение выше будет скопировано каждому. Запускаем?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🚀 Запустить", callback_data=f"bc:go:{broadcast_id}")],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data=f"bc:cancel:{broadcast_id}")],
+        ])
+    )
 
-@app.api_route("/health", methods=["GET", "HEAD", "POST"])
-async def health():
-    """Health check - accepts GET, HEAD, POST"""
-    return {"status": "ok", "service": "ContentGPT Bot"}
+@router.callback_query(F.data.startswith("bc:go:"))
+async def broadcast_go(query: CallbackQuery):
+    """Запуск рассылки; прогресс обновляется в этом же сообщении."""
+    if not is_user_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещён", show_alert=True)
+        return
+    
+    broadcast_id = int(query.data.split("bc:go:")[1])
+    if not await broadcaster.start(broadcast_id, query.message.message_id):
+        await query.answer("⚠️ Рассылка уже запущена или отменена", show_alert=True)
+        return
+    
+    await query.answer("🚀 Рассылка запущена")
+    row = await asyncio.to_thread(broadcaster.get, broadcast_id)
+    if row and row["status"] == "running":
+        await query.message.edit_text(
+            broadcaster.progress_text(row),
+            reply_markup=broadcaster.cancel_kb(broadcast_id)
+        )
 
-@app.post("/webhook/yandex-kassa")
-async def yandex_kassa_webhook(request: dict):
-    """Webhook платежей от Yandex.Kassa"""
-    logger.info(f"🔔 Kassa webhook: {request}")
-    return {"status": "received"}
-
-def run_fastapi():
-    """Запуск FastAPI в отдельном потоке"""
-    logger.info(f"🌐 FastAPI на 0.0.0.0:{PORT}")
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=PORT,
-        log_level="info"
-    )
+@router.callback_query(F.data.startswith("bc:cancel:"))
+async def broadcast_cancel(query: CallbackQuery):
+    """Остановка рассылки или отмена черновика."""
+    if not is_user_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещён", show_alert=True)
+        return
+    
+    broadcast_id = int(query.data.split("bc:cancel:")[1])
+    if not await broadcaster.cancel(broadcast_id):
+        await query.answer("⚠️ Рассылка уже завершена")
+        return
+    
+    if not broadcaster.is_running(broadcast_id):
+        await query.message.edit_text(f"⏹ Рассылка #{broadcast_id} отменена.")
+    await query.answer("⏹ Останавливаю…")
 
 # =============================================================================
 # MAIN
 # =============================================================================
 
+async def setup_webhook() -> bool:
+    """Зарегистрировать webhook в Telegram. False — работаем через polling."""
+    if settings.BOT_MODE == "polling":
+        return False
+    
+    if not settings.WEBHOOK_BASE_URL:
+        if settings.BOT_MODE == "webhook":
+            logger.warning("⚠️ BOT_MODE=webhook, но WEBHOOK_BASE_URL не задан — запускаю polling")
+        return False
+    
+    url = settings.WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+    try:
+        await bot.set_webhook(
+            url=url,
+            secret_token=settings.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"🔗 Webhook установлен: {settings.WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Не удалось установить webhook ({e}) — запускаю polling")
+        return False
+
 async def main():
-    """Запуск бота с polling"""
-    logger.info("✅ Bot initialized and ready to poll")
+    """Запуск бота: webhook (FastAPI + Dispatcher в одном event loop) или polling."""
+    await metrics_writer.start()
+    await fsm_storage.start()
+    await jobs.start()
+    await scheduler.start()
     
-    # Запускаем FastAPI в отдельном потоке
-    api_thread = threading.Thread(target=run_fastapi, daemon=True)
-    api_thread.start()
-    logger.info(f"📍 FastAPI сервер запущен на 0.0.0.0:{PORT}")
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=PORT, log_level="info"))
     
     try:
-        logger.info("🚀 Starting bot polling...")
-        await dp.start_polling(bot)
+        if await setup_webhook():
+            logger.info(f"🚀 Webhook-режим, FastAPI на 0.0.0.0:{PORT}")
+            await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+            await update_pool.start()
+            try:
+                # uvicorn сам обрабатывает SIGINT/SIGTERM
+                await server.serve()
+            finally:
+                await update_pool.stop()
+                await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+        else:
+            # Polling: HTTP-сервер (health) работает задачей в том же event loop,
+            # сигналы обрабатывает start_polling
+            server.install_signal_handlers = lambda: None
+            server_task = asyncio.create_task(server.serve())
+            logger.info(f"📍 FastAPI сервер запущен на 0.0.0.0:{PORT}")
+            
+            try:
+                logger.info("🚀 Starting bot polling...")
+                await bot.delete_webhook(drop_pending_updates=False)
+                await dp.start_polling(bot)
+            finally:
+                server.should_exit = True
+                await server_task
     except Exception as e:
-        logger.error(f"❌ Error in polling: {e}")
+        logger.error(f"❌ Error in bot loop: {e}")
         raise
     finally:
+        await scheduler.stop()
+        await broadcaster.stop()
+        await jobs.stop()
+        await kassa_client.close()
+        await fsm_storage.close()
+        await metrics_writer.close()
         await bot.session.close()
         logger.info("🛑 Bot session closed")
 
 
+async def worker_main(index: int, updates_queue) -> None:
+    """Процесс-воркер: обрабатывает апдейты своего шарда из очереди фронта."""
+    logger.info(f"🧩 Воркер {index} запущен (pid {os.getpid()})")
+    # Глобальный лимит Telegram делится между процессами
+    outbound_limiter.set_global_rate(settings.TG_GLOBAL_RATE / settings.BOT_WORKERS)
+    # Задачи пользователя — в процессе, где его апдейты и кэши (ShardRouter: user_id % N)
+    jobs.set_shard(index, settings.BOT_WORKERS)
+    
+    await metrics_writer.start()
+    await fsm_storage.start()
+    await jobs.start()
+    await scheduler.start()
+    await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+    await update_pool.start()
+    
+    try:
+        while True:
+            raw = await asyncio.to_thread(updates_queue.get)
+            if raw is None:
+                break
+            try:
+                update = Update.model_validate_json(raw, context={"bot": bot})
+            except Exception as e:
+                logger.error(f"❌ Воркер {index}: некорректный апдейт: {e}")
+                continue
+            await update_pool.queue.put(update)
+    finally:
+        await update_pool.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+        await scheduler.stop()
+        await broadcaster.stop()
+        await jobs.stop()
+        await kassa_client.close()
+        await fsm_storage.close()
+        await metrics_writer.close()
+        await bot.session.close()
+        logger.info(f"🛑 Воркер {index} остановлен")
+
+def run_worker(index: int, updates_queue) -> None:
+    asyncio.run(worker_main(index, updates_queue))
+
+async def front_main() -> None:
+    """Фронт-процесс: принимает апдейты (webhook или polling) и раздаёт воркерам."""
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=PORT, log_level="info"))
+    
+    try:
+        if await setup_webhook():
+            logger.info(f"🚀 Webhook-режим ({settings.BOT_WORKERS} процессов), FastAPI на 0.0.0.0:{PORT}")
+            await server.serve()
+            return
+        
+        server.install_signal_handlers = lambda: None
+        server_task = asyncio.create_task(server.serve())
+        logger.info(f"🚀 Polling-режим ({settings.BOT_WORKERS} процессов)")
+        # Воркеры игнорируют сигналы: SIGTERM/SIGINT прерывают polling, а остановку
+        # воркеров (stop_workers в __main__) делает фронт
+        polling = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, polling.cancel)
+        await bot.delete_webhook(drop_pending_updates=False)
+        
+        offset = None
+        allowed = dp.resolve_used_update_types()
+        try:
+            while True:
+                updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed)
+                for update in updates:
+                    offset = update.update_id + 1
+                    data = update.model_dump(mode="json", exclude_unset=True)
+                    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                    # Backpressure: ждём, пока в очереди шарда освободится место
+                    while not shard_router.route(update_user_id(data), raw):
+                        await asyncio.sleep(0.1)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            server.should_exit = True
+            await server_task
+    finally:
+        await bot.session.close()
+
+
 if __name__ == "__main__":
     logger.info("📍 Script execution started")
     logger.info("🔄 Initializing database...")
     init_database()
+    load_known_users()
     logger.info("✅ Database initialized")
     logger.info("🤖 Starting ContentGPT Bot...")
     
     try:
-        asyncio.run(main())
+        if settings.BOT_WORKERS > 1:
+            # Воркеры форкаются до запуска event loop
+            shard_router, worker_processes = start_workers(
+                settings.BOT_WORKERS, run_worker, queue_size=settings.WEBHOOK_QUEUE_SIZE,
+            )
+            try:
+                asyncio.run(front_main())
+            finally:
+                stop_workers(shard_router, worker_processes)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("⏹️ Bot stopped by user")
     except Exception as e:
@@ -0,0 +1,95 @@
+# model_router.py - Выбор модели YandexGPT (yandexgpt / yandexgpt-lite) по типу контента и тарифу
+#
+# Политика: content_type -> {тариф | "*": модель}. Короткие шаблонные ответы
+# (хештеги, идеи, подписи) идут в lite — быстрее и дешевле; при ошибке или
+# таймауте запрос повторяется на другой модели. Исходы копятся в RouterStats,
+# чтобы политику можно было подстраивать по данным.
+
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+MODEL_PRO = "yandexgpt"
+MODEL_LITE = "yandexgpt-lite"
+MODELS = (MODEL_PRO, MODEL_LITE)
+
+DEFAULT_POLICY: Dict[str, Dict[str, str]] = {
+    "post": {"*": MODEL_PRO},
+    "story": {"*": MODEL_PRO},
+    "style_analysis": {"*": MODEL_PRO},
+    "caption": {"*": MODEL_LITE, "premium": MODEL_PRO, "vip": MODEL_PRO},
+    "ideas": {"*": MODEL_LITE, "vip": MODEL_PRO},
+    "hashtags": {"*": MODEL_LITE},
+}
+
+
+class RouterStats:
+    """Счётчики исходов по (модель, тип контента, тариф)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+
+    def record(self, model: str, content_type: str, tier: str, ok: bool, latency: float, fallback: bool) -> None:
+        key = (model, content_type, tier)
+        with self._lock:
+            s = self._stats.setdefault(key, {"ok": 0, "fail": 0, "fallback": 0, "latency_total": 0.0})
+            s["ok" if ok else "fail"] += 1
+            if fallback:
+                s["fallback"] += 1
+            if ok:
+                s["latency_total"] += latency
+
+    def snapshot(self) -> List[dict]:
+        """Сводка: успехи/ошибки/средняя задержка по каждому ключу."""
+        with self._lock:
+            return [
+                {
+                    "model": model,
+                    "content_type": ctype,
+                    "tier": tier,
+                    "ok": int(s["ok"]),
+                    "fail": int(s["fail"]),
+                    "fallback": int(s["fallback"]),
+                    "avg_latency": round(s["latency_total"] / s["ok"], 3) if s["ok"] else None,
+                }
+                for (model, ctype, tier), s in sorted(self._stats.items())
+            ]
+
+
+class ModelRouter:
+    """Политика выбора модели + запасная модель."""
+
+    def __init__(self, policy: Optional[Dict[str, Dict[str, str]]] = None, timeouts: Optional[Dict[str, float]] = None):
+        self.policy = {k: dict(v) for k, v in DEFAULT_POLICY.items()}
+        for ctype, rules in (policy or {}).items():
+            self.policy.setdefault(ctype, {}).update(rules)
+        self.timeouts = timeouts or {}
+        self.stats = RouterStats()
+
+    def route(self, content_type: str, tier: str = "free") -> List[str]:
+        """[основная модель, запасная модель]."""
+        rules = self.policy.get(content_type) or self.policy["post"]
+        primary = rules.get(tier) or rules.get("*") or MODEL_PRO
+        if primary not in MODELS:
+            logger.warning("⚠️ Неизвестная модель в политике: {}", primary)
+            primary = MODEL_PRO
+        fallback = MODEL_LITE if primary == MODEL_PRO else MODEL_PRO
+        return [primary, fallback]
+
+    def timeout_for(self, model: str, default: float) -> float:
+        return float(self.timeouts.get(model, default))
+
+
+def parse_policy(raw: str) -> Dict[str, Dict[str, str]]:
+    """MODEL_ROUTING: JSON вида {"ideas": {"*": "yandexgpt-lite", "vip": "yandexgpt"}}."""
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        return {str(k): {str(t): str(m) for t, m in v.items()} for k, v in data.items()}
+    except (ValueError, AttributeError) as e:
+        logger.error("❌ Некорректный MODEL_ROUTING: {}", e)
+        return {}
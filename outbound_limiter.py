@@ -0,0 +1,123 @@
+# outbound_limiter.py - Ограничитель исходящих запросов к Bot API (flood limits Telegram)
+#
+# Подключается middleware сессии бота, поэтому действует на все хендлеры сразу:
+#   • глобально ~30 сообщений/сек;
+#   • в личный чат ~1 сообщение/сек (с небольшим всплеском);
+#   • в группу ~20 сообщений/мин.
+# Запросы без chat_id (answerCallbackQuery, getUpdates, setWebhook…) не ограничиваются.
+# На TelegramRetryAfter чат «замораживается» на указанное время и запрос повторяется.
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from loguru import logger
+
+
+class TokenBucket:
+    """Токен-бакет с резервированием: reserve() сразу говорит, сколько ждать."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Занять токен; вернуть задержку до момента, когда он станет доступен."""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def block(self, seconds: float, now: float) -> None:
+        """Запретить отправку на seconds (после RetryAfter)."""
+        self._refill(now)
+        # следующий reserve() вернёт задержку ровно seconds
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundRateLimiter(BaseRequestMiddleware):
+    """Request-middleware: глобальный и по-чатовый лимиты + повтор на RetryAfter."""
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        group_per_minute: float = 20.0,
+        max_retries: int = 3,
+        max_chats: int = 10_000,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60.0
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats: Dict[int, TokenBucket] = {}
+
+    def set_global_rate(self, rate: float) -> None:
+        """Сменить глобальный лимит (доля процесса в многопроцессном режиме)."""
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Забываем чаты, которые давно ничего не отправляли
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle(now)}
+            is_group = chat_id < 0
+            bucket = TokenBucket(
+                self.group_rate if is_group else self.chat_rate,
+                self.chat_burst,
+            )
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        now = time.monotonic()
+        delay = max(
+            self._chat_bucket(chat_id, now).reserve(now),
+            self.global_bucket.reserve(now),
+        )
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id: Optional[int] = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            return await make_request(bot, method)
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(
+                    "⚠️ Flood limit для чата {}: ждём {}с ({}, попытка {})",
+                    chat_id, e.retry_after, type(method).__name__, attempt + 1,
+                )
+                self._chat_bucket(chat_id, time.monotonic()).block(e.retry_after, time.monotonic())
+
+        raise RuntimeError("unreachable")
@@ -0,0 +1,333 @@
+# payments.py - Платежи ЮKassa: идемпотентная смена статуса + проверка webhook
+#
+# Статус платежа меняется одной транзакцией с записью в журнал подписок
+# (entitlements.py): webhook, кнопка «✅ Я оплатил» и повторная доставка
+# уведомления могут прийти одновременно — период добавится ровно один раз.
+#
+# ЮKassa не подписывает уведомления: отправитель проверяется по IP (официальные
+# сети ЮKassa) и, опционально, по секрету в URL webhook, а статус из тела
+# уведомления не используется — он перезапрашивается в API.
+#
+# PaymentReconciler — страховка на случай потерянного webhook: платежи в pending
+# проверяются в API с экспоненциальным backoff (next_check_at по индексу),
+# брошенные — помечаются expired. Запускается задачей-одиночкой (leader.py).
+#
+# PaymentStatusCache — статусы из API для кнопки «✅ Я оплатил»: короткий TTL
+# и один запрос на платёж, сколько бы раз ни нажали кнопку.
+#
+# Таблица payments создаётся в init_database() (main.py).
+
+import asyncio
+import hmac
+import ipaddress
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from loguru import logger
+
+from entitlements import EntitlementLedger
+from yookassa_client import YooKassaClient, YooKassaError
+
+# https://yookassa.ru/developers/using-api/webhooks#ip
+YOOKASSA_NETWORKS = (
+    "185.71.76.0/27",
+    "185.71.77.0/27",
+    "77.75.153.0/25",
+    "77.75.156.11/32",
+    "77.75.156.35/32",
+    "77.75.154.128/25",
+    "2a02:5180::/32",
+)
+
+# Статус ЮKassa → статус строки payments
+PROVIDER_STATUS = {
+    "succeeded": "completed",
+    "waiting_for_capture": "completed",
+    "canceled": "canceled",
+}
+
+FINAL_STATUSES = ("completed", "canceled")
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def parse_networks(raw: str) -> List[Network]:
+    """'a.b.c.d/nn, ...' → список сетей; некорректные записи пропускаются."""
+    networks = []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning("⚠️ Некорректная сеть в allowlist: {}", item)
+    return networks
+
+
+class WebhookGuard:
+    """Проверка отправителя уведомлений: IP из allowlist и секрет из URL."""
+
+    def __init__(self, networks: List[Network], secret: str = "", proxy_hops: int = 0):
+        self.networks = networks
+        self.secret = secret
+        self.proxy_hops = proxy_hops
+
+    def client_ip(self, peer: Optional[str], forwarded_for: Optional[str]) -> Optional[str]:
+        """
+        Адрес клиента за proxy_hops доверенными прокси. Левые записи X-Forwarded-For
+        присылает сам клиент — верить можно только тем, что дописали наши прокси (справа).
+        """
+        if self.proxy_hops <= 0:
+            return peer
+        hops = [hop.strip() for hop in (forwarded_for or "").split(",") if hop.strip()]
+        if len(hops) < self.proxy_hops:
+            return None
+        return hops[-self.proxy_hops]
+
+    def allowed(self, ip: Optional[str], secret: str = "") -> bool:
+        if self.secret and not hmac.compare_digest(secret, self.secret):
+            return False
+        if not self.networks:
+            return True
+        try:
+            address = ipaddress.ip_address(ip or "")
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+
+class PaymentTransition:
+    """Результат смены статуса; changed — этот вызов перевёл платёж из pending."""
+
+    __slots__ = ("payment_id", "user_id", "subscription_type", "status", "changed")
+
+    def __init__(self, payment_id, user_id, subscription_type, status, changed):
+        self.payment_id = payment_id
+        self.user_id = user_id
+        self.subscription_type = subscription_type
+        self.status = status
+        self.changed = changed
+
+
+class PaymentStore:
+    """Переходы статусов платежей (pending → completed/canceled) + активация подписки."""
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], ledger: EntitlementLedger, subscription_days: int = 30):
+        self.connect = connect
+        self.ledger = ledger
+        self.subscription_days = subscription_days
+
+    def get(self, provider: str, external_id: str) -> Optional[PaymentTransition]:
+        """Текущее состояние платежа (changed=False) без записи; None — не найден."""
+        conn = self.connect()
+        try:
+            row = conn.execute("""
+                SELECT id, user_id, subscription_type, status FROM payments
+                WHERE provider = ? AND external_id = ?
+                ORDER BY id DESC LIMIT 1
+            """, (provider, external_id)).fetchone()
+        finally:
+            conn.close()
+        return PaymentTransition(*row, False) if row else None
+
+    def transition(self, provider: str, external_id: str, provider_status: str) -> Optional[PaymentTransition]:
+        """
+        Применить статус провайдера к платежу; None — платёж не найден.
+        Повторный вызов ничего не меняет (changed=False).
+        """
+        target = PROVIDER_STATUS.get(provider_status)
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("""
+                    SELECT id, user_id, subscription_type, status FROM payments
+                    WHERE provider = ? AND external_id = ?
+                    ORDER BY id DESC LIMIT 1
+                """, (provider, external_id)).fetchone()
+                if not row:
+                    conn.execute("COMMIT")
+                    return None
+                payment_id, user_id, sub_type, status = row
+                if target is None or status in FINAL_STATUSES:
+                    conn.execute("COMMIT")
+                    return PaymentTransition(payment_id, user_id, sub_type, status, False)
+
+                conn.execute(
+                    "UPDATE payments SET status = ?, updated_at = datetime('now') WHERE id = ?",
+                    (target, payment_id),
+                )
+                if target == "completed" and user_id and sub_type:
+                    self.ledger.grant(conn, user_id, provider, external_id, sub_type, self.subscription_days)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        if user_id:
+            self.ledger.invalidate(user_id)
+
+        logger.info("💳 Платёж {} ({}): {} → {}", external_id, provider, status, target)
+        return PaymentTransition(payment_id, user_id, sub_type, target, True)
+
+    def record_completed(
+        self,
+        user_id: int,
+        provider: str,
+        external_id: str,
+        subscription_type: str,
+        amount: float,
+        currency: str,
+    ) -> bool:
+        """Платёж, пришедший уже оплаченным (Telegram Stars); False — он уже учтён."""
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                granted = self.ledger.grant(conn, user_id, provider, external_id, subscription_type, self.subscription_days)
+                if granted:
+                    conn.execute("""
+                        INSERT INTO payments (user_id, provider, external_id, subscription_type, amount, currency, status)
+                        VALUES (?, ?, ?, ?, ?, ?, 'completed')
+                    """, (user_id, provider, external_id, subscription_type, amount, currency))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        self.ledger.invalidate(user_id)
+        return granted
+
+
+class PaymentStatusCache:
+    """Статус платежа из API: кэш на ttl секунд + общий запрос для одновременных нажатий."""
+
+    def __init__(self, client: YooKassaClient, ttl: float = 5.0, max_size: int = 10000):
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: Dict[str, Tuple[float, str]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def status(self, payment_id: str) -> str:
+        now = time.monotonic()
+        cached = self._cache.get(payment_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        task = self._inflight.get(payment_id)
+        if task is None:
+            task = self._inflight[payment_id] = asyncio.create_task(self._fetch(payment_id))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _fetch(self, payment_id: str) -> str:
+        try:
+            status = (await self.client.get_payment(payment_id)).get("status", "")
+        finally:
+            self._inflight.pop(payment_id, None)
+        if len(self._cache) >= self.max_size:
+            now = time.monotonic()
+            self._cache = {key: item for key, item in self._cache.items() if item[0] > now}
+        self._cache[payment_id] = (time.monotonic() + self.ttl, status)
+        return status
+
+
+class PaymentReconciler:
+    """Сверка зависших платежей с API: батч по индексу, backoff на платёж, лимит параллелизма."""
+
+    def __init__(
+        self,
+        store: PaymentStore,
+        client: YooKassaClient,
+        on_change: Optional[Callable[[PaymentTransition], Awaitable[None]]] = None,
+        batch_size: int = 100,
+        concurrency: int = 5,
+        backoff: float = 30.0,
+        max_backoff: float = 1800.0,
+        expire_after: float = 86400.0,
+    ):
+        self.store = store
+        self.client = client
+        self.on_change = on_change
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.expire_after = expire_after
+
+    def _due(self) -> List[Tuple[int, str, int, float]]:
+        """(id, external_id, check_attempts, возраст в секундах) платежей, которые пора проверить."""
+        conn = self.store.connect()
+        try:
+            return conn.execute("""
+                SELECT id, external_id, check_attempts,
+                       (julianday('now') - julianday(created_at)) * 86400
+                FROM payments
+                WHERE status = 'pending' AND next_check_at <= ? AND provider = 'yookassa'
+                ORDER BY next_check_at
+                LIMIT ?
+            """, (time.time(), self.batch_size)).fetchall()
+        finally:
+            conn.close()
+
+    def _reschedule(self, payment_id: int, attempts: int) -> None:
+        delay = min(self.max_backoff, self.backoff * 2 ** attempts)
+        self._update("""
+            UPDATE payments SET check_attempts = check_attempts + 1, next_check_at = ?
+            WHERE id = ? AND status = 'pending'
+        """, (time.time() + delay, payment_id))
+
+    def _expire(self, payment_id: int) -> None:
+        # Не финальный статус: если оплата всё же придёт, webhook её примет
+        self._update("""
+            UPDATE payments SET status = 'expired', updated_at = datetime('now')
+            WHERE id = ? AND status = 'pending'
+        """, (payment_id,))
+
+    def _update(self, sql: str, params: tuple) -> None:
+        conn = self.store.connect()
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _check(self, row: Tuple[int, str, int, float], limit: asyncio.Semaphore) -> None:
+        payment_id, external_id, attempts, age = row
+        async with limit:
+            try:
+                status = (await self.client.get_payment(external_id)).get("status", "")
+            except YooKassaError as e:
+                if e.status != 404:
+                    logger.warning("⚠️ Сверка платежа {}: {}", external_id, e)
+                    await asyncio.to_thread(self._reschedule, payment_id, attempts)
+                    return
+                status = ""
+
+        if status in PROVIDER_STATUS:
+            result = await asyncio.to_thread(self.store.transition, "yookassa", external_id, status)
+            if result is not None and result.changed and self.on_change is not None:
+                await self.on_change(result)
+        elif age >= self.expire_after:
+            await asyncio.to_thread(self._expire, payment_id)
+            logger.info("⌛ Платёж {} не оплачен за {:.0f} ч — expired", external_id, age / 3600)
+        else:
+            await asyncio.to_thread(self._reschedule, payment_id, attempts)
+
+    async def run_once(self) -> int:
+        """Проверить один батч; число проверенных платежей."""
+        if not self.client.configured:
+            return 0
+        rows = await asyncio.to_thread(self._due)
+        if rows:
+            limit = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*(self._check(row, limit) for row in rows))
+            logger.info("🔎 Сверка платежей: проверено {}", len(rows))
+        return len(rows)
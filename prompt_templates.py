@@ -0,0 +1,217 @@
+# prompt_templates.py - Реестр шаблонов промптов и бюджетов токенов по типам контента
+#
+# Каждый content_type описывается один раз: системный промпт, шаблон запроса,
+# maxTokens для ответа и бюджеты (в токенах) на пользовательские поля.
+# Шаблоны разбираются при импорте, а поля, превышающие бюджет, обрезаются
+# до отправки в YandexGPT.
+
+import math
+import re
+from string import Formatter
+from typing import Dict, List, Optional, Tuple
+
+# Средняя длина «слова-токена» для русского текста (оценка сверху по числу токенов)
+CHARS_PER_TOKEN = 4
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"[.!?…\n]")
+
+EDIT_MARKER = "\n\nВнеси правки (обязательно): "
+STYLE_NOTE = "\nСтиль автора (учти): {}\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов (без обращения к API токенизации)."""
+    if not text:
+        return 0
+    words = sum(math.ceil(len(w) / CHARS_PER_TOKEN) for w in _WORD_RE.findall(text))
+    return words + len(_PUNCT_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Обрезать текст до бюджета токенов по границе предложения/слова."""
+    if not text or budget <= 0:
+        return ""
+    if estimate_tokens(text) <= budget:
+        return text
+
+    # Грубая отсечка по символам, затем доводка до границы
+    cut = text[: budget * CHARS_PER_TOKEN]
+    while cut and estimate_tokens(cut) > budget:
+        cut = cut[: int(len(cut) * 0.9)]
+
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(cut)]
+    if ends and ends[-1] > len(cut) // 2:
+        cut = cut[: ends[-1]]
+    elif " " in cut:
+        cut = cut[: cut.rfind(" ")]
+
+    return cut.rstrip() + "…"
+
+
+class PromptTemplate:
+    """Предразобранный шаблон промпта для одного типа контента."""
+
+    __slots__ = ("content_type", "system", "parts", "max_tokens", "temperature", "field_budgets", "input_budget")
+
+    def __init__(
+        self,
+        content_type: str,
+        system: str,
+        template: str,
+        max_tokens: int,
+        field_budgets: Optional[Dict[str, int]] = None,
+        input_budget: int = 2000,
+        temperature: float = 0.7,
+    ):
+        self.content_type = content_type
+        self.system = system
+        # [(литерал, имя_поля | None), ...] — разбор один раз при импорте
+        self.parts: List[Tuple[str, Optional[str]]] = [
+            (literal, field) for literal, field, _, _ in Formatter().parse(template)
+        ]
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.field_budgets = field_budgets or {}
+        self.input_budget = input_budget
+
+    def render(self, **fields: str) -> str:
+        """Подставить поля с учётом бюджетов."""
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = str(fields.get(field, "") or "")
+            budget = self.field_budgets.get(field)
+            if budget:
+                value = truncate_to_tokens(value, budget)
+            out.append(value)
+        return "".join(out)
+
+
+TEMPLATES: Dict[str, PromptTemplate] = {
+    "post": PromptTemplate(
+        "post",
+        system="Ты профессиональный копирайтер для соцсетей. Дай структурированный пост с эмодзи и мягким CTA.",
+        template=(
+            "Создай пост для соцсетей.\n"
+            "Тема: {topic}\n"
+            "Аудитория: {audience}\n"
+            "Стиль: {style}\n"
+            "CTA: {cta}\n"
+            "Длина: 800–1200 знаков.\n"
+            "Добавь структуру (абзацы/списки), эмодзи уместно.\n"
+            "{style_note}"
+        ),
+        max_tokens=800,
+        field_budgets={"topic": 150, "audience": 80, "cta": 60, "style_note": 250},
+    ),
+    "story": PromptTemplate(
+        "story",
+        system="Ты сторителлер. Сгенерируй сценарий сторис в 5-7 пунктов + вопросы для вовлечения.",
+        template=(
+            "Сгенерируй сценарий сторис.\n"
+            "Цель/вектор: {vector}\n"
+            "Формат: 5–7 слайдов, на каждом: текст + что показать + вопрос/CTA.\n"
+            "{style_note}"
+        ),
+        max_tokens=700,
+        field_budgets={"vector": 150, "style_note": 250},
+    ),
+    "ideas": PromptTemplate(
+        "ideas",
+        system="Ты генератор идей. Дай 10 идей контента, разнообразных по формату.",
+        template=(
+            "Дай 10 идей контента.\n"
+            "Тема/ниша: {theme}\n"
+            "Сделай идеи разными по формату: пост, сторис, рилс, карусель, опрос.\n"
+            "{style_note}"
+        ),
+        max_tokens=500,
+        field_budgets={"theme": 150, "style_note": 150},
+    ),
+    "caption": PromptTemplate(
+        "caption",
+        system="Ты эксперт по подписям. Дай 2 версии (формальная/неформальная) + хештеги.",
+        template=(
+            "Сгенерируй подпись к посту в соцсетях.\n"
+            "Дай 2 версии: формальная и неформальная.\n"
+            "Добавь 10 хештегов.\n"
+            "ТЗ пользователя: {task}\n"
+            "{style_note}"
+        ),
+        max_tokens=400,
+        field_budgets={"task": 250, "style_note": 150},
+    ),
+    "hashtags": PromptTemplate(
+        "hashtags",
+        system="Ты SMM-специалист. Дай релевантные хештеги одной строкой, без пояснений.",
+        template="Подбери 15–20 хештегов.\nТема: {topic}\n",
+        max_tokens=150,
+        field_budgets={"topic": 150},
+    ),
+    "style_analysis": PromptTemplate(
+        "style_analysis",
+        system="Ты анализируешь стиль автора. Коротко опиши стиль (3-5 предложений) и ключевые приемы.",
+        template=(
+            "Проанализируй стиль автора по примерам.\n"
+            "Скажи: тон, структура, длина, любимые приемы, 3-5 характерных фраз.\n"
+            "Ответ: 3-5 предложений + 5 буллетов.\n\n"
+            "ПРИМЕРЫ:\n{examples}"
+        ),
+        max_tokens=450,
+        field_budgets={"examples": 1500},
+        input_budget=1800,
+    ),
+}
+
+# Сколько последних правок хранить в цепочке «✏️ Правки»
+EDIT_CHAIN_LIMIT = 3
+EDIT_INSTRUCTION_BUDGET = 200
+
+
+def get_template(content_type: str) -> PromptTemplate:
+    """Шаблон для типа контента (по умолчанию — пост)."""
+    return TEMPLATES.get(content_type) or TEMPLATES["post"]
+
+
+def render_prompt(content_type: str, user_style: Optional[str] = None, **fields: str) -> str:
+    """Собрать промпт для content_type; user_style превращается в заметку о стиле."""
+    fields["style_note"] = STYLE_NOTE.format(user_style) if user_style else ""
+    return get_template(content_type).render(**fields)
+
+
+def render_edit_prompt(content_type: str, prev_prompt: str, instruction: str) -> str:
+    """
+    Промпт для правок: исходный промпт + последние EDIT_CHAIN_LIMIT правок.
+    Более старые правки отбрасываются, общий размер укладывается в input_budget.
+    """
+    base, *edits = prev_prompt.split(EDIT_MARKER)
+    edits.append(truncate_to_tokens(instruction, EDIT_INSTRUCTION_BUDGET))
+    edits = edits[-EDIT_CHAIN_LIMIT:]
+    tail = "".join(EDIT_MARKER + e for e in edits)
+
+    budget = get_template(content_type).input_budget
+    return _truncate_base(base, max(budget - estimate_tokens(tail), budget // 2)) + tail
+
+
+def _truncate_base(base: str, budget: int) -> str:
+    # «…» в конце обрезанного текста — ещё один токен
+    if estimate_tokens(base) <= budget:
+        return base
+    return truncate_to_tokens(base, budget - estimate_tokens("…"))
+
+
+def fit_input(content_type: str, prompt: str) -> str:
+    """
+    Страховка перед отправкой: весь пользовательский промпт в пределах бюджета.
+    Режется только исходная часть — цепочка правок (последняя — от пользователя) остаётся целой.
+    """
+    budget = get_template(content_type).input_budget
+    if estimate_tokens(prompt) <= budget:
+        return prompt
+    base, marker, edits = prompt.partition(EDIT_MARKER)
+    tail = marker + edits
+    return _truncate_base(base, max(budget - estimate_tokens(tail), 0)) + tail
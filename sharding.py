@@ -0,0 +1,105 @@
+# sharding.py - Многопроцессный режим: фронт-процесс + N процессов-воркеров
+#
+# Фронт принимает апдейты (webhook или getUpdates), определяет user_id и кладёт
+# сырой JSON в очередь процесса user_id % N. Все апдейты пользователя попадают
+# в один процесс — сохраняются порядок, замок на пользователя и LRU-кэши.
+# Очередь задач общая (SQLite), но каждый процесс берёт из неё задачи только
+# своего шарда (JobQueue.set_shard) — иначе генерация и её спекулятивный
+# вариант попадали бы в кэши чужого процесса. FSM, генерации — тоже в SQLite.
+#
+# gunicorn здесь не подходит: он раздаёт соединения воркерам произвольно,
+# а нам нужно шардирование по пользователю.
+
+import multiprocessing
+import queue
+import signal
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+# Поля апдейта, у объекта которых есть автор (from/user)
+_USER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request", "message_reaction", "business_message", "edited_business_message",
+    "purchased_paid_media",
+)
+
+
+def update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    """user_id автора апдейта (без полного разбора в pydantic); None — апдейт без автора."""
+    for field in _USER_FIELDS:
+        obj = data.get(field)
+        if not obj:
+            continue
+        author = obj.get("from") or obj.get("user")
+        if author and "id" in author:
+            return int(author["id"])
+        chat = obj.get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+    return None
+
+
+class ShardRouter:
+    """Распределение апдейтов по очередям процессов-воркеров."""
+
+    def __init__(self, queues: List[Any]):
+        self.queues = queues
+
+    def shard_for(self, user_id: Optional[int]) -> int:
+        return user_id % len(self.queues) if user_id is not None else 0
+
+    def route(self, user_id: Optional[int], raw: bytes) -> bool:
+        """Положить апдейт в очередь шарда; False — очередь переполнена."""
+        try:
+            self.queues[self.shard_for(user_id)].put_nowait(raw)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self) -> None:
+        """Сигнал остановки всем воркерам."""
+        for q in self.queues:
+            try:
+                q.put(None, timeout=5)
+            except queue.Full:
+                pass
+
+
+def _worker_entry(index: int, q: Any, target: Callable[[int, Any], None]) -> None:
+    # Останавливает фронт (через None в очереди), а не сигнал всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    target(index, q)
+
+
+def start_workers(
+    count: int,
+    target: Callable[[int, Any], None],
+    queue_size: int = 1000,
+) -> Tuple[ShardRouter, List[multiprocessing.Process]]:
+    """
+    Запустить count процессов target(index, queue).
+    Используется fork: вызывать до запуска event loop, после init_database().
+    """
+    ctx = multiprocessing.get_context("fork")
+    queues = [ctx.Queue(maxsize=queue_size) for _ in range(count)]
+    processes = []
+    for index, q in enumerate(queues):
+        process = ctx.Process(target=_worker_entry, args=(index, q, target), name=f"bot-worker-{index}", daemon=False)
+        process.start()
+        processes.append(process)
+    logger.info("🧩 Запущено процессов-воркеров: {}", count)
+    return ShardRouter(queues), processes
+
+
+def stop_workers(router: ShardRouter, processes: List[multiprocessing.Process], timeout: float = 30.0) -> None:
+    """Дождаться штатной остановки воркеров (затем — terminate)."""
+    router.close()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning("⚠️ Воркер {} не остановился за {}с — terminate", process.name, timeout)
+            process.terminate()
+            process.join(5)
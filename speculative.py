@@ -0,0 +1,97 @@
+# speculative.py - Фоновая предгенерация «🔄 Ещё вариант»
+#
+# После выдачи результата для платных тарифов в фоне генерируется один
+# альтернативный вариант того же промпта. Он хранится в ограниченном буфере
+# с TTL (по одному на пользователя) и отдаётся мгновенно при content:regen.
+# Лимит списывается только при фактическом использовании варианта.
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from loguru import logger
+
+
+def prompt_key(content_type: str, prompt: str) -> str:
+    """Ключ варианта: тип контента + хеш промпта."""
+    return content_type + ":" + hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+
+class _Slot:
+    __slots__ = ("key", "task", "created")
+
+    def __init__(self, key: str, task: asyncio.Task, created: float):
+        self.key = key
+        self.task = task
+        self.created = created
+
+
+class SpeculativeBuffer:
+    """Буфер предгенерированных вариантов: user_id -> один вариант."""
+
+    def __init__(self, max_users: int = 500, ttl: float = 600.0):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._slots: "OrderedDict[int, _Slot]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def schedule(self, user_id: int, key: str, factory: Callable[[], Awaitable[Any]]) -> None:
+        """Запустить фоновую генерацию варианта (вытесняет предыдущий вариант юзера)."""
+        self.discard(user_id)
+        self._evict_expired()
+
+        while len(self._slots) >= self.max_users:
+            _, oldest = self._slots.popitem(last=False)
+            oldest.task.cancel()
+
+        task = asyncio.create_task(factory())
+        task.add_done_callback(_log_failure)
+        self._slots[user_id] = _Slot(key, task, time.monotonic())
+
+    async def take(self, user_id: int, key: str) -> Optional[Any]:
+        """
+        Забрать вариант для key (дождавшись, если он ещё генерируется).
+        Вариант отдаётся один раз; несовпадающий или устаревший — отбрасывается.
+        """
+        slot = self._slots.pop(user_id, None)
+        if slot is None:
+            return None
+
+        if slot.key != key or time.monotonic() - slot.created > self.ttl:
+            slot.task.cancel()
+            return None
+
+        try:
+            # shield: отмена ожидающего (остановка воркера) не выдаётся за отмену варианта
+            return await asyncio.shield(slot.task)
+        except asyncio.CancelledError:
+            if slot.task.cancelled():
+                return None
+            slot.task.cancel()
+            raise
+        except Exception:
+            return None
+
+    def discard(self, user_id: int) -> None:
+        """Отбросить вариант пользователя (если есть)."""
+        slot = self._slots.pop(user_id, None)
+        if slot is not None:
+            slot.task.cancel()
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        while self._slots:
+            slot = next(iter(self._slots.values()))
+            if now - slot.created <= self.ttl:
+                break
+            self._slots.popitem(last=False)
+            slot.task.cancel()
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("⚠️ Ошибка предгенерации варианта: {}", task.exception())
@@ -0,0 +1,136 @@
+# subscription_expiry.py - Истечение подписок и напоминания о продлении
+#
+# Лимиты уже считаются по журналу (entitlements.py) и истекают сами; здесь —
+# копия подписки в users: истёкшие строки находятся по индексу на
+# subscription_until и пересчитываются из журнала пачками (платный тариф может
+# смениться младшим, если у пользователя есть другой действующий период).
+# Заодно — напоминание о продлении за N дней до конца (если включены
+# notif_reminders), не более одного на период. Запускается задачей-одиночкой.
+# Напоминание помечается до отправки (два процесса не отправят его дважды);
+# если отправка упала с исключением (сеть, 429), пометка снимается — повторим
+# при следующем запуске.
+
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from loguru import logger
+
+from entitlements import EntitlementLedger
+
+# (user_id, subscription_type, subscription_until) → отправлено ли сообщение;
+# False — не отправлять больше (бот заблокирован), исключение — повторить позже
+RemindFunc = Callable[[int, str, str], Awaitable[bool]]
+
+
+class SubscriptionExpiry:
+    """Понижение истёкших подписок и напоминания о продлении."""
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        ledger: EntitlementLedger,
+        remind: Optional[RemindFunc] = None,
+        batch_size: int = 500,
+        remind_days: float = 3.0,
+    ):
+        self.connect = connect
+        self.ledger = ledger
+        self.remind = remind
+        self.batch_size = batch_size
+        self.remind_days = remind_days
+
+    def _expire_batch(self) -> List[int]:
+        """Пересчитать одну пачку истёкших подписок; их user_id."""
+        now = datetime.now().isoformat(timespec="seconds")
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                user_ids = [row[0] for row in conn.execute("""
+                    SELECT user_id FROM users
+                    WHERE subscription_type != 'free' AND subscription_until <= ?
+                    LIMIT ?
+                """, (now, self.batch_size))]
+                for user_id in user_ids:
+                    self.ledger.sync_user(conn, user_id)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        for user_id in user_ids:
+            self.ledger.invalidate(user_id)
+        return user_ids
+
+    def _due_reminders(self) -> List[Tuple[int, str, str]]:
+        now = datetime.now()
+        conn = self.connect()
+        try:
+            return conn.execute("""
+                SELECT u.user_id, u.subscription_type, u.subscription_until
+                FROM users u JOIN user_settings s ON s.user_id = u.user_id
+                WHERE u.subscription_type != 'free'
+                  AND u.subscription_until > ? AND u.subscription_until <= ?
+                  AND u.renewal_reminded_until IS NOT u.subscription_until
+                  AND u.is_active = 1 AND s.notif_reminders = 1
+                LIMIT ?
+            """, (
+                now.isoformat(timespec="seconds"),
+                (now + timedelta(days=self.remind_days)).isoformat(timespec="seconds"),
+                self.batch_size,
+            )).fetchall()
+        finally:
+            conn.close()
+
+    def _claim_reminder(self, user_id: int, until: str) -> bool:
+        """Пометить напоминание до отправки: два процесса не отправят его дважды."""
+        conn = self.connect()
+        try:
+            cur = conn.execute("""
+                UPDATE users SET renewal_reminded_until = ?
+                WHERE user_id = ? AND renewal_reminded_until IS NOT ?
+            """, (until, user_id, until))
+            conn.commit()
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def _release_reminder(self, user_id: int, until: str) -> None:
+        """Снять пометку после неудачной отправки."""
+        conn = self.connect()
+        try:
+            conn.execute("""
+                UPDATE users SET renewal_reminded_until = NULL
+                WHERE user_id = ? AND renewal_reminded_until = ?
+            """, (user_id, until))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def run_once(self) -> None:
+        expired = 0
+        while True:
+            batch = await asyncio.to_thread(self._expire_batch)
+            expired += len(batch)
+            if len(batch) < self.batch_size:
+                break
+        if expired:
+            logger.info("⌛ Истекло подписок: {}", expired)
+
+        if self.remind is None or self.remind_days <= 0:
+            return
+        sent = 0
+        for user_id, sub_type, until in await asyncio.to_thread(self._due_reminders):
+            if not await asyncio.to_thread(self._claim_reminder, user_id, until):
+                continue
+            try:
+                sent += int(await self.remind(user_id, sub_type, until))
+            except Exception as e:
+                logger.warning("⚠️ Напоминание {} не отправлено, повторим: {}", user_id, e)
+                await asyncio.to_thread(self._release_reminder, user_id, until)
+        if sent:
+            logger.info("🔔 Напоминаний о продлении: {}", sent)
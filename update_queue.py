@@ -0,0 +1,96 @@
+# update_queue.py - Быстрый ответ на webhook: очередь апдейтов + пул обработчиков + дедупликация
+#
+# Webhook только проверяет и ставит апдейт в очередь, сразу отвечая Telegram 200.
+# Обработка идёт в пуле asyncio-воркеров. Повторные доставки того же update_id
+# (Telegram повторяет запрос, если не дождался ответа) отбрасываются.
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from loguru import logger
+
+
+class UpdateDeduper:
+    """Ограниченное по размеру и времени множество недавних update_id."""
+
+    def __init__(self, window: float = 3600.0, max_size: int = 100_000):
+        self.window = window
+        self.max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, update_id: int) -> bool:
+        """True — апдейт уже был (повторная доставка); иначе запоминает его."""
+        now = time.monotonic()
+
+        while self._seen:
+            ts = next(iter(self._seen.values()))
+            if now - ts <= self.window and len(self._seen) < self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = now
+        return False
+
+    def forget(self, update_id: int) -> None:
+        """Убрать update_id (апдейт не принят — пусть Telegram доставит его снова)."""
+        self._seen.pop(update_id, None)
+
+
+class UpdateWorkerPool:
+    """Пул воркеров, обрабатывающих апдейты из очереди через dp.feed_update."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = 32, max_queue: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def full(self) -> bool:
+        return self.queue.full()
+
+    def submit(self, update: Update) -> bool:
+        """Поставить апдейт в очередь; False — очередь переполнена."""
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+            logger.info("⚙️ Пул обработки апдейтов: {} воркеров", self.workers)
+
+    async def stop(self, timeout: Optional[float] = 10.0) -> None:
+        """Дождаться обработки очереди (не дольше timeout) и остановить воркеров."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ В очереди осталось {} необработанных апдейтов", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.exception("❌ Ошибка обработки апдейта {}: {}", update.update_id, e)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,81 @@
+# user_serial.py - Последовательная обработка апдейтов одного пользователя
+#
+# Outer-middleware на dp.update: апдейты одного user_id идут строго по очереди
+# (FIFO-замок на пользователя), разные пользователи — параллельно.
+#   • очередь на пользователя ограничена: лишнее отклоняется с подсказкой;
+#   • повторное нажатие той же inline-кнопки, пока первое ещё в работе, схлопывается.
+# Ограничение очереди заодно не даёт одному пользователю занять весь пул воркеров.
+# Регистрируется ДО FSMContextMiddleware (см. main.py): состояние FSM читается под замком.
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+from loguru import logger
+
+
+class _UserLane:
+    __slots__ = ("lock", "size", "callbacks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0              # выполняется + ждут
+        self.callbacks: Set[str] = set()
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    """Замок на пользователя + ограниченная очередь + схлопывание дублей callback."""
+
+    def __init__(self, max_queue: int = 3):
+        self.max_queue = max_queue
+        self._lanes: Dict[int, _UserLane] = {}
+
+    def __len__(self) -> int:
+        return len(self._lanes)
+
+    async def _reject(self, event: Update, data: Dict[str, Any], text: str) -> None:
+        bot = data["bot"]
+        try:
+            if event.callback_query:
+                await bot.answer_callback_query(event.callback_query.id, text)
+            elif event.message:
+                await bot.send_message(event.message.chat.id, text)
+        except Exception as e:
+            logger.debug("Не удалось ответить на отклонённый апдейт: {}", e)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if user is None or not isinstance(event, Update):
+            return await handler(event, data)
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = _UserLane()
+
+        callback_data = event.callback_query.data if event.callback_query else None
+        if callback_data and callback_data in lane.callbacks:
+            await self._reject(event, data, "⏳ Уже выполняется…")
+            return None
+        if lane.size > self.max_queue:
+            logger.warning("⚠️ Очередь юзера {} переполнена, апдейт {} отклонён", user.id, event.update_id)
+            await self._reject(event, data, "⏳ Подождите, обрабатываю предыдущий запрос.")
+            return None
+
+        lane.size += 1
+        if callback_data:
+            lane.callbacks.add(callback_data)
+        try:
+            async with lane.lock:
+                return await handler(event, data)
+        finally:
+            lane.size -= 1
+            if callback_data:
+                lane.callbacks.discard(callback_data)
+            if lane.size == 0:
+                self._lanes.pop(user.id, None)
@@ -0,0 +1,142 @@
+# yookassa_client.py - Асинхронный клиент API ЮKassa на общем keep-alive пуле
+#
+# Одна aiohttp-сессия на процесс: TLS-соединения переиспользуются, число
+# одновременных соединений ограничено, у каждого запроса — таймаут.
+# Сессия создаётся лениво в работающем event loop (после fork — своя у каждого
+# процесса-воркера). aiohttp приходит вместе с aiogram.
+#
+# Сетевые ошибки, 429 и 5xx повторяются с backoff; повтор создания платежа
+# идёт с тем же Idempotence-Key — ЮKassa вернёт уже созданный платёж, а не второй.
+# Ошибки — YooKassaError с кодом и описанием из ответа API.
+
+import asyncio
+import uuid
+from typing import Any, Dict, Optional
+
+import aiohttp
+from loguru import logger
+
+
+class YooKassaError(Exception):
+    """Ошибка API ЮKassa; status — HTTP-код (0 — сеть/таймаут), code/description — из тела ответа."""
+
+    def __init__(self, status: int, code: str = "", description: str = ""):
+        super().__init__(f"{status} {code}: {description}".strip())
+        self.status = status
+        self.code = code
+        self.description = description or code or f"HTTP {status}"
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 0 or self.status == 429 or self.status >= 500
+
+
+class YooKassaClient:
+    """Запросы к API ЮKassa через общий пул соединений."""
+
+    def __init__(
+        self,
+        shop_id: str,
+        secret_key: str,
+        api_base: str = "https://api.yookassa.ru/v3",
+        timeout: float = 10.0,
+        max_connections: int = 20,
+        retries: int = 2,
+        retry_backoff: float = 0.5,
+    ):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.api_base = api_base.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.shop_id, self.secret_key),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _send(self, method: str, path: str, headers: Dict[str, str], body: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        try:
+            async with self._get_session().request(
+                method, f"{self.api_base}{path}", json=body, headers=headers,
+            ) as response:
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    data = {}
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise YooKassaError(0, "network_error", repr(e)) from e
+
+        if status in (200, 201):
+            return data
+        data = data if isinstance(data, dict) else {}
+        # 202 — запрос с этим Idempotence-Key ещё обрабатывается, повторить позже
+        if status == 202:
+            raise YooKassaError(503, "processing", "запрос ещё обрабатывается")
+        raise YooKassaError(status, data.get("code", ""), data.get("description", ""))
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Dict[str, Any]] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if not self.configured:
+            raise YooKassaError(0, "not_configured", "ЮKassa не настроена")
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else {}
+        attempt = 0
+        while True:
+            try:
+                return await self._send(method, path, headers, body)
+            except YooKassaError as e:
+                if not e.retryable or attempt >= self.retries:
+                    logger.warning("⚠️ ЮKassa {} {}: {}", method, path, e)
+                    raise
+                logger.debug("ЮKassa {} {}: {} — повтор {}", method, path, e, attempt + 1)
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    async def create_payment(
+        self,
+        amount: float,
+        description: str,
+        return_url: str,
+        metadata: Optional[Dict[str, Any]] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Создать платёж (redirect-подтверждение, автосписание).
+        idempotence_key — один на платёж (например, order_id): повторы не создадут дубль.
+        """
+        body = {
+            "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": return_url},
+            "capture": True,
+            "description": description[:128],
+            "metadata": metadata or {},
+        }
+        payment = await self._request("POST", "/payments", body, idempotence_key or str(uuid.uuid4()))
+        logger.info("✅ Платёж создан: {}", payment.get("id"))
+        return payment
+
+    async def get_payment(self, payment_id: str) -> Dict[str, Any]:
+        """Объект платежа (id, status, amount, ...)."""
+        return await self._request("GET", f"/payments/{payment_id}")